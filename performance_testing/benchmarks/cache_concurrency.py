@@ -0,0 +1,76 @@
+"""
+Concurrency benchmark for the protein cache (pc).
+
+Stores a set of synthetic protein files in the cache, then requests them
+at increasing levels of concurrency, printing throughput and latency percentiles.
+
+Run it against a version of pc before and after a change to compare them, e.g.
+    MONGO_HOST=localhost:27017 python protein-cache/src/main.py
+    python benchmarks/cache_concurrency.py --url http://0.0.0.0:6000
+Set HOT_CACHE_MAX_BYTES=0 when starting pc to measure the mongo path
+rather than the in-memory hot cache.
+"""
+import argparse
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+
+def synthetic_protein_file(i, atoms):
+    "Return a ProteinFile json object with a pdb file of the given number of atoms"
+    lines = [f"ATOM  {n:5d}  CA  ALA A{n % 9999:4d}    {random.uniform(-99, 99):8.3f}"
+             f"{random.uniform(-99, 99):8.3f}{random.uniform(-99, 99):8.3f}  1.00 0.00           C"
+             for n in range(atoms)]
+    return {"uniprot_id": f"BENCH{i:05d}",
+            "pdb_file": "\n".join(lines) + "\nEND\n",
+            "sequence": "".join(random.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(300)),
+            "source_db": "BENCHMARK",
+            "score": random.random()}
+
+
+def seed(url, n, atoms):
+    files = [synthetic_protein_file(i, atoms) for i in range(n)]
+    r = requests.post(url + "/protein_files/", json=files)
+    r.raise_for_status()
+    return [f["uniprot_id"] for f in files]
+
+
+def run(url, ids, concurrency, requests_per_level):
+    "Return (requests per second, list of latencies in ms) for one concurrency level"
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+
+    def request(i):
+        start = time.perf_counter()
+        r = session.get(f"{url}/retrieve_by_uniprot_id/{ids[i % len(ids)]}")
+        r.raise_for_status()
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(request, range(requests_per_level)))
+    return requests_per_level / (time.perf_counter() - start), latencies
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://0.0.0.0:6000")
+    parser.add_argument("--entries", type=int, default=200, help="number of files to store")
+    parser.add_argument("--atoms", type=int, default=3000, help="atoms per file (~80 bytes each)")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    args = parser.parse_args()
+
+    ids = seed(args.url, args.entries, args.atoms)
+    print(f"{'concurrency':>12} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for concurrency in args.concurrency:
+        throughput, latencies = run(args.url, ids, concurrency, args.requests)
+        print(f"{concurrency:>12} {throughput:>10.1f} {percentile(latencies, 50):>10.2f} "
+              f"{percentile(latencies, 95):>10.2f} {percentile(latencies, 99):>10.2f}")
@@ -0,0 +1,78 @@
+"""
+Microbenchmark of ranking the entries of a cache miss in pss, comparing
+scoring each entry object and sorting them all, as pss used to, with scoring
+the PDB entries in one vectorized pass and selecting only the top k, as it does now.
+
+The protein has --entries PDB entries (500 by default, more than most of the
+heavily studied proteins have) and an AlphaFold DB entry. Prints the best time
+per ranking for each way, and checks both pick the same entries.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "protein-structure-storage"))
+os.chdir(os.path.join(os.path.dirname(__file__), "..", "..", "protein-structure-storage"))  # for the weights files
+from src.database_entries.afdb_entry import AFDBEntry  # noqa: E402
+from src.database_entries.pdbe_entry import PDBeEntry  # noqa: E402
+from src.database_entries.ranking import top_entries  # noqa: E402
+logging.disable(logging.WARNING)
+
+
+def synthetic_entries(n):
+    "Return the entry data of a protein with n PDB entries and an AlphaFold DB entry"
+    sequence = "".join(random.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(393))
+    metadata = {"sequence": sequence, "sequence_length": "393", "mass": "43653"}
+    entries = []
+    for i in range(n):
+        start = random.randint(1, 300)
+        chains = ", ".join(f"{chr(65 + c)}/{chr(66 + c)}={start}-{random.randint(start, 393)}"
+                           for c in range(0, random.randint(1, 3) * 2, 2))
+        entries.append({"external_db_name": "PDB", "id": f"{i:04X}",
+                        "method": random.choice(["X-ray", "X-ray", "EM", "NMR"]),
+                        "resolution": f"{random.uniform(1, 4):.2f} A", "chains": chains,
+                        "protein_metadata": metadata})
+    entries.append({"external_db_name": "AlphaFoldDB", "id": "P04637", "protein_metadata": metadata})
+    return entries
+
+
+def entry_objects(entry_data):
+    return [AFDBEntry(d) if d["external_db_name"] == "AlphaFoldDB" else PDBeEntry(d) for d in entry_data]
+
+
+def sort_all(entry_data, k):
+    "The ranking pss used before, scoring every entry object and sorting them all"
+    entries = entry_objects(entry_data)
+    entries.sort(reverse=True)
+    return entries[:k]
+
+
+def vectorized(entry_data, k):
+    return top_entries(entry_objects(entry_data), k)
+
+
+def best_ms(fn, entry_data, k, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(entry_data, k)
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=500, help="PDB entries of the protein")
+    parser.add_argument("-k", type=int, default=3, help="entries selected, FETCH_MAX_ATTEMPTS in pss")
+    parser.add_argument("--repeats", type=int, default=50, help="rankings per way, the best is reported")
+    args = parser.parse_args()
+
+    entry_data = synthetic_entries(args.entries)
+    expected = [e.entry_data["id"] for e in sort_all(entry_data, args.k)]
+    assert [e.entry_data["id"] for e in vectorized(entry_data, args.k)] == expected, "the rankings differ"
+    print(f"{args.entries} PDB entries, top {args.k}: {', '.join(expected)}")
+    for name, fn in [("sort all", sort_all), ("vectorized", vectorized)]:
+        print(f"{name:>12} {best_ms(fn, entry_data, args.k, args.repeats):>8.2f} ms")
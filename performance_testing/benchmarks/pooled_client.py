@@ -0,0 +1,144 @@
+"""
+Benchmark of the latency of a cold cache miss in pss, comparing a new
+connection per request (urllib's urlopen, as pss used to) with the shared
+pooled client pss now uses for all its outbound requests.
+
+A cold miss makes a request to each of three hosts: the uniprot xml,
+the structure file from rcsb or afdb, and the cache.
+
+By default the hosts are simulated by local servers, two over TLS with a
+self signed certificate (made with the openssl command) and one over plain http,
+each adding --rtt-ms of latency per round trip, i.e. 2 round trips to accept
+a TLS connection (TCP and TLS 1.3 handshakes), 1 for a plain connection
+and 1 per request. Use --remote to request the real uniprot, rcsb and afdb
+servers instead (the cache is skipped).
+
+Prints the mean and percentile latency of a miss for each client.
+"""
+import argparse
+import asyncio
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "protein-structure-storage"))
+from src.http_client import create_client  # noqa: E402
+
+REMOTE_URLS = ["https://rest.uniprot.org/uniprotkb/{id}.xml",
+               "https://alphafold.ebi.ac.uk/files/AF-{id}-F1-model_v4.pdb",
+               "https://files.rcsb.org/download/1TUP.pdb"]
+REMOTE_IDS = ["P04637", "P02070", "P69905", "P68871", "P00533"]
+
+
+class SlowServer(ThreadingHTTPServer):
+    "Server adding rtt seconds of latency per round trip"
+    daemon_threads = True
+
+    def __init__(self, rtt, tls_context=None):
+        self.rtt = rtt
+        self.tls_context = tls_context
+        super().__init__(("127.0.0.1", 0), Handler)
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        time.sleep(self.rtt)  # TCP handshake
+        if self.tls_context is not None:
+            time.sleep(self.rtt)  # TLS 1.3 handshake
+            sock = self.tls_context.wrap_socket(sock, server_side=True)
+        return sock, addr
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections alive
+    body = b"ATOM  " * 10000
+
+    def do_GET(self):
+        time.sleep(self.server.rtt)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def self_signed_certificate(directory):
+    "Return the (certificate, key) paths of a new self signed certificate for 127.0.0.1"
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                    "-keyout", key, "-out", cert], check=True, capture_output=True)
+    return cert, key
+
+
+def start_local_hosts(rtt, directory):
+    "Start the three simulated hosts, returning their url templates and a client tls context"
+    cert, key = self_signed_certificate(directory)
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert, key)
+    servers = [SlowServer(rtt, server_context), SlowServer(rtt, server_context), SlowServer(rtt)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = [f"https://127.0.0.1:{servers[0].server_port}/uniprotkb/{{id}}.xml",
+            f"https://127.0.0.1:{servers[1].server_port}/files/{{id}}.pdb",
+            f"http://127.0.0.1:{servers[2].server_port}/raw/retrieve_by_uniprot_id/{{id}}"]
+    return urls, ssl.create_default_context(cafile=cert)
+
+
+def urlopen_miss(urls, id, context):
+    for url in urls:
+        with urllib.request.urlopen(url.format(id=id), context=context) as f:
+            f.read()
+
+
+def pooled_miss(client, loop):
+    async def get_all(urls, id):
+        for url in urls:
+            (await client.get(url.format(id=id))).raise_for_status()
+
+    def miss(urls, id, context):
+        loop.run_until_complete(get_all(urls, id))
+    return miss
+
+
+def run(miss, urls, ids, context, n):
+    "Return the latency in ms of n misses, cycling through ids"
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        miss(urls, ids[i % len(ids)], context)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--misses", type=int, default=50, help="cold misses per client")
+    parser.add_argument("--rtt-ms", type=float, default=20, help="simulated round trip time")
+    parser.add_argument("--remote", action="store_true", help="use the real uniprot, afdb and rcsb servers")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.remote:
+            urls, ids, context = REMOTE_URLS, REMOTE_IDS, ssl.create_default_context()
+        else:
+            urls, context = start_local_hosts(args.rtt_ms / 1000, directory)
+            ids = REMOTE_IDS
+        loop = asyncio.new_event_loop()
+        client = create_client(verify=context)
+        print(f"{'client':>10} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} {'first ms':>10}")
+        for name, miss in [("urlopen", urlopen_miss), ("pooled", pooled_miss(client, loop))]:
+            latencies = run(miss, urls, ids, context, args.misses)
+            p = statistics.quantiles(latencies, n=100)
+            print(f"{name:>10} {statistics.mean(latencies):>10.1f} {p[49]:>10.1f} {p[94]:>10.1f} "
+                  f"{latencies[0]:>10.1f}")
+        loop.run_until_complete(client.aclose())
+        loop.close()
@@ -0,0 +1,74 @@
+"""
+Microbenchmark of the per cache hit work done by pc and pss to move a file,
+comparing the json transport with the raw transport.
+
+json: pc renders {"present": true, "pdb_file": ...} as json, pss parses the json
+      and encodes the file again for its plain text response.
+raw:  pc sends the stored bytes with the metadata in headers,
+      pss passes the chunks through to its client.
+
+Prints CPU time per hit and peak memory allocated per hit for a few file sizes.
+Needs no running services.
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+CHUNK_SIZE = 64 * 1024
+
+
+def synthetic_pdb_file(size):
+    "Return a pdb like text of roughly size bytes"
+    line = "ATOM  {:5d}  CA  ALA A{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00 0.00           C\n"
+    lines = []
+    total = 0
+    while total < size:
+        lines.append(line.format(len(lines) % 99999, len(lines) % 9999,
+                                 random.uniform(-99, 99), random.uniform(-99, 99), random.uniform(-99, 99)))
+        total += len(lines[-1])
+    return "".join(lines)
+
+
+def json_hit(stored):
+    # pc: decode the stored file and render it like fastapi's JSONResponse
+    body = json.dumps({"present": True, "pdb_file": stored.decode()}, ensure_ascii=False,
+                      allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+    # pss: parse the response and render a PlainTextResponse
+    return json.loads(body)["pdb_file"].encode("utf-8")
+
+
+def raw_hit(stored):
+    # pc: send the stored bytes, pss: stream the chunks through
+    for i in range(0, len(stored), CHUNK_SIZE):
+        chunk = memoryview(stored)[i:i + CHUNK_SIZE]
+    return stored
+
+
+def measure(fn, stored, repeats):
+    "Return (cpu ms per hit, peak bytes allocated per hit)"
+    start = time.process_time()
+    for _ in range(repeats):
+        fn(stored)
+    cpu = (time.process_time() - start) * 1000 / repeats
+    tracemalloc.start()
+    fn(stored)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 10_000_000],
+                        help="file sizes in bytes")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'size':>12} {'transport':>10} {'cpu ms/hit':>12} {'peak MB/hit':>12}")
+    for size in args.sizes:
+        stored = synthetic_pdb_file(size).encode()
+        for name, fn in [("json", json_hit), ("raw", raw_hit)]:
+            cpu, peak = measure(fn, stored, args.repeats)
+            print(f"{len(stored):>12} {name:>10} {cpu:>12.3f} {peak / 1e6:>12.2f}")
@@ -0,0 +1,135 @@
+"""
+Microbenchmark of parsing the UniProt xml of a cache miss in pss, comparing
+the full tree parse pss used to do (a dict for every dbReference) of the whole
+response, and the streamed parse it does now, which parses the response in
+chunks as they arrive and keeps only the supported databases.
+
+By default it parses a synthetic entry shaped like P04637 (p53), one of the
+most studied proteins: a few hundred PDB structures among thousands of other
+cross references, citations and features. Use --fetch to download the real
+P04637 entry from UniProt, or --file to parse a saved xml file.
+
+The response is given to each parser as chunks read from the network would be,
+so the peak memory includes the response body a parser holds, as well as what it parses.
+Prints the time and peak memory allocated per parse for each parser, the
+entries returned, and the size of the json pss keeps in its metadata cache for them.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import urllib.request
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "protein-structure-storage"))
+from src.uniprot import _EntriesParser, XML_CHUNK_BYTES  # noqa: E402
+
+UNIPROT_URL = "https://rest.uniprot.org/uniprotkb/{id}.xml"
+
+
+def response_chunks(xml_text):
+    "Yield xml_text in new chunks of XML_CHUNK_BYTES, as a streamed response would"
+    for start in range(0, len(xml_text), XML_CHUNK_BYTES):
+        yield xml_text[start:start + XML_CHUNK_BYTES]
+
+
+def synthetic_entry(pdb_refs=300, other_refs=2500, citations=300, features=1500):
+    "Return the xml of a uniprot entry with roughly the shape of P04637"
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<uniprot xmlns="http://uniprot.org/uniprot">\n'
+             '<entry dataset="Swiss-Prot"><accession>P04637</accession>\n']
+    for i in range(citations):
+        parts.append(f'<reference key="{i}"><citation type="journal article" date="2000">'
+                     f'<title>Title of paper {i}</title><authorList><person name="A. Author"/></authorList>'
+                     f'<dbReference type="PubMed" id="{10000000 + i}"/><dbReference type="DOI" id="10.1/{i}"/>'
+                     f'</citation><scope>FUNCTION</scope></reference>\n')
+    for i in range(pdb_refs):
+        parts.append(f'<dbReference type="PDB" id="{i:04X}"><property type="method" value="X-ray"/>'
+                     f'<property type="resolution" value="{random.uniform(1, 4):.2f} A"/>'
+                     f'<property type="chains" value="A/B=94-312"/></dbReference>\n')
+    parts.append('<dbReference type="AlphaFoldDB" id="P04637"/>\n')
+    databases = ["GO", "InterPro", "Pfam", "EMBL", "RefSeq", "Reactome", "STRING", "BioGRID"]
+    for i in range(other_refs):
+        parts.append(f'<dbReference type="{databases[i % len(databases)]}" id="X{i}">'
+                     f'<property type="term" value="some description of reference {i}"/>'
+                     f'<property type="evidence" value="ECO:0000269"/></dbReference>\n')
+    for i in range(features):
+        parts.append(f'<feature type="modified residue" description="Phosphoserine" evidence="{i % 50}">'
+                     f'<location><position position="{i % 393 + 1}"/></location></feature>\n')
+    sequence = "".join(random.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(393))
+    parts.append(f'<sequence length="393" mass="43653" checksum="AD5C149FD8106131" version="4">{sequence}</sequence>\n'
+                 '</entry>\n</uniprot>\n')
+    return "".join(parts).encode()
+
+
+def full_tree_entries(chunks):
+    """The parser pss used before, reading the whole response, then building the whole tree
+    and a dict for every dbReference"""
+    entries = []
+    root = ElementTree.fromstring(b"".join(chunks))
+    extracted_metadata = {}
+    for child in root:
+        if child.tag.endswith("entry"):
+            for dbentry in child:
+                if dbentry.tag.endswith("dbReference"):
+                    new_entry = {}
+                    new_entry['external_db_name'] = dbentry.attrib['type']
+                    new_entry['id'] = dbentry.attrib['id']
+                    for properties in dbentry:
+                        if properties.tag.endswith("property"):
+                            new_entry[properties.attrib['type']] = properties.attrib['value']
+                    entries.append(new_entry)
+                elif dbentry.tag.endswith("sequence"):
+                    extracted_metadata["sequence"] = dbentry.text
+                    extracted_metadata["mass"] = dbentry.attrib['mass']
+                    extracted_metadata["sequence_length"] = dbentry.attrib['length']
+    for entry in entries:
+        entry["protein_metadata"] = extracted_metadata
+    return entries
+
+
+def streamed_entries(chunks):
+    "The parser pss uses now, parsing each chunk of the response as it arrives"
+    parser = _EntriesParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def measure(fn, xml_text, repeats):
+    "Return (best ms per parse, peak bytes allocated per parse, entries returned, bytes of their json)"
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(response_chunks(xml_text))
+        times.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    entries = fn(response_chunks(xml_text))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stored = json.dumps([{k: v for k, v in entry.items() if k != "protein_metadata"} for entry in entries])
+    return min(times), peak, len(entries), len(stored)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fetch", metavar="ID", nargs="?", const="P04637", help="download the entry from uniprot")
+    parser.add_argument("--file", help="parse a saved uniprot xml file")
+    parser.add_argument("--repeats", type=int, default=20, help="parses per parser, the best is reported")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file, "rb") as f:
+            xml_text = f.read()
+    elif args.fetch is not None:
+        with urllib.request.urlopen(UNIPROT_URL.format(id=args.fetch)) as f:
+            xml_text = f.read()
+    else:
+        xml_text = synthetic_entry()
+    print(f"xml of {len(xml_text) / 1024:.0f}KB")
+    print(f"{'parser':>12} {'ms':>8} {'peak KB':>10} {'entries':>8} {'json KB':>8}")
+    for name, fn in [("full tree", full_tree_entries), ("streamed", streamed_entries)]:
+        ms, peak, entries, stored = measure(fn, xml_text, args.repeats)
+        print(f"{name:>12} {ms:>8.1f} {peak / 1024:>10.0f} {entries:>8} {stored / 1024:>8.0f}")
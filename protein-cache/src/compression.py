@@ -0,0 +1,74 @@
+import os
+import zlib
+from starlette.exceptions import HTTPException
+
+# Bytes a gzip compressed request body may decompress to, so a small body can't expand to fill the memory
+MAX_DECOMPRESSED_BYTES = int(os.environ.get("MAX_DECOMPRESSED_BYTES", 512 * 1024 * 1024))
+
+
+def accepts_gzip(accept_encoding):
+    """Return True if an Accept-Encoding header value accepts gzip,
+    e.g. "gzip, deflate" or "*;q=0, gzip" but not "gzip;q=0" or a missing header.
+    A gzip coding takes precedence over *, and the highest q of a coding given twice wins."""
+    if accept_encoding is None:
+        return False
+    qualities = {}
+    for coding in accept_encoding.lower().split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip()
+        if name not in ("gzip", "*"):
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = max(quality, qualities.get(name, 0.0))
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+class DecompressRequestMiddleware:
+    """ASGI middleware decompressing request bodies sent with Content-Encoding: gzip
+    as they arrive, so pss can send the files it stores compressed.
+    Other request bodies are passed on unchanged. Bodies decompressing to more than max_bytes
+    are rejected with 413, and bodies that aren't valid gzip with 400."""
+
+    def __init__(self, app, max_bytes=MAX_DECOMPRESSED_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = scope["headers"]
+        encoding = next((v for k, v in headers if k == b"content-encoding"), b"").strip().lower()
+        if encoding != b"gzip":
+            return await self.app(scope, receive, send)
+        # the body the app sees has neither the encoding nor the compressed length
+        scope = dict(scope, headers=[(k, v) for k, v in headers
+                                     if k not in (b"content-encoding", b"content-length")])
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressed = 0
+
+        async def receive_decompressed():
+            nonlocal decompressed
+            message = await receive()
+            if message["type"] == "http.request":
+                # one byte past the limit is enough to know the body is too large
+                remaining = self.max_bytes - decompressed + 1
+                try:
+                    body = decompressor.decompress(message.get("body", b""), remaining)
+                    if not message.get("more_body", False) and len(body) < remaining:
+                        body += decompressor.flush()
+                except zlib.error as e:
+                    raise HTTPException(400, f"Invalid gzip request body: {e}")
+                decompressed += len(body)
+                if decompressed > self.max_bytes:
+                    raise HTTPException(413, f"Request body decompresses to more than {self.max_bytes} bytes")
+                message = dict(message, body=body)
+            return message
+
+        await self.app(scope, receive_decompressed, send)
@@ -1,80 +1,387 @@
-from pymongo import MongoClient
-import time
+from datetime import datetime, timezone
 from hashlib import blake2b
+import asyncio
+import json
+import os
+import time
+from kmers import KMER_LENGTH, sequence_kmers
+from hot_cache import HotCache
+from eviction import AccessTracker, EvictionStats, parse_ttls
+from metrics import MongoCommandTimer
+from storage import create_engine
+from storage.base import METADATA_FIELDS
+
+# Storage engine holding the cache, "mongo" or "sqlite" (see storage/)
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "mongo")
+
+engine = None
+
+
+async def connect(storage_engine=None):
+    """Open the storage engine and prepare it for use, by default the one
+    named by STORAGE_ENGINE. Must be called from the running event loop
+    before using the cache."""
+    global engine
+    if storage_engine is None:
+        storage_engine = create_engine(STORAGE_ENGINE, event_listeners=[MongoCommandTimer()])
+    engine = storage_engine
+    await engine.connect()
+    print(f"Using the {engine.name} storage engine")
+
+
+async def close():
+    await engine.close()
 
-def wait_for_mongo(host="mongo:27017", retries=5, delay=5):
-    # Create a temporary client with a short serverSelectionTimeout
-    temp_client = MongoClient(host=host, serverSelectionTimeoutMS=1000)  # Short timeout for initial connection attempts
-    for attempt in range(retries):
-        try:
-            # Attempt to ping the MongoDB server
-            temp_client.admin.command('ping')
-            print("MongoDB is ready!")
-            return True  # MongoDB is ready
-        except Exception as e:
-            print(f"Waiting for MongoDB... Attempt {attempt + 1}/{retries}")
-            time.sleep(delay)
-    raise Exception("MongoDB not ready after max retries. Exiting.")
 
-# Wait for MongoDB to be ready before establishing a permanent connection
-wait_for_mongo()
+# In-memory cache of recent query results in front of the storage engine, bounded in bytes
+HOT_CACHE_MAX_BYTES = int(os.environ.get("HOT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+hot_cache = HotCache(HOT_CACHE_MAX_BYTES)
 
-# Connect to running database with a longer timeout now that we know MongoDB is ready
-client = MongoClient(host="mongo:27017", serverSelectionTimeoutMS=30000)
+# Byte budget of the storage engine, 0 for no limit.
+# Once it is exceeded the least frequently accessed entries are evicted.
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 0))
+# Optional ttl per source db, e.g. "ALPHAFOLDDB=30" to refetch AFDB entries monthly
+CACHE_TTL_DAYS = parse_ttls(os.environ.get("CACHE_TTL_DAYS", ""))
+EVICTION_INTERVAL_SECONDS = float(os.environ.get("EVICTION_INTERVAL_SECONDS", 60))
+access_tracker = AccessTracker()
+eviction_stats = EvictionStats()
+# Days the uniprot metadata stored by pss is kept. pss decides how old
+# metadata it will use itself, this only bounds what is kept.
+UNIPROT_METADATA_RETENTION_DAYS = float(os.environ.get("UNIPROT_METADATA_RETENTION_DAYS", 30))
 
-db = client["cache"]
 
-def get_cache(search_dict, source_dbs=None, field="pdb_file"):
+async def get_cache(search_dict, source_dbs=None, field="pdb_file"):
     """Return field if in cache, otherwise returns None.
+       search_dict holds a "uniprot_id", or an "_id" for a db id.
        source_dbs is list of pdb dbs to search (use all by default).
        If there are multiple matching entries, return the heighest scoring.
+       field can be "metadata" to return a dict of the METADATA_FIELDS,
+       or "raw" to return a (metadata, file bytes) tuple without decoding the file,
+       or "raw_gzip" for the file gzip compressed, as stored, without decompressing it.
+       Only the fields needed are read from the storage engine.
+       Each hit is counted towards the entry's access stats used for eviction.
     """
-    if isinstance(source_dbs, list):
-        source_dbs = [x.upper() for x in source_dbs]
-        search_dict["source_db"] = {"$in":source_dbs};
-    e = db.cache.find(search_dict)
-    if e is None:
-        return None
-    e = e.sort({"score": -1}).limit(1)
+    key = _hot_key(search_dict, source_dbs, field)
+    cached = hot_cache.get(key)
+    if cached is not None:
+        access_tracker.record(cached[0])
+        return cached[1]
+    tags = _hot_tags(search_dict)
+    # taken before the read, so a result an entry write makes stale meanwhile isn't cached
+    generation = hot_cache.generation(tags)
     try:
-        return e.next().get(field)
+        found = await engine.find_best(search_dict, source_dbs, field)
     except Exception:
         return None
+    if found is None or found[1] is None:
+        return None
+    access_tracker.record(found[0])
+    # hot cache values keep the entry id, so hits can be counted
+    hot_cache.put(key, found, tags, generation)
+    return found[1]
+
+
+async def get_cache_batch(uniprot_ids, source_dbs=None, chunk_size=500):
+    """Yield (uniprot_id, pdb_file, tombstone) for each of the uniprot ids, in the order given,
+       where pdb_file is the heighest scoring file for that id or None,
+       and tombstone the reason of its tombstone (see get_tombstones) if it has no file, or None.
+       The ids are looked up chunk_size at a time, so only one chunk of files
+       is held in memory.
+    """
+    uniprot_ids = [x.upper() for x in uniprot_ids]
+    for start in range(0, len(uniprot_ids), chunk_size):
+        chunk = uniprot_ids[start:start + chunk_size]
+        # share hot cache entries with get_cache lookups by uniprot id
+        keys = {id: _hot_key({"uniprot_id": id}, source_dbs, "pdb_file") for id in chunk}
+        hot = {id: hot_cache.get(key) for id, key in keys.items()}
+        cold = [id for id, cached in hot.items() if cached is None]
+        if len(cold) > 0:
+            tags = {id: _hot_tags({"uniprot_id": id}) for id in cold}
+            generations = {id: hot_cache.generation(tags[id]) for id in cold}
+            for id, found in (await engine.find_best_batch(cold, source_dbs)).items():
+                hot_cache.put(keys[id], found, tags[id], generations[id])
+                hot[id] = found
+        misses = [id for id in chunk if hot.get(id) is None]
+        tombstones = await get_tombstones(misses, source_dbs) if len(misses) > 0 else {}
+        for uniprot_id in chunk:
+            found = hot.get(uniprot_id)
+            if found is not None:
+                access_tracker.record(found[0])
+            yield uniprot_id, None if found is None else found[1], tombstones.get(uniprot_id)
+
+
+async def get_cache_by_sequence(sequence, source_dbs=None, field="pdb_file"):
+    """Return field of the highest scoring entry whose sequence contains
+       the given sequence, otherwise returns None.
+       Raises ValueError if sequence is shorter than KMER_LENGTH, as nearly every entry would match it.
+    """
+    sequence = sequence.upper()
+    if len(sequence) < KMER_LENGTH:
+        raise ValueError(f"The sequence must be at least {KMER_LENGTH} residues long")
+    key = ("sequence", sequence, _sources_key(source_dbs), field)
+    cached = hot_cache.get(key)
+    if cached is not None:
+        access_tracker.record(cached[0])
+        return cached[1]
+    generation = hot_cache.generation(("sequence",))
+    found = await engine.find_by_sequence(sequence, source_dbs, field)
+    if found is None or found[1] is None:
+        return None
+    access_tracker.record(found[0])
+    # any new entry could be a better match, so this depends on every entry
+    hot_cache.put(key, found, ("sequence",), generation)
+    return found[1]
 
 
-def store_cache(uniprot_id, pdb_file, sequence, source_db, score):
+async def store_cache(uniprot_id, pdb_file, sequence, source_db, score):
     """stores the given id and file in the cache.
+    The file itself is kept once per distinct file under its hash,
+    the cache entry only holds the hash.
 
     If uniprot id is blank, the file will always be added.
     If the uniprot id is already present, then:
      - if the source_db is new the file is added
      - if there is already an entry from that source_db
        it will be replaced if the pdb_file is different
+    The check and the write are atomic.
+    Returns the id of the entry written, or "" if the file was already stored.
     """
-    pdb_hash = blake2b(pdb_file.encode()).hexdigest()
-    uniprot_id = uniprot_id.upper()
-    source_db = source_db.upper()
-    obj_info = {"uniprot_id": uniprot_id,
-                "source_db": source_db,
-                "score": score,
-                "sequence": sequence.upper(),
-                "pdb_file": pdb_file,
-                "hash": pdb_hash,}
-    e = None
-    if uniprot_id != "":
-        e = db.cache.find_one(
-            {"uniprot_id": uniprot_id, "source_db": source_db})
-        if e is not None and e.get("hash") != pdb_hash:
-            print("Updated existing entry")
-            result = db.cache.replace_one(e, obj_info)
-            return str(e.get("_id"))
-    if e is None:
-        print("Inserted into cache")
-        result = db.cache.insert_one(obj_info)
-        return str(result.inserted_id)
-    print("Already in cache")
-    return ""
-
-
-def clear_cache():
-    client.drop_database("cache")
+    info = _entry_info(uniprot_id, pdb_file, sequence, source_db, score)
+    entry_id = await engine.store(info, pdb_file)
+    if entry_id != "":
+        _invalidate_hot(info["uniprot_id"], entry_id)
+        if info["uniprot_id"] != "":
+            await engine.remove_tombstones([info["uniprot_id"]])
+    return entry_id
+
+
+async def is_current(uniprot_id, source_db, pdb_hash):
+    """Return True if the entry for uniprot_id from source_db already holds
+    the file with the given hash, so storing that file would change nothing."""
+    return await engine.is_current(uniprot_id.upper(), source_db.upper(), pdb_hash)
+
+
+async def is_current_bulk(files):
+    """Return is_current for each (uniprot_id, source_db, hash) tuple of files,
+    in the order given, reading the entries of all of them in one query."""
+    keys = [(uniprot_id.upper(), source_db.upper(), pdb_hash) for uniprot_id, source_db, pdb_hash in files]
+    ids = {uniprot_id for uniprot_id, _, _ in keys if uniprot_id != ""}
+    hashes = await engine.find_hashes(ids) if len(ids) > 0 else {}
+    return [uniprot_id != "" and hashes.get((uniprot_id, source_db)) == pdb_hash
+            for uniprot_id, source_db, pdb_hash in keys]
+
+
+async def store_cache_bulk(protein_files):
+    """Store a list of (uniprot_id, pdb_file, sequence, source_db, score) tuples
+    in the cache, following the same rules as store_cache,
+    with fewer round trips than storing them one at a time.
+
+    Returns a list with a dict for each file giving its cache "id" and its "status",
+    one of "inserted", "updated", "unchanged" or "error".
+    """
+    infos = [_entry_info(*f) for f in protein_files]
+    results = await engine.store_bulk(infos, [f[1] for f in protein_files])
+    stored_ids = set()
+    for info, r in zip(infos, results):
+        if r["status"] in ("inserted", "updated"):
+            _invalidate_hot(info["uniprot_id"], r["id"])
+            if info["uniprot_id"] != "":
+                stored_ids.add(info["uniprot_id"])
+    if len(stored_ids) > 0:
+        await engine.remove_tombstones(stored_ids)
+    return results
+
+
+async def clear_cache():
+    await engine.clear()
+    hot_cache.clear()
+    access_tracker.clear()
+
+
+async def explain_queries(uniprot_id="", sequence="", db_id=None):
+    """Return the query plan used by each retrieve query, and the usage
+    stats of every index the storage engine has.
+    """
+    return await engine.explain_queries(uniprot_id.upper(), sequence.upper(), db_id)
+
+
+async def get_uniprot_metadata(accession, max_age=None):
+    """Return the uniprot metadata stored for accession and when it was stored,
+    as a (metadata, unix timestamp) tuple, or None if there is none,
+    or it was stored more than max_age seconds ago."""
+    found = await engine.get_uniprot_metadata(accession.upper())
+    if found is None:
+        return None
+    metadata_json, stored_at = found
+    if max_age is not None and stored_at < time.time() - max_age:
+        return None
+    return json.loads(metadata_json), stored_at
+
+
+async def store_uniprot_metadata(accession, metadata):
+    """Store the uniprot metadata of an accession, the dbReference entries and
+    protein metadata pss parsed from its uniprot xml, replacing any stored before."""
+    await engine.store_uniprot_metadata(accession.upper(), json.dumps(metadata), time.time())
+
+
+async def expire_uniprot_metadata(retention_days=None):
+    "Remove the uniprot metadata older than retention_days, returning the number removed"
+    retention_days = UNIPROT_METADATA_RETENTION_DAYS if retention_days is None else retention_days
+    return await engine.expire_uniprot_metadata(time.time() - retention_days * 24 * 3600)
+
+
+async def get_tombstones(uniprot_ids, source_dbs=None):
+    """Return a dict of uniprot id to the reason of its tombstone, for each of the
+    uniprot ids pss found no file for when searching source_dbs (or all source dbs,
+    which covers every subset of them) that hasn't expired."""
+    scopes = {_scope(source_dbs), _scope(None)}
+    return await engine.find_tombstones([x.upper() for x in uniprot_ids], list(scopes), time.time())
+
+
+async def store_tombstone(uniprot_id, source_dbs, reason, ttl):
+    """Remember for ttl seconds that pss found no file for the uniprot id in source_dbs,
+    for reason, e.g. that uniprot has no such id or no structure for it.
+    Removed early when a file is stored for the uniprot id."""
+    await engine.store_tombstone(uniprot_id.upper(), _scope(source_dbs), reason, time.time() + ttl)
+
+
+async def expire_tombstones():
+    "Remove the expired tombstones, returning the number removed"
+    return await engine.expire_tombstones(time.time())
+
+
+async def flush_access_stats():
+    """Add the accesses recorded in memory since the last flush
+    to the access_count and last_access of the entries."""
+    pending = access_tracker.drain()
+    if len(pending) > 0:
+        await engine.add_accesses(pending)
+
+
+async def expire_entries(ttls=None):
+    """Remove the entries older than the ttl of their source db,
+    so they are fetched again from the source next time.
+    Returns the number of entries removed."""
+    ttls = CACHE_TTL_DAYS if ttls is None else ttls
+    removed = 0
+    for source_db, ttl in ttls.items():
+        expired = await engine.expired_entries(source_db, time.time() - ttl)
+        removed += len(await _remove_entries(expired))
+    eviction_stats.add(expired=removed)
+    return removed
+
+
+async def evict_to_budget(max_bytes=None, batch_size=100):
+    """Remove the least frequently accessed entries, oldest access first,
+    until the storage engine fits in max_bytes.
+    Storing an entry counts as its first access, so a file just fetched
+    for a client outlives entries last accessed before it was stored.
+    Returns the number of entries removed."""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    removed = 0
+    if max_bytes <= 0:
+        return removed
+    while (await engine.size())["total_bytes"] > max_bytes:
+        victims = await engine.eviction_candidates(batch_size)
+        if len(victims) == 0:
+            break
+        removed += len(await _remove_entries(victims))
+    eviction_stats.add(evicted=removed)
+    return removed
+
+
+async def run_evictor(interval=None):
+    """Flush the access stats, expire entries, uniprot metadata and tombstones, and evict entries every interval seconds,
+    until cancelled. Runs as a background task of the service."""
+    interval = EVICTION_INTERVAL_SECONDS if interval is None else interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_access_stats()
+            await expire_entries()
+            await expire_uniprot_metadata()
+            await expire_tombstones()
+            await evict_to_budget()
+            eviction_stats.ran()
+        except Exception as e:
+            print(f"Eviction failed: {e}")
+
+
+async def cache_size():
+    "Return the bytes used by the storage engine, the total under total_bytes"
+    return await engine.size()
+
+
+async def eviction_report(top=10):
+    """Return the cache size against its budget, the eviction counts and rate,
+    and the top most accessed entries."""
+    await flush_access_stats()
+    return {**await cache_size(),
+            "max_bytes": CACHE_MAX_BYTES,
+            "entries": await engine.count(),
+            "ttl_days": {s: ttl / (24 * 3600) for s, ttl in CACHE_TTL_DAYS.items()},
+            **eviction_stats.stats(),
+            "hottest": await engine.hottest(top)}
+
+
+# --------------------------------------------------------
+# --------------- PRIVATE HELPER FUNCTIONS ---------------
+# --------------------------------------------------------
+
+def _sources_key(source_dbs):
+    "Normalise a source_dbs filter for use in a hot cache key"
+    if not isinstance(source_dbs, list):
+        return None
+    return tuple(sorted({x.upper() for x in source_dbs}))
+
+
+def _scope(source_dbs):
+    "Return the scope of a tombstone for a source_dbs filter, \"\" for all source dbs"
+    key = _sources_key(source_dbs)
+    return "" if key is None or len(key) == 0 else ",".join(key)
+
+
+def _hot_key(search_dict, source_dbs, field):
+    "Return the hot cache key for a get_cache query"
+    return ("query",
+            tuple(sorted((k, str(v)) for k, v in search_dict.items())),
+            _sources_key(source_dbs),
+            field)
+
+
+def _hot_tags(search_dict):
+    "Return the tags to invalidate a get_cache query result by"
+    tags = []
+    if "uniprot_id" in search_dict:
+        tags.append(("uniprot_id", search_dict["uniprot_id"]))
+    if "_id" in search_dict:
+        tags.append(("db_id", str(search_dict["_id"])))
+    return tuple(tags)
+
+
+def _invalidate_hot(uniprot_id, entry_id):
+    "Remove hot cache results that may change when an entry is written"
+    hot_cache.invalidate(("uniprot_id", uniprot_id))
+    hot_cache.invalidate(("db_id", str(entry_id)))
+    hot_cache.invalidate("sequence")
+
+
+async def _remove_entries(entry_ids):
+    "Remove entries from the storage engine and the hot cache"
+    removed = await engine.remove_entries(entry_ids)
+    for entry_id, uniprot_id in removed:
+        _invalidate_hot(uniprot_id, entry_id)
+    return removed
+
+
+def _entry_info(uniprot_id, pdb_file, sequence, source_db, score):
+    "Return the cache entry for a pdb file"
+    return {"uniprot_id": uniprot_id.upper(),
+            "source_db": source_db.upper(),
+            "score": score,
+            "sequence": sequence.upper(),
+            "kmers": sequence_kmers(sequence.upper()),
+            "hash": blake2b(pdb_file.encode()).hexdigest(),
+            "sequence_length": len(sequence),
+            "size": len(pdb_file.encode()),
+            "stored_at": datetime.now(timezone.utc),}
@@ -0,0 +1,88 @@
+from collections import deque
+import threading
+import time
+
+# Window the eviction rate is reported over
+RATE_WINDOW_SECONDS = 3600
+
+
+class AccessTracker:
+    """Counts the accesses to each cache entry in memory, so that reads
+    do not each write to the database. The evictor drains the counts
+    periodically and adds them to the entries in one bulk write.
+    """
+
+    def __init__(self):
+        self.pending = {}  # entry id -> [access count, time of last access]
+        self.lock = threading.Lock()
+
+    def record(self, entry_id, now=None):
+        "Count one access to the entry"
+        now = time.time() if now is None else now
+        with self.lock:
+            counts = self.pending.setdefault(entry_id, [0, now])
+            counts[0] += 1
+            counts[1] = now
+
+    def drain(self):
+        "Return the counts recorded since the last drain, and forget them"
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def clear(self):
+        with self.lock:
+            self.pending = {}
+
+
+class EvictionStats:
+    "Counts the entries removed by the evictor, by reason"
+
+    def __init__(self):
+        self.evicted = 0  # removed to keep the cache within its byte budget
+        self.expired = 0  # removed as older than the ttl of their source db
+        self.events = deque()  # (time, number removed) within RATE_WINDOW_SECONDS
+        self.last_run = None
+        self.lock = threading.Lock()
+
+    def add(self, evicted=0, expired=0, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.evicted += evicted
+            self.expired += expired
+            if evicted + expired > 0:
+                self.events.append((now, evicted + expired))
+            self._trim(now)
+
+    def ran(self, now=None):
+        self.last_run = time.time() if now is None else now
+
+    def rate(self, now=None):
+        "Return the number of entries removed per minute over the rate window"
+        now = time.time() if now is None else now
+        with self.lock:
+            self._trim(now)
+            return sum(n for _, n in self.events) * 60 / RATE_WINDOW_SECONDS
+
+    def stats(self, now=None):
+        return {"evicted": self.evicted,
+                "expired": self.expired,
+                "removed_per_minute": self.rate(now),
+                "last_run": self.last_run}
+
+    def _trim(self, now):
+        "Forget events older than the rate window, the lock must be held"
+        while len(self.events) > 0 and self.events[0][0] < now - RATE_WINDOW_SECONDS:
+            self.events.popleft()
+
+
+def parse_ttls(value):
+    """Parse per source db ttls given as "SOURCE=DAYS,..." (e.g. "ALPHAFOLDDB=30")
+    into a dict of upper case source db to ttl in seconds."""
+    ttls = {}
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+        source_db, days = item.split("=")
+        ttls[source_db.strip().upper()] = float(days) * 24 * 3600
+    return ttls
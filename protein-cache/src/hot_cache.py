@@ -0,0 +1,128 @@
+from collections import OrderedDict
+import sys
+import threading
+
+# Rough per entry overhead (key, bookkeeping) counted towards the byte budget
+ENTRY_OVERHEAD_BYTES = 200
+# Invalidation counters tags are hashed into, so their memory is bounded however many
+# tags are invalidated. Tags sharing a counter only make a put skipped needlessly.
+GENERATION_SLOTS = 4096
+
+
+class HotCache:
+    """In-memory LRU cache of query results, bounded by the total size of
+    the cached values in bytes rather than by the number of entries.
+
+    Each entry is stored with a set of tags, so that every entry
+    depending on something (such as a uniprot id) can be invalidated at once.
+    Each invalidation of a tag also bumps the tag's generation, so a value read
+    while one of its tags was invalidated is not cached (see generation).
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size, tags), least recent first
+        self.tagged = {}  # tag -> set of keys
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generations = [0] * GENERATION_SLOTS
+        self.cleared = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        "Return the value cached for key, or default if it is not cached"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self, tags):
+        """Return the generation of the tags, to take before reading a value
+        from storage and pass to put with it"""
+        with self.lock:
+            return self._generation(tags)
+
+    def put(self, key, value, tags=(), generation=None):
+        """Cache value under key, evicting the least recently used entries to make room.
+        If generation, from generation(tags) before value was read, is given,
+        value is not cached if one of its tags was invalidated since, as it may be stale."""
+        size = _value_size(value) + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != self._generation(tags):
+                return
+            self._remove(key)
+            while self.size + size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (value, size, tags)
+            self.size += size
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+
+    def invalidate(self, tag):
+        "Remove every entry stored with the tag"
+        with self.lock:
+            self.generations[_slot(tag)] += 1
+            for key in list(self.tagged.get(tag, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.cleared += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.tagged.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries),
+                    "size_bytes": self.size,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups > 0 else 0,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations}
+
+    def _generation(self, tags):
+        "The generation of the tags, the lock must be held"
+        return self.cleared, tuple(self.generations[_slot(tag)] for tag in tags)
+
+    def _remove(self, key):
+        "Remove key if present, the lock must be held"
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, tags = entry
+        self.size -= size
+        for tag in tags:
+            keys = self.tagged.get(tag)
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.tagged[tag]
+
+
+def _slot(tag):
+    return hash(tag) % GENERATION_SLOTS
+
+
+def _value_size(value):
+    "Approximate size of a cached value in bytes"
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(_value_size(v) for v in value)
+    return sys.getsizeof(value)
@@ -0,0 +1,29 @@
+# Length of the k-mers stored for each cached sequence.
+# Longer k-mers are more selective, but sequences shorter than
+# KMER_LENGTH can't be searched for.
+KMER_LENGTH = 5
+
+
+def sequence_kmers(sequence, k=KMER_LENGTH):
+    """Return the sorted distinct k-mers starting at every position of sequence.
+    The last k-1 positions give k-mers shorter than k (the tail of the sequence).
+    """
+    return sorted({sequence[i:i + k] for i in range(len(sequence))})
+
+
+def query_kmers(sequence, k=KMER_LENGTH):
+    """Return a set of k-mers that every sequence containing sequence must have.
+    Tiles the query with non-overlapping k-mers plus the k-mer ending the query,
+    sequence must be at least k long.
+    """
+    kmers = {sequence[i:i + k] for i in range(0, len(sequence) - k + 1, k)}
+    kmers.add(sequence[-k:])
+    return sorted(kmers)
+
+
+def kmer_search(sequence, k=KMER_LENGTH):
+    """Return a mongo filter on the kmers field matching entries that may
+    contain sequence, which must be at least k long.
+    Candidates still need to be checked with an exact match.
+    """
+    return {"kmers": {"$all": query_kmers(sequence, k)}}
@@ -1,14 +1,38 @@
-from fastapi import FastAPI, Query
-from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse, Response
+from contextlib import asynccontextmanager, suppress
+import asyncio
+import json
 import uvicorn
-from pydantic import BaseModel
-from db import store_cache, get_cache, clear_cache
+from pydantic import BaseModel, ValidationError
+import db
+from metrics import MetricsMiddleware, metrics_response, register_hot_cache
+from compression import DecompressRequestMiddleware, accepts_gzip
+from db import store_cache, store_cache_bulk, is_current, is_current_bulk, get_cache, get_cache_batch, get_cache_by_sequence, clear_cache, explain_queries, eviction_report, hot_cache, get_uniprot_metadata, store_uniprot_metadata, get_tombstones, store_tombstone
 from typing import Annotated
-from bson import ObjectId
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    await db.connect()
+    evictor = asyncio.create_task(db.run_evictor())
+    yield
+    evictor.cancel()
+    with suppress(asyncio.CancelledError):
+        await evictor
+    # keep the accesses counted since the last run
+    await db.flush_access_stats()
+    await db.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(DecompressRequestMiddleware)
+app.add_middleware(MetricsMiddleware)
+register_hot_cache(hot_cache)
 HOST = "0.0.0.0"
 PORT = 6000
+# Number of protein files from an ndjson stream to store per bulk write
+BULK_BATCH_SIZE = 1000
 
 
 def json_response(data, field="pdb_file"):
@@ -17,28 +41,135 @@ def json_response(data, field="pdb_file"):
     return {"present": True, field: data}
 
 
+def raw_response(data, tombstone=None, encoding=None):
+    """Return a cached file as plain bytes, with its metadata in X-Cache-* headers,
+    or an empty 404 response if it was not found, giving the reason of its
+    tombstone in an X-Cache-Tombstone header if it has one.
+    encoding is the Content-Encoding the bytes are already in, such as "gzip"."""
+    if data is None:
+        headers = {} if tombstone is None else {"X-Cache-Tombstone": tombstone}
+        return Response(status_code=404, headers=headers)
+    metadata, pdb_file = data
+    headers = {"X-Cache-" + k.replace("_", "-").title(): str(v) for k, v in metadata.items()}
+    headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(pdb_file, media_type="text/plain; charset=utf-8", headers=headers)
+
+
+def raw_field(accept_encoding):
+    """Return the get_cache field of a raw lookup: the file as stored,
+    gzip compressed, if the client accepts gzip, otherwise decompressed"""
+    return "raw_gzip" if accepts_gzip(accept_encoding) else "raw"
+
+
+def raw_encoding(field):
+    return "gzip" if field == "raw_gzip" else None
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics: request latency per route, mongo command latency
+    and the hot cache counters."""
+    return metrics_response()
+
+
 @app.get("/retrieve_by_uniprot_id/{id}")
-def retrieve_by_uniprot_id(id: str, source_dbs: Annotated[list[str] | None, Query()] = None):
+async def retrieve_by_uniprot_id(id: str, source_dbs: Annotated[list[str] | None, Query()] = None):
+    return json_response(
+        await get_cache({"uniprot_id": id.upper()}, source_dbs))
+
+
+@app.get("/retrieve_metadata_by_uniprot_id/{id}")
+async def retrieve_metadata_by_uniprot_id(id: str, source_dbs: Annotated[list[str] | None, Query()] = None):
     return json_response(
-        get_cache({"uniprot_id": id.upper()}, source_dbs))
+        await get_cache({"uniprot_id": id.upper()}, source_dbs, field="metadata"), field="metadata")
+
+
+class UniprotIdBatch(BaseModel):
+    "Structure of json object to POST to batch retrieve functions"
+    ids: list[str]
+    source_dbs: list[str] | None = None
+
+
+@app.post("/retrieve_by_uniprot_ids/")
+async def retrieve_by_uniprot_ids(batch: UniprotIdBatch):
+    """Streams the highest scoring file for each uniprot id as newline delimited json,
+    one {"uniprot_id", "present", "pdb_file", "tombstone"} object per id, in the order given.
+    tombstone is the reason of the tombstone of an id that is not present, or null."""
+    return StreamingResponse(
+        (json.dumps({"uniprot_id": id, **json_response(data), "tombstone": tombstone}) + "\n"
+         async for id, data, tombstone in get_cache_batch(batch.ids, batch.source_dbs)),
+        media_type="application/x-ndjson")
+
+
+async def cache_by_sequence(sequence, source_dbs, field="pdb_file"):
+    "get_cache_by_sequence, returning 400 for a sequence too short to search for"
+    try:
+        return await get_cache_by_sequence(sequence, source_dbs, field=field)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
 
 
 @app.get("/retrieve_by_sequence/{sequence}")
-def retrieve_by_sequence(sequence: str, source_dbs: Annotated[list[str] | None, Query()] = None):
+async def retrieve_by_sequence(sequence: str, source_dbs: Annotated[list[str] | None, Query()] = None):
+    return json_response(
+        await cache_by_sequence(sequence, source_dbs))
+
+
+@app.get("/retrieve_metadata_by_sequence/{sequence}")
+async def retrieve_metadata_by_sequence(sequence: str, source_dbs: Annotated[list[str] | None, Query()] = None):
     return json_response(
-        get_cache({"sequence": {"$regex": sequence.upper()}}, source_dbs))
+        await cache_by_sequence(sequence, source_dbs, field="metadata"), field="metadata")
 
 
 @app.get("/retrieve_by_db_id/{db_id}")
-def retrieve_by_db_id(db_id: str):
+async def retrieve_by_db_id(db_id: str):
+    return json_response(
+        await get_cache({"_id": db_id}))
+
+
+@app.get("/retrieve_metadata_by_db_id/{db_id}")
+async def retrieve_metadata_by_db_id(db_id: str):
     return json_response(
-        get_cache({"_id": ObjectId(db_id)}))
+        await get_cache({"_id": db_id}, field="metadata"), field="metadata")
 
 
 @app.get("/retrieve_db_id_by_uniprot_id/{id}")
-def retrieve_db_id_by_uniprot_id(id: str, source_dbs: Annotated[list[str] | None, Query()] = None):
+async def retrieve_db_id_by_uniprot_id(id: str, source_dbs: Annotated[list[str] | None, Query()] = None):
     return json_response(
-        str(get_cache({"uniprot_id": id.upper()}, field="_id", source_dbs=source_dbs)), field="db_id")
+        str(await get_cache({"uniprot_id": id.upper()}, field="_id", source_dbs=source_dbs)), field="db_id")
+
+
+@app.get("/raw/retrieve_by_uniprot_id/{id}")
+async def retrieve_raw_by_uniprot_id(id: str, source_dbs: Annotated[list[str] | None, Query()] = None,
+                                     accept_encoding: Annotated[str | None, Header()] = None):
+    """Like retrieve_by_uniprot_id, but returns the file itself rather than
+    wrapping it in json, with the entry metadata in X-Cache-* headers.
+    If the client accepts gzip the file is sent compressed as it is stored,
+    without decompressing it.
+    Returns 404 if the file is not in the cache, with an X-Cache-Tombstone header
+    if pss found there is no file for the id (see PUT /tombstones/)."""
+    field = raw_field(accept_encoding)
+    data = await get_cache({"uniprot_id": id.upper()}, source_dbs, field=field)
+    if data is None:
+        return raw_response(None, (await get_tombstones([id], source_dbs)).get(id.upper()))
+    return raw_response(data, encoding=raw_encoding(field))
+
+
+@app.get("/raw/retrieve_by_sequence/{sequence}")
+async def retrieve_raw_by_sequence(sequence: str, source_dbs: Annotated[list[str] | None, Query()] = None,
+                                   accept_encoding: Annotated[str | None, Header()] = None):
+    field = raw_field(accept_encoding)
+    return raw_response(
+        await cache_by_sequence(sequence, source_dbs, field=field), encoding=raw_encoding(field))
+
+
+@app.get("/raw/retrieve_by_db_id/{db_id}")
+async def retrieve_raw_by_db_id(db_id: str, accept_encoding: Annotated[str | None, Header()] = None):
+    field = raw_field(accept_encoding)
+    return raw_response(
+        await get_cache({"_id": db_id}, field=field), encoding=raw_encoding(field))
 
 
 class ProteinFile(BaseModel):
@@ -51,18 +182,159 @@ class ProteinFile(BaseModel):
 
 
 @app.post("/protein_file/", response_class=PlainTextResponse)
-def store_protein_in_cache(protein_file: ProteinFile):
+async def store_protein_in_cache(protein_file: ProteinFile):
     print(f"storing protein file: id:{protein_file.uniprot_id}")
-    return store_cache(protein_file.uniprot_id,
+    return await store_cache(protein_file.uniprot_id,
                 protein_file.pdb_file,
                 protein_file.sequence,
                 protein_file.source_db,
                 protein_file.score)
 
+
+@app.get("/is_current/{id}")
+async def is_current_in_cache(id: str, source_db: str, hash: str):
+    """Returns whether the entry for the uniprot id from source_db already holds the file
+    with the given blake2b hash, so the file can be stored only if it is not current."""
+    return {"current": await is_current(id, source_db, hash)}
+
+
+class FileHash(BaseModel):
+    "Structure of json object to POST to is_current_bulk"
+    uniprot_id: str
+    source_db: str
+    hash: str
+
+
+@app.post("/is_current/")
+async def is_current_bulk_in_cache(files: list[FileHash]):
+    """Like is_current for a list of files, returns {"current": [...]} with
+    whether the cache already holds each one, in the order given, so only
+    the files that aren't current need to be sent to /protein_files/."""
+    return {"current": await is_current_bulk([(f.uniprot_id, f.source_db, f.hash) for f in files])}
+
+
+@app.post("/protein_files/")
+async def store_proteins_in_cache(protein_files: list[ProteinFile]):
+    """Stores a list of protein files using bulk writes.
+    Returns the cache id and status of each file, in the order given."""
+    print(f"storing {len(protein_files)} protein files")
+    return await store_cache_bulk([_protein_file_tuple(p) for p in protein_files])
+
+
+@app.post("/protein_files/ndjson", response_class=PlainTextResponse)
+async def store_protein_stream_in_cache(request: Request):
+    """Stores a newline delimited json stream of protein files,
+    in bulk writes of BULK_BATCH_SIZE files as the stream arrives.
+    Returns the cache id and status of each file as ndjson, in the order given."""
+    results = []
+    batch = []
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= BULK_BATCH_SIZE:
+                results += await _store_ndjson_batch(batch)
+                batch = []
+    batch.append(buffer)
+    results += await _store_ndjson_batch(batch)
+    print(f"stored ndjson stream of {len(results)} protein files")
+    return "".join(json.dumps(r) + "\n" for r in results)
+
+
+@app.get("/uniprot_metadata/{accession}")
+async def retrieve_uniprot_metadata(accession: str, max_age: float | None = None):
+    """Returns the uniprot metadata pss stored for the accession, with the unix time
+    it was stored at, if it was stored less than max_age seconds ago."""
+    found = await get_uniprot_metadata(accession, max_age)
+    if found is None:
+        return {"present": False, "metadata": None, "stored_at": None}
+    return {"present": True, "metadata": found[0], "stored_at": found[1]}
+
+
+class UniprotMetadata(BaseModel):
+    "Structure of json object to PUT to store uniprot metadata"
+    metadata: dict
+
+
+@app.put("/uniprot_metadata/{accession}")
+async def store_uniprot_metadata_in_cache(accession: str, uniprot_metadata: UniprotMetadata):
+    """Stores the uniprot metadata parsed by pss for an accession, the dbReference
+    entries and protein metadata of its uniprot xml, so pss doesn't need to fetch and parse it again."""
+    await store_uniprot_metadata(accession, uniprot_metadata.metadata)
+    return {"stored": True}
+
+
+class Tombstone(BaseModel):
+    "Structure of json object to PUT to store a tombstone"
+    source_dbs: list[str] | None = None
+    reason: str
+    ttl: float
+
+
+@app.put("/tombstones/{id}")
+async def store_tombstone_in_cache(id: str, tombstone: Tombstone):
+    """Stores a tombstone, recording that pss found no file for the uniprot id
+    in source_dbs (all of them if not given), so lookups of the id answer that
+    for ttl seconds, or until a file is stored for the id."""
+    await store_tombstone(id, tombstone.source_dbs, tombstone.reason, tombstone.ttl)
+    return {"stored": True}
+
+
 @app.get("/clear_cache/")
-def clear_cache_database():
-    clear_cache()
+async def clear_cache_database():
+    await clear_cache()
     return
 
+
+@app.get("/admin/query_plans/")
+async def query_plans(uniprot_id: str = "", sequence: str = "", db_id: str | None = None):
+    """Returns the query plan of each retrieve query and index usage stats,
+    to check that the retrieve routes are served from indexes.
+    Returns 400 if db_id is not a valid id."""
+    try:
+        return await explain_queries(uniprot_id, sequence, db_id)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+@app.get("/admin/hot_cache_stats/")
+async def hot_cache_stats():
+    """Returns the size, hit, miss and eviction counts of the in-memory hot cache."""
+    return hot_cache.stats()
+
+
+@app.get("/admin/eviction_stats/")
+async def eviction_stats(top: int = 10):
+    """Returns the size of the cache against its byte budget, the number of entries
+    evicted and expired, the eviction rate, and the top most accessed entries."""
+    return await eviction_report(top)
+
+
+def _protein_file_tuple(protein_file):
+    return (protein_file.uniprot_id,
+            protein_file.pdb_file,
+            protein_file.sequence,
+            protein_file.source_db,
+            protein_file.score)
+
+
+async def _store_ndjson_batch(lines):
+    "Parse and bulk store a list of ndjson lines, blank lines are skipped"
+    results = []
+    files = []
+    for line in lines:
+        if line.strip() == b"":
+            continue
+        try:
+            files.append(_protein_file_tuple(ProteinFile.model_validate_json(line)))
+            results.append(None)
+        except ValidationError as e:
+            results.append({"id": "", "status": "error", "detail": str(e)})
+    stored = iter(await store_cache_bulk(files) if len(files) > 0 else [])
+    return [r if r is not None else next(stored) for r in results]
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host=HOST, port=PORT)
@@ -0,0 +1,90 @@
+from prometheus_client import Histogram, Counter, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from fastapi.responses import Response
+from pymongo import monitoring
+import time
+
+# Hits in the hot cache are served in well under the default first bucket of 5ms
+REQUEST_LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, until the last byte of the response is sent",
+    ["method", "route", "status"],
+    buckets=REQUEST_LATENCY_BUCKETS)
+MONGO_COMMAND_LATENCY = Histogram(
+    "pc_mongo_command_duration_seconds",
+    "Time taken by mongo commands, as measured by the driver",
+    ["command"])
+MONGO_COMMAND_FAILURES = Counter(
+    "pc_mongo_command_failures_total",
+    "Mongo commands that failed",
+    ["command"])
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing the cache's requests by route template, so lookups of
+    different ids, sequences or db ids share a series. The raw and ndjson responses are
+    streamed from the database, and are timed until their last file is sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(scope["method"],
+                                   route.path if route is not None else "unmatched",
+                                   status).observe(time.perf_counter() - start)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    "Records the duration of every command the mongo client sends"
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_COMMAND_LATENCY.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name).inc()
+
+
+class HotCacheCollector:
+    "Exposes the counters the hot cache keeps itself, read when metrics are scraped"
+
+    def __init__(self, hot_cache):
+        self.hot_cache = hot_cache
+
+    def collect(self):
+        stats = self.hot_cache.stats()
+        for name in ["hits", "misses", "evictions", "invalidations"]:
+            yield CounterMetricFamily(f"pc_hot_cache_{name}", f"Hot cache {name}", value=stats[name])
+        yield GaugeMetricFamily("pc_hot_cache_size_bytes", "Size of the values in the hot cache",
+                                value=stats["size_bytes"])
+        yield GaugeMetricFamily("pc_hot_cache_entries", "Number of entries in the hot cache",
+                                value=stats["entries"])
+
+
+def register_hot_cache(hot_cache):
+    REGISTRY.register(HotCacheCollector(hot_cache))
+
+
+def metrics_response():
+    "Return the current value of every metric in the prometheus text format"
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,14 @@
+from .base import StorageEngine
+
+
+def create_engine(name, event_listeners=()):
+    """Return the storage engine called name, "mongo" or "sqlite".
+    Engines are imported when chosen, so one engine's dependencies
+    are not needed to run another."""
+    if name == "mongo":
+        from .mongo import MongoEngine
+        return MongoEngine(event_listeners=event_listeners)
+    if name == "sqlite":
+        from .sqlite import SQLiteEngine
+        return SQLiteEngine()
+    raise ValueError(f"Unknown storage engine {name}, expected mongo or sqlite")
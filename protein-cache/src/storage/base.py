@@ -0,0 +1,152 @@
+from abc import ABC, abstractmethod
+
+# Fields returned by metadata queries, everything describing an entry except its file
+METADATA_FIELDS = ["_id", "uniprot_id", "source_db", "score", "hash", "sequence_length", "size"]
+
+
+class StorageEngine(ABC):
+    """Where the cache entries and their files are kept.
+
+    An entry is the dict built by db._entry_info (uniprot_id, source_db, score,
+    sequence, kmers, hash, sequence_length, size, stored_at) plus an id assigned
+    by the engine. Files are stored once per distinct hash and reference counted.
+    Entries are looked up with a search dict holding either a "uniprot_id"
+    or an "_id" (the db id, as a string or the engine's own id type).
+
+    Engines also keep the uniprot metadata pss parses for each accession,
+    as json text with the unix timestamp it was stored at, and tombstones:
+    uniprot ids pss found no file for, by the reason and the scope (the source dbs
+    searched, as a string, see db._scope) they apply to, until a unix timestamp.
+
+    The in-memory hot cache, access tracking and eviction policy live in db.py,
+    in front of the engine, so each engine only has to store and query entries.
+    Lookups return an (entry id, value) tuple, or None if nothing matched,
+    where value depends on field:
+     - "pdb_file" the file as a string
+     - "metadata" a dict of the METADATA_FIELDS, with the id as a "db_id" string
+     - "raw" a (metadata, file as utf-8 bytes) tuple
+     - "raw_gzip" a (metadata, file as gzip compressed utf-8 bytes) tuple,
+       the stored blob itself so it can be sent on without decompressing it
+     - any other entry field, such as "_id", as stored
+    """
+
+    name = None
+
+    @abstractmethod
+    async def connect(self):
+        "Open the storage and prepare it for use"
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def find_best(self, search_dict, source_dbs=None, field="pdb_file"):
+        """Return (entry id, value of field) for the highest scoring entry matching
+        search_dict, from one of the source_dbs if a list is given, or None"""
+
+    @abstractmethod
+    async def find_best_batch(self, uniprot_ids, source_dbs=None):
+        """Return a dict of uniprot id to (entry id, pdb_file) for the highest scoring
+        entry of each of the uniprot ids that has one"""
+
+    @abstractmethod
+    async def find_by_sequence(self, sequence, source_dbs=None, field="pdb_file"):
+        """Return (entry id, value of field) for the highest scoring entry whose
+        sequence contains sequence, at least KMER_LENGTH long, or None"""
+
+    @abstractmethod
+    async def store(self, info, pdb_file):
+        """Store an entry following the rules of db.store_cache.
+        Returns the id of the entry written as a string, or "" if it was unchanged"""
+
+    @abstractmethod
+    async def store_bulk(self, infos, pdb_files):
+        """Store many entries following the rules of db.store_cache_bulk.
+        Returns a {"id", "status"} dict for each entry, in the order given"""
+
+    @abstractmethod
+    async def is_current(self, uniprot_id, source_db, pdb_hash):
+        "Return True if the entry for uniprot_id from source_db holds the file with pdb_hash"
+
+    @abstractmethod
+    async def find_hashes(self, uniprot_ids):
+        "Return a {(uniprot_id, source_db): hash} dict of the files of the entries of the uniprot ids"
+
+    @abstractmethod
+    async def clear(self):
+        "Remove every entry and file"
+
+    @abstractmethod
+    async def add_accesses(self, accesses):
+        """Add to the access stats of entries, accesses maps entry ids
+        to an (access count, time of last access as a unix timestamp) pair"""
+
+    @abstractmethod
+    async def expired_entries(self, source_db, stored_before):
+        "Return the ids of the entries from source_db stored before a unix timestamp"
+
+    @abstractmethod
+    async def eviction_candidates(self, n):
+        """Return the ids of the n entries to evict first, the least frequently
+        accessed, least recently accessed first among equal counts"""
+
+    @abstractmethod
+    async def remove_entries(self, entry_ids):
+        """Delete entries and release their files.
+        Returns a (entry id, uniprot_id) tuple for each entry deleted"""
+
+    @abstractmethod
+    async def size(self):
+        "Return a dict of the bytes used, with the total under total_bytes"
+
+    @abstractmethod
+    async def count(self):
+        "Return the number of entries"
+
+    @abstractmethod
+    async def hottest(self, n):
+        """Return the n most accessed entries as dicts of db_id, uniprot_id,
+        source_db, access_count and last_access"""
+
+    @abstractmethod
+    async def explain_queries(self, uniprot_id="", sequence="", db_id=None):
+        """Return the query plan of each retrieve query and index usage stats.
+        The sequence query is only explained for a sequence at least KMER_LENGTH long.
+        Raises ValueError if db_id is not a valid id for the engine."""
+
+    @abstractmethod
+    async def get_uniprot_metadata(self, accession):
+        "Return the (json text, stored at unix timestamp) of the uniprot metadata of accession, or None"
+
+    @abstractmethod
+    async def store_uniprot_metadata(self, accession, metadata_json, stored_at):
+        "Store the uniprot metadata of accession, replacing any stored before"
+
+    @abstractmethod
+    async def expire_uniprot_metadata(self, stored_before):
+        "Remove the uniprot metadata stored before a unix timestamp, returning the number removed"
+
+    @abstractmethod
+    async def find_tombstones(self, uniprot_ids, scopes, now):
+        """Return a dict of uniprot id to the reason of a tombstone for it in one of scopes,
+        for each of the uniprot ids that has one expiring after now"""
+
+    @abstractmethod
+    async def store_tombstone(self, uniprot_id, scope, reason, expires_at):
+        "Store a tombstone for the uniprot id in scope, replacing any stored before"
+
+    @abstractmethod
+    async def remove_tombstones(self, uniprot_ids):
+        "Remove the tombstones of the uniprot ids, in every scope"
+
+    @abstractmethod
+    async def expire_tombstones(self, now):
+        "Remove the tombstones expiring before now, returning the number removed"
+
+
+def entry_metadata(entry):
+    "Return the metadata of an entry, with its _id as a db_id string"
+    metadata = {f: entry.get(f) for f in METADATA_FIELDS if f != "_id"}
+    metadata["db_id"] = str(entry["_id"])
+    return metadata
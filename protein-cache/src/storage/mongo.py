@@ -0,0 +1,651 @@
+from pymongo import AsyncMongoClient, ASCENDING, DESCENDING, ReturnDocument, UpdateOne, InsertOne
+from pymongo.errors import OperationFailure, BulkWriteError, DuplicateKeyError
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from datetime import datetime, timezone
+from hashlib import blake2b
+import asyncio
+import gzip
+import os
+from kmers import KMER_LENGTH, sequence_kmers, kmer_search
+from .base import StorageEngine, METADATA_FIELDS, entry_metadata
+
+MONGO_HOST = os.environ.get("MONGO_HOST", "mongo:27017")
+# Code of the write errors of inserts rejected by a unique index
+DUPLICATE_KEY_ERROR = 11000
+# Connection pool of the async client, sized for many concurrent requests
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 200))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 10))
+# Candidates of a sequence search checked with an exact match, highest score first,
+# before giving up, so a search for a common sequence has bounded work
+SEQUENCE_CANDIDATES_LIMIT = int(os.environ.get("SEQUENCE_CANDIDATES_LIMIT", 1000))
+
+# Indexes backing the cache queries, as (name, keys, options).
+# uniprot lookups filter on uniprot_id and source_db then sort on score,
+# so the compound index answers them without an in-memory sort.
+# The unique index only covers entries with a uniprot id, as entries
+# uploaded without one are always added.
+CACHE_INDEXES = [
+    ("uniprot_source_score",
+     [("uniprot_id", ASCENDING), ("source_db", ASCENDING), ("score", DESCENDING)],
+     {}),
+    ("unique_uniprot_source",
+     [("uniprot_id", ASCENDING), ("source_db", ASCENDING)],
+     {"unique": True,
+      "partialFilterExpression": {"uniprot_id": {"$gt": ""}}}),
+    ("hash", [("hash", ASCENDING)], {}),
+    ("sequence", [("sequence", ASCENDING)], {}),
+    # multikey index, acting as a posting list from each k-mer to its entries in score order,
+    # so sequence searches stream candidates best first rather than sorting them all in memory
+    ("kmers_score", [("kmers", ASCENDING), ("score", DESCENDING)], {}),
+    # eviction order, least frequently then least recently accessed first
+    ("eviction_rank", [("access_count", ASCENDING), ("last_access", ASCENDING)], {}),
+    ("source_stored_at", [("source_db", ASCENDING), ("stored_at", ASCENDING)], {}),
+]
+# Indexes replaced by others, as (collection, name), dropped if they exist
+DROPPED_INDEXES = [
+    ("cache", "kmers"),
+]
+# Indexes of the uniprot_metadata collection, looked up by its _id, the accession
+UNIPROT_METADATA_INDEXES = [
+    ("stored_at", [("stored_at", ASCENDING)], {}),
+]
+# Indexes of the tombstones collection
+TOMBSTONE_INDEXES = [
+    ("uniprot_scope", [("uniprot_id", ASCENDING), ("scope", ASCENDING)], {"unique": True}),
+    ("expires_at", [("expires_at", ASCENDING)], {}),
+]
+
+
+async def wait_for_mongo(host=MONGO_HOST, retries=5, delay=5):
+    # Create a temporary client with a short serverSelectionTimeout
+    temp_client = AsyncMongoClient(host=host, serverSelectionTimeoutMS=1000)  # Short timeout for initial connection attempts
+    try:
+        for attempt in range(retries):
+            try:
+                # Attempt to ping the MongoDB server
+                await temp_client.admin.command('ping')
+                print("MongoDB is ready!")
+                return True  # MongoDB is ready
+            except Exception as e:
+                print(f"Waiting for MongoDB... Attempt {attempt + 1}/{retries}")
+                await asyncio.sleep(delay)
+        raise Exception("MongoDB not ready after max retries. Exiting.")
+    finally:
+        await temp_client.close()
+
+
+class MongoEngine(StorageEngine):
+    """Keeps the entries in the cache collection of a MongoDB server,
+    the files gzip compressed in the blobs collection, the uniprot
+    metadata in the uniprot_metadata collection and tombstones in the
+    tombstones collection."""
+
+    name = "mongo"
+
+    def __init__(self, host=MONGO_HOST, event_listeners=()):
+        self.host = host
+        self.event_listeners = list(event_listeners)
+        self.client = None
+        self.db = None
+
+    async def connect(self):
+        """Wait for MongoDB to be ready, connect to it and prepare the cache collections.
+        Must be called from the running event loop before using the cache."""
+        await wait_for_mongo(self.host)
+        # Connect to running database with a longer timeout now that we know MongoDB is ready
+        self.client = AsyncMongoClient(host=self.host, serverSelectionTimeoutMS=30000,
+                                       maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                       minPoolSize=MONGO_MIN_POOL_SIZE,
+                                       event_listeners=self.event_listeners)
+        self.db = self.client["cache"]
+        await self.create_indexes()
+        await self.backfill_kmers()
+        await self.migrate_inline_files()
+        await self.backfill_metadata()
+
+    async def close(self):
+        await self.client.close()
+
+    async def create_indexes(self):
+        """Create the cache indexes if they are missing.
+        Mongo skips indexes that already exist, so this is safe to run on every startup.
+        """
+        for collection, indexes in [("cache", CACHE_INDEXES), ("uniprot_metadata", UNIPROT_METADATA_INDEXES),
+                                    ("tombstones", TOMBSTONE_INDEXES)]:
+            for name, keys, options in indexes:
+                try:
+                    await self.db[collection].create_index(keys, name=name, **options)
+                except OperationFailure as e:
+                    print(f"Failed to create {collection} index {name}: {e}")
+        for collection, name in DROPPED_INDEXES:
+            if name in await self.db[collection].index_information():
+                await self.db[collection].drop_index(name)
+
+    async def backfill_kmers(self, batch_size=1000):
+        "Add the kmers field to entries stored before the kmer index existed."
+        updates = []
+        async for e in self.db.cache.find({"kmers": {"$exists": False}}, {"sequence": 1}):
+            updates.append(UpdateOne(
+                {"_id": e["_id"]},
+                {"$set": {"kmers": sequence_kmers(e.get("sequence", ""))}}))
+            if len(updates) >= batch_size:
+                await self.db.cache.bulk_write(updates, ordered=False)
+                updates = []
+        if len(updates) > 0:
+            await self.db.cache.bulk_write(updates, ordered=False)
+
+    async def migrate_inline_files(self):
+        """Move pdb files stored inline in cache entries into the blob store.
+        Each entry whose reference was taken is recorded on the blob until the
+        inline file is removed, so a migration stopped between the two steps
+        doesn't take the reference again when it is run again."""
+        async for e in self.db.cache.find({"pdb_file": {"$exists": True}}, {"pdb_file": 1, "hash": 1}):
+            pdb_hash = e.get("hash") or blake2b(e["pdb_file"].encode()).hexdigest()
+            try:
+                await self.db.blobs.update_one(
+                    {"_id": pdb_hash, "migrating": {"$ne": e["_id"]}},
+                    {"$inc": {"refs": 1}, "$push": {"migrating": e["_id"]},
+                     "$setOnInsert": _blob_fields(e["pdb_file"])},
+                    upsert=True)
+            except DuplicateKeyError:
+                pass  # the blob exists and already holds this entry's reference
+            await self.db.cache.update_one({"_id": e["_id"]},
+                                           {"$set": {"hash": pdb_hash}, "$unset": {"pdb_file": ""}})
+            await self.db.blobs.update_one({"_id": pdb_hash}, {"$pull": {"migrating": e["_id"]}})
+
+    async def backfill_metadata(self):
+        "Add the sequence_length, size and stored_at fields to entries stored before they existed."
+        await self.db.cache.update_many(
+            {"sequence_length": {"$exists": False}},
+            [{"$set": {"sequence_length": {"$strLenCP": {"$ifNull": ["$sequence", ""]}}}}])
+        # the creation time of the entry's ObjectId is when it was first stored
+        await self.db.cache.update_many(
+            {"stored_at": {"$exists": False}},
+            [{"$set": {"stored_at": {"$toDate": "$_id"}}}])
+        async for e in self.db.cache.find({"size": {"$exists": False}}, {"hash": 1}):
+            blob = await self.db.blobs.find_one({"_id": e.get("hash")}, {"size": 1})
+            if blob is not None:
+                await self.db.cache.update_one({"_id": e["_id"]}, {"$set": {"size": blob["size"]}})
+
+    async def find_best(self, search_dict, source_dbs=None, field="pdb_file"):
+        try:
+            search_dict = _object_ids(search_dict)
+        except InvalidId:
+            return None
+        entries = await self._find_best(search_dict, source_dbs, _projection(field)).to_list(1)
+        if len(entries) == 0:
+            return None
+        entry = entries[0]
+        if field == "pdb_file":
+            value = await self._entry_file(entry)
+        elif field == "metadata":
+            value = entry_metadata(entry)
+        elif field == "raw":
+            value = (entry_metadata(entry), await self._entry_bytes(entry))
+        elif field == "raw_gzip":
+            value = (entry_metadata(entry), await self._entry_gzip(entry))
+        else:
+            value = entry.get(field)
+        return entry["_id"], value
+
+    async def find_best_batch(self, uniprot_ids, source_dbs=None):
+        "Looks up all the ids with a single aggregation and a single blob query"
+        search_dict = _source_filter({"uniprot_id": {"$in": list(uniprot_ids)}}, source_dbs)
+        best = {e["_id"]: e async for e in await self.db.cache.aggregate([
+            {"$match": search_dict},
+            {"$sort": {"uniprot_id": 1, "score": -1}},
+            {"$group": {"_id": "$uniprot_id",
+                        "entry_id": {"$first": "$_id"},
+                        "hash": {"$first": "$hash"},
+                        "pdb_file": {"$first": "$pdb_file"}}},
+        ])}
+        hashes = [e["hash"] for e in best.values() if e.get("pdb_file") is None]
+        files = await self._get_blobs(hashes)
+        found = {}
+        for id, e in best.items():
+            # entries stored before the blob store existed may still be inline
+            pdb_file = e.get("pdb_file") or files.get(e["hash"])
+            if pdb_file is not None:
+                found[id] = (e["entry_id"], pdb_file)
+        return found
+
+    async def find_by_sequence(self, sequence, source_dbs=None, field="pdb_file"):
+        """Candidates come from the kmer index in score order, and are checked with an exact match
+        as they arrive. Only the best SEQUENCE_CANDIDATES_LIMIT candidates are checked."""
+        async for c in self._sequence_candidates(sequence, source_dbs):
+            if c.get("sequence", "").find(sequence) != -1:
+                return await self.find_best({"_id": c["_id"]}, field=field)
+        return None
+
+    async def store(self, info, pdb_file):
+        "The check and the write are a single atomic upsert."
+        # add the blob before the entry that points at it
+        await self._put_blob(info["hash"], pdb_file)
+        entry_id, status = await self._store_entry(info)
+        print({"inserted": "Inserted into cache",
+               "updated": "Updated existing entry",
+               "unchanged": "Already in cache"}[status])
+        return "" if status == "unchanged" else entry_id
+
+    async def store_bulk(self, infos, pdb_files):
+        """Uses one query for the existing entries and unordered bulk writes,
+        rather than a few round trips per file.
+        The writes are conditional on what the query read: an update only matches the
+        entry while it still holds the file that was read, upserting it again if it was
+        removed since, and an insert fails if an entry was added since. Entries whose
+        writes fail that way are stored one at a time like store."""
+        existing = {}
+        ids = list({i["uniprot_id"] for i in infos if i["uniprot_id"] != ""})
+        if len(ids) > 0:
+            async for e in self.db.cache.find({"uniprot_id": {"$in": ids}},
+                                              {"uniprot_id": 1, "source_db": 1, "hash": 1}):
+                existing[(e["uniprot_id"], e["source_db"])] = e
+
+        # Work out the final state of each entry, so that repeats of an entry
+        # within the batch become a single write, as the writes are unordered.
+        results = []  # (key, result)
+        writes = {}  # key -> (entry id, info, hash of the stored entry or None)
+        for i, info in enumerate(infos):
+            key = (info["uniprot_id"], info["source_db"])
+            if info["uniprot_id"] == "":
+                key = i  # entries without a uniprot id are always added
+            if key in writes:
+                entry_id, _, old_hash = writes[key]
+                current_hash = writes[key][1]["hash"]
+            elif key in existing:
+                entry_id = existing[key]["_id"]
+                old_hash = current_hash = existing[key].get("hash")
+            else:
+                entry_id, old_hash, current_hash = ObjectId(), None, None
+            if current_hash == info["hash"]:
+                results.append((key, {"id": str(entry_id), "status": "unchanged"}))
+                continue
+            status = "inserted" if current_hash is None else "updated"
+            results.append((key, {"id": str(entry_id), "status": status}))
+            writes[key] = (entry_id, info, old_hash)
+
+        files = {info["hash"]: f for info, f in zip(infos, pdb_files)}
+        planned = list(writes.items())
+        new_refs = {}
+        cache_ops = []
+        for _, (entry_id, info, old_hash) in planned:
+            new_refs[info["hash"]] = new_refs.get(info["hash"], 0) + 1
+            if old_hash is None:
+                cache_ops.append(InsertOne({"_id": entry_id, **info, **_first_access(info)}))
+            else:
+                # $set rather than a replace keeps the access stats of the entry
+                cache_ops.append(UpdateOne({"_id": entry_id, "hash": old_hash},
+                                           {"$set": info, "$setOnInsert": _first_access(info)}, upsert=True))
+
+        # add blobs before the entries that point at them
+        await self._put_blobs({h: (n, files[h]) for h, n in new_refs.items()})
+        upserted, errors = set(), {}
+        if len(cache_ops) > 0:
+            try:
+                upserted = set((await self.db.cache.bulk_write(cache_ops, ordered=False)).upserted_ids)
+            except BulkWriteError as e:
+                upserted = {u["index"] for u in e.details["upserted"]}
+                errors = {error["index"]: error for error in e.details["writeErrors"]}
+
+        # Each update either matched, and replaced the file that was read, or was upserted
+        # as the entry was removed since (releasing its file). A duplicate key error means
+        # the entry was changed or added since, so it is stored again from what it holds now.
+        released = {}
+        outcomes = {}  # key -> (entry id, status) replacing the planned results
+        conflicts = []
+        for i, (key, (entry_id, info, old_hash)) in enumerate(planned):
+            error = errors.get(i)
+            if error is None:
+                if old_hash is None:
+                    continue
+                if i in upserted:
+                    outcomes[key] = (str(entry_id), "inserted")
+                else:
+                    released[old_hash] = released.get(old_hash, 0) - 1
+            elif error["code"] == DUPLICATE_KEY_ERROR:
+                conflicts.append((key, info))
+            else:
+                print(f"Failed to store entry in cache: {error['errmsg']}")
+                released[info["hash"]] = released.get(info["hash"], 0) - 1
+                outcomes[key] = (str(entry_id), "error")
+        await self._release_blobs(released)
+        for key, info in conflicts:
+            # the reference taken above for the new file is handed on to _store_entry
+            entry_id, status = await self._store_entry(info)
+            if status == "unchanged":
+                e = await self.db.cache.find_one(
+                    {"uniprot_id": info["uniprot_id"], "source_db": info["source_db"]}, {"_id": 1})
+                entry_id = "" if e is None else str(e["_id"])
+            outcomes[key] = (entry_id, status)
+
+        for key, r in results:
+            if key in outcomes and r["status"] != "unchanged":
+                r["id"], r["status"] = outcomes[key]
+        stored = sum(1 for _, r in results if r["status"] in ("inserted", "updated"))
+        print(f"Bulk stored {stored} of {len(infos)} files")
+        return [r for _, r in results]
+
+    async def is_current(self, uniprot_id, source_db, pdb_hash):
+        e = await self.db.cache.find_one(
+            {"uniprot_id": uniprot_id, "source_db": source_db, "hash": pdb_hash},
+            {"_id": 1})
+        return e is not None
+
+    async def find_hashes(self, uniprot_ids):
+        return {(e["uniprot_id"], e["source_db"]): e.get("hash")
+                async for e in self.db.cache.find({"uniprot_id": {"$in": list(uniprot_ids)}},
+                                                  {"_id": 0, "uniprot_id": 1, "source_db": 1, "hash": 1})}
+
+    async def clear(self):
+        await self.client.drop_database("cache")
+        # dropping the database drops its indexes too
+        await self.create_indexes()
+
+    async def add_accesses(self, accesses):
+        ops = [UpdateOne({"_id": entry_id},
+                         {"$inc": {"access_count": count},
+                          "$max": {"last_access": datetime.fromtimestamp(last, timezone.utc)}})
+               for entry_id, (count, last) in accesses.items()]
+        if len(ops) > 0:
+            await self.db.cache.bulk_write(ops, ordered=False)
+
+    async def expired_entries(self, source_db, stored_before):
+        cutoff = datetime.fromtimestamp(stored_before, timezone.utc)
+        return [e["_id"] for e in await self.db.cache.find(
+            {"source_db": source_db, "stored_at": {"$lt": cutoff}}, {"_id": 1}).to_list()]
+
+    async def eviction_candidates(self, n):
+        # entries stored before storing counted as an access have no access_count, which sorts first
+        return [e["_id"] for e in await self.db.cache.find({}, {"_id": 1}).sort(
+            [("access_count", ASCENDING), ("last_access", ASCENDING)]).limit(n).to_list()]
+
+    async def remove_entries(self, entry_ids):
+        """Each entry is deleted atomically with reading its hash, so a file replaced
+        concurrently is not released twice."""
+        released = {}
+        removed = []
+        for entry_id in entry_ids:
+            e = await self.db.cache.find_one_and_delete({"_id": entry_id},
+                                                        projection={"uniprot_id": 1, "hash": 1})
+            if e is None:
+                continue
+            removed.append((entry_id, e.get("uniprot_id", "")))
+            if e.get("hash") is not None:
+                released[e["hash"]] = released.get(e["hash"], 0) - 1
+        await self._release_blobs(released)
+        return removed
+
+    async def size(self):
+        "The size of the cache entries and the blobs, as counted by mongo's collection stats."
+        sizes = {}
+        for name in ["cache", "blobs"]:
+            try:
+                stats = await (await self.db[name].aggregate(
+                    [{"$collStats": {"storageStats": {}}}])).to_list()
+                sizes[name + "_bytes"] = stats[0]["storageStats"]["size"]
+            except (OperationFailure, IndexError):
+                sizes[name + "_bytes"] = 0  # the collection does not exist yet
+        sizes["total_bytes"] = sizes["cache_bytes"] + sizes["blobs_bytes"]
+        return sizes
+
+    async def count(self):
+        return await self.db.cache.estimated_document_count()
+
+    async def hottest(self, n):
+        hottest = await self.db.cache.find(
+            {"access_count": {"$gt": 0}},
+            {"uniprot_id": 1, "source_db": 1, "access_count": 1, "last_access": 1}).sort(
+            [("access_count", DESCENDING), ("last_access", DESCENDING)]).limit(n).to_list()
+        return [{"db_id": str(e["_id"]),
+                 "uniprot_id": e.get("uniprot_id"),
+                 "source_db": e.get("source_db"),
+                 "access_count": e.get("access_count"),
+                 "last_access": str(e.get("last_access"))}
+                for e in hottest]
+
+    async def explain_queries(self, uniprot_id="", sequence="", db_id=None):
+        """A query is index covered if its winning plan never scans the collection,
+        and sorts in memory if its plan has a blocking SORT stage."""
+        queries = {"retrieve_by_uniprot_id": self._find_best({"uniprot_id": uniprot_id})}
+        if len(sequence) >= KMER_LENGTH:
+            queries["retrieve_by_sequence"] = self._sequence_candidates(sequence)
+        if db_id is not None:
+            try:
+                queries["retrieve_by_db_id"] = self._find_best({"_id": ObjectId(db_id)})
+            except InvalidId:
+                raise ValueError(f"Invalid db_id: {db_id}")
+        plans = {}
+        for route, cursor in queries.items():
+            explained = await cursor.explain()
+            winning_plan = explained.get("queryPlanner", {}).get("winningPlan", {})
+            # newer mongo versions nest the plan when using the slot based engine
+            winning_plan = winning_plan.get("queryPlan", winning_plan)
+            stages = _plan_stages(winning_plan)
+            stats = explained.get("executionStats", {})
+            plans[route] = {
+                "index_covered": "COLLSCAN" not in stages,
+                "in_memory_sort": "SORT" in stages,
+                "stages": stages,
+                "indexes": _plan_indexes(winning_plan),
+                "keys_examined": stats.get("totalKeysExamined"),
+                "docs_examined": stats.get("totalDocsExamined"),
+                "execution_time_ms": stats.get("executionTimeMillis"),
+            }
+        index_stats = [{"name": s["name"],
+                        "key": s["key"],
+                        "ops": s["accesses"]["ops"],
+                        "since": str(s["accesses"]["since"])}
+                       async for s in await self.db.cache.aggregate([{"$indexStats": {}}])]
+        return {"plans": plans, "index_stats": index_stats}
+
+    async def get_uniprot_metadata(self, accession):
+        m = await self.db.uniprot_metadata.find_one({"_id": accession})
+        if m is None:
+            return None
+        return m["metadata"], m["stored_at"].replace(tzinfo=timezone.utc).timestamp()
+
+    async def store_uniprot_metadata(self, accession, metadata_json, stored_at):
+        await self.db.uniprot_metadata.replace_one(
+            {"_id": accession},
+            {"metadata": metadata_json, "stored_at": datetime.fromtimestamp(stored_at, timezone.utc)},
+            upsert=True)
+
+    async def expire_uniprot_metadata(self, stored_before):
+        cutoff = datetime.fromtimestamp(stored_before, timezone.utc)
+        return (await self.db.uniprot_metadata.delete_many({"stored_at": {"$lt": cutoff}})).deleted_count
+
+    async def find_tombstones(self, uniprot_ids, scopes, now):
+        found = {}
+        async for t in self.db.tombstones.find(
+                {"uniprot_id": {"$in": list(uniprot_ids)},
+                 "scope": {"$in": list(scopes)},
+                 "expires_at": {"$gt": datetime.fromtimestamp(now, timezone.utc)}},
+                {"_id": 0, "uniprot_id": 1, "reason": 1}):
+            found[t["uniprot_id"]] = t["reason"]
+        return found
+
+    async def store_tombstone(self, uniprot_id, scope, reason, expires_at):
+        await self.db.tombstones.replace_one(
+            {"uniprot_id": uniprot_id, "scope": scope},
+            {"uniprot_id": uniprot_id, "scope": scope, "reason": reason,
+             "expires_at": datetime.fromtimestamp(expires_at, timezone.utc)},
+            upsert=True)
+
+    async def remove_tombstones(self, uniprot_ids):
+        await self.db.tombstones.delete_many({"uniprot_id": {"$in": list(uniprot_ids)}})
+
+    async def expire_tombstones(self, now):
+        cutoff = datetime.fromtimestamp(now, timezone.utc)
+        return (await self.db.tombstones.delete_many({"expires_at": {"$lt": cutoff}})).deleted_count
+
+    # --------------- private helpers ---------------
+
+    def _sequence_candidates(self, sequence, source_dbs=None):
+        """Return a cursor over the sequences of the entries that may contain sequence,
+        highest score first, read in that order from the kmers_score index"""
+        search_dict = _source_filter(kmer_search(sequence), source_dbs)
+        return self.db.cache.find(search_dict, {"sequence": 1}).sort({"score": -1}).hint(
+            "kmers_score").limit(SEQUENCE_CANDIDATES_LIMIT)
+
+    def _find_best(self, search_dict, source_dbs=None, projection=None):
+        "Return a cursor over the highest scoring entry matching search_dict"
+        search_dict = _source_filter(search_dict, source_dbs)
+        if projection is None:
+            projection = {"kmers": 0}
+        return self.db.cache.find(search_dict, projection).sort({"score": -1}).limit(1)
+
+    async def _entry_file(self, entry):
+        "Return the pdb file of a cache entry"
+        if "pdb_file" in entry:
+            # stored before the blob store existed, and not migrated yet
+            return entry["pdb_file"]
+        return await self._get_blob(entry.get("hash"))
+
+    async def _entry_bytes(self, entry):
+        "Return the pdb file of a cache entry as utf-8 bytes"
+        if "pdb_file" in entry:
+            # stored before the blob store existed, and not migrated yet
+            return entry["pdb_file"].encode()
+        return await self._get_blob_bytes(entry.get("hash"))
+
+    async def _entry_gzip(self, entry):
+        "Return the pdb file of a cache entry gzip compressed, as stored"
+        if "pdb_file" in entry:
+            # stored before the blob store existed, and not migrated yet
+            return gzip.compress(entry["pdb_file"].encode(), mtime=0)
+        blob = await self.db.blobs.find_one({"_id": entry.get("hash")})
+        if blob is None:
+            return None
+        return bytes(blob["data"])
+
+    async def _store_entry(self, info):
+        """Add the entry of info, or replace the file of its uniprot id and source db's entry,
+        in one atomic upsert. The blob of info's file must already hold a reference for it,
+        which is released if the entry already holds the file, as is the replaced file's.
+        Returns (entry id, status), the id being "" if the status is "unchanged"."""
+        new_id = ObjectId()
+        if info["uniprot_id"] == "":
+            await self.db.cache.insert_one({"_id": new_id, **info, **_first_access(info)})
+            return str(new_id), "inserted"
+        try:
+            # only matches an entry with a different file, if the entry has the same file
+            # the upsert tries to insert a duplicate which the unique index rejects
+            e = await self.db.cache.find_one_and_update(
+                {"uniprot_id": info["uniprot_id"],
+                 "source_db": info["source_db"],
+                 "hash": {"$ne": info["hash"]}},
+                {"$set": info, "$setOnInsert": {"_id": new_id, **_first_access(info)}},
+                projection={"hash": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError:
+            await self._release_blob(info["hash"])
+            return "", "unchanged"
+        if e is None:
+            return str(new_id), "inserted"
+        await self._release_blob(e.get("hash"))
+        return str(e["_id"]), "updated"
+
+    async def _put_blob(self, pdb_hash, pdb_file):
+        """Store pdb_file compressed in the blob store under its hash,
+        or add a reference to it if it is already stored."""
+        await self._put_blobs({pdb_hash: (1, pdb_file)})
+
+    async def _put_blobs(self, blobs):
+        """Add references to many blobs in one bulk write.
+        blobs maps each hash to a (reference count, pdb_file) tuple."""
+        ops = []
+        for pdb_hash, (refs, pdb_file) in blobs.items():
+            ops.append(UpdateOne(
+                {"_id": pdb_hash},
+                {"$inc": {"refs": refs}, "$setOnInsert": _blob_fields(pdb_file)},
+                upsert=True))
+        if len(ops) > 0:
+            await self.db.blobs.bulk_write(ops, ordered=False)
+
+    async def _get_blob(self, pdb_hash):
+        "Return the decompressed file stored under the hash, or None"
+        data = await self._get_blob_bytes(pdb_hash)
+        if data is None:
+            return None
+        return data.decode()
+
+    async def _get_blob_bytes(self, pdb_hash):
+        "Return the decompressed bytes stored under the hash, or None"
+        blob = await self.db.blobs.find_one({"_id": pdb_hash})
+        if blob is None:
+            return None
+        return gzip.decompress(blob["data"])
+
+    async def _get_blobs(self, hashes):
+        "Return a dict of hash to decompressed file for the stored hashes"
+        return {blob["_id"]: gzip.decompress(blob["data"]).decode()
+                async for blob in self.db.blobs.find({"_id": {"$in": list(set(hashes))}})}
+
+    async def _release_blob(self, pdb_hash):
+        "Remove a reference to a blob, deleting the blob when it is unreferenced"
+        await self._release_blobs({pdb_hash: -1})
+
+    async def _release_blobs(self, blobs):
+        "Remove references from many blobs, blobs maps each hash to a negative count"
+        if len(blobs) == 0:
+            return
+        await self.db.blobs.bulk_write([UpdateOne({"_id": h}, {"$inc": {"refs": n}})
+                                        for h, n in blobs.items()], ordered=False)
+        await self.db.blobs.delete_many({"_id": {"$in": list(blobs)}, "refs": {"$lte": 0}})
+
+
+def _blob_fields(pdb_file):
+    "The fields of a new blob holding pdb_file"
+    data = pdb_file.encode()
+    return {"data": Binary(gzip.compress(data, mtime=0)), "encoding": "gzip", "size": len(data)}
+
+
+def _first_access(info):
+    """The access stats of a new entry: storing it counts as an access, as it is stored
+    because a client asked for it, so it isn't the first to be evicted"""
+    return {"access_count": 1, "last_access": info["stored_at"]}
+
+
+def _object_ids(search_dict):
+    "Return search_dict with a db id given as a string converted to an ObjectId"
+    if isinstance(search_dict.get("_id"), str):
+        return {**search_dict, "_id": ObjectId(search_dict["_id"])}
+    return search_dict
+
+
+def _projection(field):
+    "Return the projection reading only what find_best needs to return field"
+    if field == "pdb_file":
+        # entries stored before the blob store existed may hold the file inline
+        return {"hash": 1, "pdb_file": 1}
+    if field == "metadata":
+        return {f: 1 for f in METADATA_FIELDS}
+    if field in ("raw", "raw_gzip"):
+        return {f: 1 for f in METADATA_FIELDS + ["pdb_file"]}
+    return {field: 1}
+
+
+def _source_filter(search_dict, source_dbs):
+    "Restrict search_dict to the source_dbs list, if one is given"
+    if isinstance(source_dbs, list):
+        source_dbs = [x.upper() for x in source_dbs]
+        search_dict["source_db"] = {"$in": source_dbs}
+    return search_dict
+
+
+def _plan_stages(plan):
+    "Return the list of stage names in a query plan tree"
+    stages = [plan.get("stage")] if "stage" in plan else []
+    for child in plan.get("inputStages", []) + [plan.get("inputStage", {})]:
+        stages += _plan_stages(child)
+    return stages
+
+
+def _plan_indexes(plan):
+    "Return the names of the indexes scanned in a query plan tree"
+    indexes = [plan["indexName"]] if "indexName" in plan else []
+    for child in plan.get("inputStages", []) + [plan.get("inputStage", {})]:
+        indexes += _plan_indexes(child)
+    return indexes
@@ -0,0 +1,474 @@
+from datetime import datetime, timezone
+import asyncio
+import gzip
+import os
+import re
+import secrets
+import sqlite3
+import threading
+from kmers import KMER_LENGTH, query_kmers
+from .base import StorageEngine, METADATA_FIELDS, entry_metadata
+
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "cache.sqlite3")
+# Bytes of the database file read through a memory map rather than read() calls,
+# so reads of cached pages need no system call or copy into SQLite's page cache
+SQLITE_MMAP_BYTES = int(os.environ.get("SQLITE_MMAP_BYTES", 1024 * 1024 * 1024))
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS entries (
+        id TEXT PRIMARY KEY,
+        uniprot_id TEXT NOT NULL,
+        source_db TEXT NOT NULL,
+        score REAL,
+        sequence TEXT NOT NULL DEFAULT '',
+        hash TEXT,
+        sequence_length INTEGER,
+        size INTEGER,
+        stored_at REAL,
+        access_count INTEGER NOT NULL DEFAULT 0,
+        last_access REAL)""",
+    # same indexes as the mongo engine, see storage/mongo.py
+    "CREATE INDEX IF NOT EXISTS entries_uniprot_source_score ON entries (uniprot_id, source_db, score DESC)",
+    """CREATE UNIQUE INDEX IF NOT EXISTS entries_unique_uniprot_source ON entries (uniprot_id, source_db)
+        WHERE uniprot_id != ''""",
+    "CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash)",
+    "CREATE INDEX IF NOT EXISTS entries_eviction_rank ON entries (access_count, last_access)",
+    "CREATE INDEX IF NOT EXISTS entries_source_stored_at ON entries (source_db, stored_at)",
+    # posting list from each k-mer to its entries
+    """CREATE TABLE IF NOT EXISTS kmers (
+        kmer TEXT NOT NULL,
+        entry_id TEXT NOT NULL,
+        PRIMARY KEY (kmer, entry_id)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS kmers_entry ON kmers (entry_id)",
+    """CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        encoding TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        refs INTEGER NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS uniprot_metadata (
+        accession TEXT PRIMARY KEY,
+        metadata TEXT NOT NULL,
+        stored_at REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS uniprot_metadata_stored_at ON uniprot_metadata (stored_at)",
+    """CREATE TABLE IF NOT EXISTS tombstones (
+        uniprot_id TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        reason TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (uniprot_id, scope)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS tombstones_expires_at ON tombstones (expires_at)",
+]
+
+# Entry fields that are columns of the entries table, the id is stored as id
+COLUMNS = {"_id": "id", "uniprot_id": "uniprot_id", "source_db": "source_db", "score": "score",
+           "sequence": "sequence", "hash": "hash", "sequence_length": "sequence_length",
+           "size": "size", "stored_at": "stored_at", "access_count": "access_count",
+           "last_access": "last_access"}
+
+
+class SQLiteEngine(StorageEngine):
+    """Keeps the cache in a single SQLite file, for single node deployments,
+    edge caches, tests and benchmarks. Needs no server and nothing outside
+    the standard library.
+
+    The database is in WAL mode, so reads never wait for writes, and is memory
+    mapped, so reads are served from the mapped pages.
+    Queries run in worker threads to keep the event loop free, each thread reading
+    with its own connection, while writes share one connection and are serialised.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH, mmap_bytes=SQLITE_MMAP_BYTES):
+        self.path = path
+        self.mmap_bytes = mmap_bytes
+        self.writer = None
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+
+    async def connect(self):
+        self.writer = self._open()
+        with self.write_lock, self.writer:
+            for statement in SCHEMA:
+                self.writer.execute(statement)
+
+    async def close(self):
+        with self.readers_lock:
+            for reader in self.readers:
+                reader.close()
+            self.readers = []
+        self.local = threading.local()
+        self.writer.close()
+
+    async def find_best(self, search_dict, source_dbs=None, field="pdb_file"):
+        return await self._read(self._find_best, search_dict, source_dbs, field)
+
+    async def find_best_batch(self, uniprot_ids, source_dbs=None):
+        return await self._read(self._find_best_batch, list(uniprot_ids), source_dbs)
+
+    async def find_by_sequence(self, sequence, source_dbs=None, field="pdb_file"):
+        return await self._read(self._find_by_sequence, sequence, source_dbs, field)
+
+    async def store(self, info, pdb_file):
+        entry_id, status = await self._write(self._store, info, pdb_file)
+        if status == "unchanged":
+            print("Already in cache")
+            return ""
+        print("Inserted into cache" if status == "inserted" else "Updated existing entry")
+        return entry_id
+
+    async def store_bulk(self, infos, pdb_files):
+        "All the files are stored in a single transaction"
+        return await self._write(self._store_bulk, infos, pdb_files)
+
+    async def is_current(self, uniprot_id, source_db, pdb_hash):
+        row = await self._read(lambda conn: conn.execute(
+            "SELECT 1 FROM entries WHERE uniprot_id = ? AND source_db = ? AND hash = ?",
+            (uniprot_id, source_db, pdb_hash)).fetchone())
+        return row is not None
+
+    async def find_hashes(self, uniprot_ids):
+        def find(conn):
+            found = {}
+            ids = list(uniprot_ids)
+            # stay under sqlite's limit on query parameters
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT uniprot_id, source_db, hash FROM entries WHERE uniprot_id IN ({','.join('?' * len(chunk))})",
+                    chunk)
+                found.update(((uniprot_id, source_db), pdb_hash) for uniprot_id, source_db, pdb_hash in rows)
+            return found
+        return await self._read(find)
+
+    async def clear(self):
+        def clear(conn):
+            for table in ["entries", "kmers", "blobs", "uniprot_metadata", "tombstones"]:
+                conn.execute(f"DELETE FROM {table}")
+        await self._write(clear)
+
+    async def add_accesses(self, accesses):
+        await self._write(lambda conn: conn.executemany(
+            """UPDATE entries SET access_count = access_count + ?,
+               last_access = max(coalesce(last_access, 0), ?) WHERE id = ?""",
+            [(count, last, entry_id) for entry_id, (count, last) in accesses.items()]))
+
+    async def expired_entries(self, source_db, stored_before):
+        rows = await self._read(lambda conn: conn.execute(
+            "SELECT id FROM entries WHERE source_db = ? AND stored_at < ?",
+            (source_db, stored_before)).fetchall())
+        return [r[0] for r in rows]
+
+    async def eviction_candidates(self, n):
+        # entries stored before storing counted as an access have no last_access, which sorts first
+        rows = await self._read(lambda conn: conn.execute(
+            "SELECT id FROM entries ORDER BY access_count, last_access LIMIT ?", (n,)).fetchall())
+        return [r[0] for r in rows]
+
+    async def remove_entries(self, entry_ids):
+        return await self._write(self._remove_entries, list(entry_ids))
+
+    async def size(self):
+        "The pages of the database file in use, pages freed by deletes are reused"
+        def size(conn):
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            return (pages - free) * page_size
+        used = await self._read(size)
+        return {"db_bytes": used, "total_bytes": used}
+
+    async def count(self):
+        return await self._read(lambda conn: conn.execute("SELECT count(*) FROM entries").fetchone()[0])
+
+    async def hottest(self, n):
+        rows = await self._read(lambda conn: conn.execute(
+            """SELECT id, uniprot_id, source_db, access_count, last_access FROM entries
+               WHERE access_count > 0 ORDER BY access_count DESC, last_access DESC LIMIT ?""",
+            (n,)).fetchall())
+        return [{"db_id": id,
+                 "uniprot_id": uniprot_id,
+                 "source_db": source_db,
+                 "access_count": access_count,
+                 "last_access": str(datetime.fromtimestamp(last_access, timezone.utc))}
+                for id, uniprot_id, source_db, access_count, last_access in rows]
+
+    async def explain_queries(self, uniprot_id="", sequence="", db_id=None):
+        """A query is index covered if its plan never scans a whole table.
+        SQLite keeps no index usage stats, so index_stats lists the indexes."""
+        def explain(conn):
+            queries = {"retrieve_by_uniprot_id": self._best_query({"uniprot_id": uniprot_id}, None, ["id"])}
+            if len(sequence) >= KMER_LENGTH:
+                queries["retrieve_by_sequence"] = self._sequence_query(sequence, None)
+            if db_id is not None:
+                queries["retrieve_by_db_id"] = self._best_query({"_id": db_id}, None, ["id"])
+            plans = {}
+            for route, (sql, params) in queries.items():
+                details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+                plans[route] = {
+                    "index_covered": not any(re.match(r"SCAN \w+$", d) for d in details),
+                    "in_memory_sort": any("USE TEMP B-TREE FOR ORDER BY" in d for d in details),
+                    "stages": details,
+                    "indexes": [m.group(1) for d in details
+                                for m in [re.search(r"USING (?:COVERING )?INDEX (\w+)", d)] if m],
+                }
+            index_stats = [{"name": name, "key": sql} for name, sql in conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")]
+            return {"plans": plans, "index_stats": index_stats}
+        return await self._read(explain)
+
+    async def get_uniprot_metadata(self, accession):
+        row = await self._read(lambda conn: conn.execute(
+            "SELECT metadata, stored_at FROM uniprot_metadata WHERE accession = ?", (accession,)).fetchone())
+        return None if row is None else (row[0], row[1])
+
+    async def store_uniprot_metadata(self, accession, metadata_json, stored_at):
+        await self._write(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO uniprot_metadata (accession, metadata, stored_at) VALUES (?, ?, ?)",
+            (accession, metadata_json, stored_at)))
+
+    async def expire_uniprot_metadata(self, stored_before):
+        return await self._write(lambda conn: conn.execute(
+            "DELETE FROM uniprot_metadata WHERE stored_at < ?", (stored_before,)).rowcount)
+
+    async def find_tombstones(self, uniprot_ids, scopes, now):
+        def find(conn):
+            found = {}
+            ids = list(uniprot_ids)
+            # stay under sqlite's limit on query parameters
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT uniprot_id, reason FROM tombstones WHERE uniprot_id IN ({','.join('?' * len(chunk))})"
+                    f" AND scope IN ({','.join('?' * len(scopes))}) AND expires_at > ?",
+                    (*chunk, *scopes, now))
+                found.update(rows)
+            return found
+        return await self._read(find)
+
+    async def store_tombstone(self, uniprot_id, scope, reason, expires_at):
+        await self._write(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO tombstones (uniprot_id, scope, reason, expires_at) VALUES (?, ?, ?, ?)",
+            (uniprot_id, scope, reason, expires_at)))
+
+    async def remove_tombstones(self, uniprot_ids):
+        await self._write(lambda conn: conn.executemany(
+            "DELETE FROM tombstones WHERE uniprot_id = ?", [(id,) for id in uniprot_ids]))
+
+    async def expire_tombstones(self, now):
+        return await self._write(lambda conn: conn.execute(
+            "DELETE FROM tombstones WHERE expires_at < ?", (now,)).rowcount)
+
+    # --------------- private helpers ---------------
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # in WAL mode a commit is durable once checkpointed, safe against corruption
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_bytes)}")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        return conn
+
+    def _reader(self):
+        "Return the read connection of the current thread"
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._open()
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    async def _read(self, fn, *args):
+        "Run fn(connection, *args) in a worker thread with its read connection"
+        return await asyncio.to_thread(lambda: fn(self._reader(), *args))
+
+    async def _write(self, fn, *args):
+        "Run fn(connection, *args) in a worker thread as one transaction"
+        def write():
+            with self.write_lock, self.writer:
+                self.writer.execute("BEGIN IMMEDIATE")
+                return fn(self.writer, *args)
+        return await asyncio.to_thread(write)
+
+    def _best_query(self, search_dict, source_dbs, columns):
+        "Return the sql and parameters selecting the highest scoring entry matching search_dict"
+        if "_id" in search_dict:
+            where, params = ["id = ?"], [str(search_dict["_id"])]
+        else:
+            where, params = ["uniprot_id = ?"], [search_dict["uniprot_id"]]
+        where, params = _source_filter(where, params, source_dbs)
+        sql = (f"SELECT {', '.join(columns)} FROM entries WHERE {' AND '.join(where)} "
+               "ORDER BY score DESC LIMIT 1")
+        return sql, params
+
+    def _find_best(self, conn, search_dict, source_dbs, field):
+        if field == "pdb_file":
+            names = ["_id", "hash"]
+        elif field in ("metadata", "raw", "raw_gzip"):
+            names = METADATA_FIELDS
+        else:
+            names = ["_id"] + ([field] if field in COLUMNS and field != "_id" else [])
+        sql, params = self._best_query(search_dict, source_dbs, [COLUMNS[n] for n in names])
+        row = conn.execute(sql, params).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(names, row))
+        if field == "pdb_file":
+            data = _blob_bytes(conn, entry["hash"])
+            value = None if data is None else data.decode()
+        elif field == "metadata":
+            value = entry_metadata(entry)
+        elif field == "raw":
+            value = (entry_metadata(entry), _blob_bytes(conn, entry["hash"]))
+        elif field == "raw_gzip":
+            value = (entry_metadata(entry), _blob_gzip(conn, entry["hash"]))
+        else:
+            value = entry.get(field)
+        return entry["_id"], value
+
+    def _find_best_batch(self, conn, uniprot_ids, source_dbs):
+        where, params = _source_filter(
+            [f"uniprot_id IN ({', '.join('?' * len(uniprot_ids))})"], list(uniprot_ids), source_dbs)
+        rows = conn.execute(
+            f"""SELECT uniprot_id, id, hash FROM (
+                  SELECT uniprot_id, id, hash,
+                         row_number() OVER (PARTITION BY uniprot_id ORDER BY score DESC) AS rank
+                  FROM entries WHERE {' AND '.join(where)})
+                WHERE rank = 1""", params).fetchall()
+        hashes = list({h for _, _, h in rows})
+        files = {h: gzip.decompress(data).decode() for h, data in conn.execute(
+            f"SELECT hash, data FROM blobs WHERE hash IN ({', '.join('?' * len(hashes))})", hashes)}
+        return {uniprot_id: (id, files[h]) for uniprot_id, id, h in rows if h in files}
+
+    def _sequence_query(self, sequence, source_dbs):
+        """Return the sql and parameters selecting the id of the highest scoring entry
+        containing sequence, at least KMER_LENGTH long, using the kmers table like storage/mongo.py
+        uses its kmers index"""
+        kmers = query_kmers(sequence)
+        candidates = (f"SELECT entry_id FROM kmers WHERE kmer IN ({', '.join('?' * len(kmers))}) "
+                      "GROUP BY entry_id HAVING count(*) = ?")
+        params = kmers + [len(kmers)]
+        where, params = _source_filter([f"id IN ({candidates})", "instr(sequence, ?) > 0"],
+                                       params + [sequence], source_dbs)
+        sql = f"SELECT id FROM entries WHERE {' AND '.join(where)} ORDER BY score DESC LIMIT 1"
+        return sql, params
+
+    def _find_by_sequence(self, conn, sequence, source_dbs, field):
+        row = conn.execute(*self._sequence_query(sequence, source_dbs)).fetchone()
+        if row is None:
+            return None
+        return self._find_best(conn, {"_id": row[0]}, None, field)
+
+    def _store(self, conn, info, pdb_file):
+        "Store an entry, returning its (id, status), the write lock must be held"
+        row = None
+        if info["uniprot_id"] != "":
+            row = conn.execute("SELECT id, hash FROM entries WHERE uniprot_id = ? AND source_db = ?",
+                               (info["uniprot_id"], info["source_db"])).fetchone()
+        if row is not None and row[1] == info["hash"]:
+            return row[0], "unchanged"
+        # add the blob before the entry that points at it
+        _put_blob(conn, info["hash"], pdb_file)
+        values = _entry_values(info)
+        if row is None:
+            entry_id = _new_id()
+            # storing counts as an access, as the entry is stored because a client asked for it,
+            # so it isn't the first to be evicted
+            values.update(access_count=1, last_access=values["stored_at"])
+            conn.execute(f"INSERT INTO entries (id, {', '.join(values)}) "
+                         f"VALUES (?{', ?' * len(values)})", [entry_id, *values.values()])
+            status = "inserted"
+        else:
+            entry_id = row[0]
+            # only the entry fields are set, the access stats are kept
+            conn.execute(f"UPDATE entries SET {', '.join(c + ' = ?' for c in values)} WHERE id = ?",
+                         [*values.values(), entry_id])
+            conn.execute("DELETE FROM kmers WHERE entry_id = ?", (entry_id,))
+            _release_blob(conn, row[1])
+            status = "updated"
+        conn.executemany("INSERT INTO kmers (kmer, entry_id) VALUES (?, ?)",
+                         [(kmer, entry_id) for kmer in info["kmers"]])
+        return entry_id, status
+
+    def _store_bulk(self, conn, infos, pdb_files):
+        results = []
+        for info, pdb_file in zip(infos, pdb_files):
+            conn.execute("SAVEPOINT store")
+            try:
+                entry_id, status = self._store(conn, info, pdb_file)
+                conn.execute("RELEASE store")
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO store")
+                conn.execute("RELEASE store")
+                print(f"Failed to store entry in cache: {e}")
+                entry_id, status = "", "error"
+            results.append({"id": entry_id, "status": status})
+        stored = sum(r["status"] in ("inserted", "updated") for r in results)
+        print(f"Bulk stored {stored} of {len(infos)} files")
+        return results
+
+    def _remove_entries(self, conn, entry_ids):
+        removed = []
+        for entry_id in entry_ids:
+            row = conn.execute("SELECT uniprot_id, hash FROM entries WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                continue
+            conn.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+            conn.execute("DELETE FROM kmers WHERE entry_id = ?", (entry_id,))
+            _release_blob(conn, row[1])
+            removed.append((entry_id, row[0]))
+        return removed
+
+
+def _new_id():
+    "Return a new entry id, 24 hex digits like a mongo ObjectId"
+    return secrets.token_hex(12)
+
+
+def _entry_values(info):
+    "Return the column values of an entry, in column order"
+    values = {c: info[c] for c in ["uniprot_id", "source_db", "score", "sequence",
+                                   "hash", "sequence_length", "size"]}
+    values["stored_at"] = info["stored_at"].timestamp()
+    return values
+
+
+def _source_filter(where, params, source_dbs):
+    "Restrict a query to the source_dbs list, if one is given"
+    if isinstance(source_dbs, list):
+        source_dbs = [x.upper() for x in source_dbs]
+        where = where + [f"source_db IN ({', '.join('?' * len(source_dbs))})"]
+        params = params + source_dbs
+    return where, params
+
+
+def _blob_bytes(conn, pdb_hash):
+    "Return the decompressed bytes stored under the hash, or None"
+    row = conn.execute("SELECT data FROM blobs WHERE hash = ?", (pdb_hash,)).fetchone()
+    if row is None:
+        return None
+    return gzip.decompress(row[0])
+
+
+def _blob_gzip(conn, pdb_hash):
+    "Return the gzip compressed bytes stored under the hash, or None"
+    row = conn.execute("SELECT data FROM blobs WHERE hash = ?", (pdb_hash,)).fetchone()
+    return None if row is None else row[0]
+
+
+def _put_blob(conn, pdb_hash, pdb_file):
+    "Add a reference to a blob, storing the file compressed if it is new"
+    if conn.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (pdb_hash,)).rowcount == 0:
+        data = pdb_file.encode()
+        conn.execute("INSERT INTO blobs (hash, data, encoding, size, refs) VALUES (?, ?, 'gzip', ?, 1)",
+                     (pdb_hash, gzip.compress(data, mtime=0), len(data)))
+
+
+def _release_blob(conn, pdb_hash):
+    "Remove a reference to a blob, deleting the blob when it is unreferenced"
+    conn.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (pdb_hash,))
+    conn.execute("DELETE FROM blobs WHERE hash = ? AND refs <= 0", (pdb_hash,))
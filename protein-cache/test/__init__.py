@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the cache's modules import each other from src, as they do when run with python src/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,50 @@
+import gzip
+import unittest
+import httpx
+from fastapi import FastAPI, Request
+from compression import DecompressRequestMiddleware, accepts_gzip
+
+
+class TestDecompressRequests(unittest.IsolatedAsyncioTestCase):
+    "Tests the middleware on an app returning the length of the body it receives"
+
+    async def asyncSetUp(self):
+        app = FastAPI()
+        app.add_middleware(DecompressRequestMiddleware, max_bytes=1000)
+
+        @app.post("/length/")
+        async def length(request: Request):
+            return {"length": len(await request.body())}
+
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://pc")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def post(self, body, **headers):
+        return await self.client.post("/length/", content=body, headers=headers)
+
+    async def test_bodies_are_decompressed(self):
+        r = await self.post(gzip.compress(b"a" * 1000), **{"Content-Encoding": "gzip"})
+        self.assertEqual((r.status_code, r.json()), (200, {"length": 1000}))
+        r = await self.post(b"a" * 2000)
+        self.assertEqual(r.json(), {"length": 2000}, "Expected uncompressed bodies to be passed on unchanged")
+
+    async def test_large_bodies_are_rejected(self):
+        r = await self.post(gzip.compress(b"a" * 1001), **{"Content-Encoding": "gzip"})
+        self.assertEqual(r.status_code, 413)
+
+    async def test_invalid_bodies_are_rejected(self):
+        r = await self.post(b"not gzip", **{"Content-Encoding": "gzip"})
+        self.assertEqual(r.status_code, 400)
+
+    def test_accepts_gzip(self):
+        for header, expected in [(None, False), ("", False), ("gzip", True), ("deflate, gzip", True),
+                                 ("br;q=1.0, gzip;q=0.8", True), ("gzip; q=0.5", True), ("*", True),
+                                 ("identity", False), ("gzip;q=0", False), ("gzip;q=x", False), ("*;q=0", False),
+                                 ("*;q=0, gzip", True), ("gzip;q=0, *", False), ("gzip;q=0, gzip;q=0.5", True)]:
+            self.assertEqual(accepts_gzip(header), expected, f"Wrong answer for Accept-Encoding: {header}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,221 @@
+import gzip
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+import db
+from storage.sqlite import SQLiteEngine
+
+
+def pdb_file(n):
+    return f"ATOM      1  CA  ALA A   1      {n:6.3f}   0.000   0.000  1.00 0.00           C\nEND\n"
+
+
+class TestCache(unittest.IsolatedAsyncioTestCase):
+    "Tests the cache rules through db.py, on an SQLite engine in a temporary directory"
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        await db.connect(SQLiteEngine(os.path.join(self.dir.name, "cache.sqlite3")))
+        db.hot_cache.clear()
+        db.access_tracker.clear()
+
+    async def asyncTearDown(self):
+        await db.close()
+        self.dir.cleanup()
+
+    async def test_store_and_get(self):
+        entry_id = await db.store_cache("p02070", pdb_file(1), "mvlsaadk", "pdb", 0.5)
+        self.assertNotEqual(entry_id, "")
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}), pdb_file(1))
+        self.assertEqual(await db.get_cache({"_id": entry_id}), pdb_file(1))
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}, field="_id"), entry_id)
+        self.assertIsNone(await db.get_cache({"uniprot_id": "P69905"}))
+        self.assertIsNone(await db.get_cache({"_id": "not an id"}))
+
+        metadata = await db.get_cache({"uniprot_id": "P02070"}, field="metadata")
+        self.assertEqual(metadata["db_id"], entry_id)
+        self.assertEqual(metadata["source_db"], "PDB")
+        self.assertEqual(metadata["sequence_length"], 8)
+        self.assertEqual(metadata["size"], len(pdb_file(1)))
+        raw_metadata, raw = await db.get_cache({"uniprot_id": "P02070"}, field="raw")
+        self.assertEqual(raw_metadata, metadata)
+        self.assertEqual(raw, pdb_file(1).encode())
+        gzip_metadata, compressed = await db.get_cache({"uniprot_id": "P02070"}, field="raw_gzip")
+        self.assertEqual(gzip_metadata, metadata)
+        self.assertEqual(gzip.decompress(compressed), pdb_file(1).encode())
+
+    async def test_store_rules(self):
+        first = await db.store_cache("P02070", pdb_file(1), "MVLS", "PDB", 0.5)
+        self.assertEqual(await db.store_cache("P02070", pdb_file(1), "MVLS", "PDB", 0.5), "",
+                         "Storing the same file again should change nothing")
+        self.assertTrue(await db.is_current("p02070", "pdb", db._entry_info("", pdb_file(1), "", "", 0)["hash"]))
+        hashes = [db._entry_info("", pdb_file(n), "", "", 0)["hash"] for n in (1, 2)]
+        self.assertEqual(await db.is_current_bulk([("p02070", "pdb", hashes[0]), ("P02070", "PDB", hashes[1]),
+                                                   ("P69905", "PDB", hashes[0]), ("", "PDB", hashes[0])]),
+                         [True, False, False, False])
+
+        # a different file from the same source replaces the entry, and is not served stale
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}), pdb_file(1))
+        self.assertEqual(await db.store_cache("P02070", pdb_file(2), "MVLS", "PDB", 0.5), first)
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}), pdb_file(2))
+        self.assertEqual(await db.engine.count(), 1)
+
+        # another source adds an entry, the highest scoring one is returned
+        await db.store_cache("P02070", pdb_file(3), "MVLS", "AlphaFoldDB", 0.9)
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}), pdb_file(3))
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}, ["pdb"]), pdb_file(2))
+
+        # entries without a uniprot id are always added
+        self.assertNotEqual(await db.store_cache("", pdb_file(4), "", "User Upload", 0), "")
+        self.assertNotEqual(await db.store_cache("", pdb_file(4), "", "User Upload", 0), "")
+        self.assertEqual(await db.engine.count(), 4)
+
+    async def test_files_are_shared_and_released(self):
+        await db.store_cache("A", pdb_file(1), "", "PDB", 0)
+        await db.store_cache("B", pdb_file(1), "", "PDB", 0)
+        await db.store_cache("A", pdb_file(2), "", "PDB", 0)
+        refs = await db.engine._read(lambda conn: conn.execute(
+            "SELECT size, refs FROM blobs ORDER BY refs").fetchall())
+        self.assertEqual([r[1] for r in refs], [1, 1], "Expected one reference to each file")
+        await db.store_cache("B", pdb_file(2), "", "PDB", 0)
+        blobs = await db.engine._read(lambda conn: conn.execute("SELECT refs FROM blobs").fetchall())
+        self.assertEqual(blobs, [(2,)], "Expected the unreferenced file to be deleted")
+
+    async def test_hot_cache_skips_results_invalidated_while_read(self):
+        await db.store_cache("P02070", pdb_file(1), "MVLS", "PDB", 0.5)
+        find_best = db.engine.find_best
+
+        async def find_best_then_store(*args, **kwargs):
+            found = await find_best(*args, **kwargs)
+            await db.store_cache("P02070", pdb_file(2), "MVLS", "PDB", 0.5)
+            return found
+
+        db.engine.find_best = find_best_then_store
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}), pdb_file(1))
+        db.engine.find_best = find_best
+        self.assertEqual(await db.get_cache({"uniprot_id": "P02070"}), pdb_file(2),
+                         "A result read before a store invalidated it should not be cached")
+
+    async def test_batch(self):
+        await db.store_cache("A", pdb_file(1), "", "PDB", 0.1)
+        await db.store_cache("A", pdb_file(2), "", "AlphaFoldDB", 0.2)
+        await db.store_cache("B", pdb_file(3), "", "PDB", 0.3)
+        # B is served from the hot cache, A and C from the engine
+        await db.get_cache({"uniprot_id": "B"})
+        results = [r async for r in db.get_cache_batch(["c", "a", "b"], chunk_size=2)]
+        self.assertEqual(results, [("C", None, None), ("A", pdb_file(2), None), ("B", pdb_file(3), None)])
+        results = [r async for r in db.get_cache_batch(["A"], ["PDB"])]
+        self.assertEqual(results, [("A", pdb_file(1), None)])
+
+    async def test_sequence_search(self):
+        await db.store_cache("A", pdb_file(1), "MVLSAADKGNVKAAW", "PDB", 0.1)
+        await db.store_cache("B", pdb_file(2), "GNVKAAWGKVGGHAA", "AlphaFoldDB", 0.2)
+        self.assertEqual(await db.get_cache_by_sequence("gnvkaaw"), pdb_file(2))
+        self.assertEqual(await db.get_cache_by_sequence("GNVKAAW", ["PDB"]), pdb_file(1))
+        self.assertEqual(await db.get_cache_by_sequence("SAADKGNV"), pdb_file(1))
+        # at the end of a sequence
+        self.assertEqual(await db.get_cache_by_sequence("GGHAA"), pdb_file(2))
+        self.assertIsNone(await db.get_cache_by_sequence("MVLSAADKGX"))
+        metadata = await db.get_cache_by_sequence("VGGHAA", field="metadata")
+        self.assertEqual(metadata["uniprot_id"], "B")
+        # shorter than a k-mer, which nearly every entry would match
+        with self.assertRaises(ValueError):
+            await db.get_cache_by_sequence("HAA")
+
+    async def test_bulk_store(self):
+        await db.store_cache("A", pdb_file(1), "", "PDB", 0)
+        results = await db.store_cache_bulk([
+            ("A", pdb_file(1), "", "PDB", 0),
+            ("A", pdb_file(2), "", "PDB", 0),
+            ("B", pdb_file(3), "", "PDB", 0),
+            ("B", pdb_file(3), "", "PDB", 0),
+        ])
+        self.assertEqual([r["status"] for r in results], ["unchanged", "updated", "inserted", "unchanged"])
+        self.assertEqual(results[2]["id"], results[3]["id"])
+        self.assertEqual(await db.get_cache({"uniprot_id": "A"}), pdb_file(2))
+
+    async def test_eviction(self):
+        # incompressible files, so each frees whole pages when removed
+        files = {id: os.urandom(16 * 1024).hex() for id in ["OLD", "A", "B", "C"]}
+        # stored a year ago and not read since
+        with mock.patch.object(db, "datetime", mock.Mock(now=lambda tz: datetime(2025, 1, 1, tzinfo=timezone.utc))):
+            await db.store_cache("OLD", files["OLD"], "", "PDB", 0)
+        for id in ["A", "B", "C"]:
+            await db.store_cache(id, files[id], "", "PDB", 0)
+        await db.get_cache({"uniprot_id": "A"})
+        await db.get_cache({"uniprot_id": "A"})
+        await db.get_cache({"uniprot_id": "B"})
+        report = await db.eviction_report()
+        # storing counts as an access
+        self.assertEqual([(e["uniprot_id"], e["access_count"]) for e in report["hottest"]],
+                         [("A", 3), ("B", 2), ("C", 1), ("OLD", 1)])
+
+        # C was just stored, so it outlives the stale entry
+        size = (await db.cache_size())["total_bytes"]
+        self.assertGreater(await db.evict_to_budget(size - 1, batch_size=1), 0)
+        self.assertIsNone(await db.get_cache({"uniprot_id": "OLD"}))
+        for id in ["A", "B", "C"]:
+            self.assertEqual(await db.get_cache({"uniprot_id": id}), files[id])
+        self.assertGreater(db.eviction_stats.stats()["evicted"], 0)
+
+    async def test_expiry(self):
+        await db.store_cache("A", pdb_file(1), "", "AlphaFoldDB", 0)
+        await db.store_cache("B", pdb_file(2), "", "PDB", 0)
+        await db.get_cache({"uniprot_id": "A"})
+        self.assertEqual(await db.expire_entries({"ALPHAFOLDDB": 3600}), 0)
+        self.assertEqual(await db.expire_entries({"ALPHAFOLDDB": -1}), 1)
+        self.assertIsNone(await db.get_cache({"uniprot_id": "A"}), "Expired entry served from the hot cache")
+        self.assertEqual(await db.get_cache({"uniprot_id": "B"}), pdb_file(2))
+
+    async def test_uniprot_metadata(self):
+        metadata = {"entries": [{"external_db_name": "PDB", "id": "1A00", "resolution": "2.0 A"}],
+                    "protein_metadata": {"sequence": "MVLS", "sequence_length": "4"}}
+        self.assertIsNone(await db.get_uniprot_metadata("P02070"))
+        await db.store_uniprot_metadata("p02070", metadata)
+        found, stored_at = await db.get_uniprot_metadata("P02070")
+        self.assertEqual(found, metadata)
+        self.assertIsNone(await db.get_uniprot_metadata("P02070", max_age=-1), "Metadata older than max_age returned")
+        self.assertIsNotNone(await db.get_uniprot_metadata("P02070", max_age=60))
+
+        await db.store_uniprot_metadata("P02070", {"entries": []})
+        self.assertEqual((await db.get_uniprot_metadata("P02070"))[0], {"entries": []}, "Metadata should be replaced")
+        self.assertEqual(await db.expire_uniprot_metadata(1), 0)
+        self.assertEqual(await db.expire_uniprot_metadata(-1), 1)
+        self.assertIsNone(await db.get_uniprot_metadata("P02070"))
+
+    async def test_tombstones(self):
+        await db.store_tombstone("a", ["PDB"], "no_structure", 60)
+        await db.store_tombstone("b", None, "unknown_id", 60)
+        await db.store_tombstone("c", ["PDB"], "no_structure", -1)
+        self.assertEqual(await db.get_tombstones(["A", "B", "C"], ["pdb"]), {"A": "no_structure", "B": "unknown_id"})
+        self.assertEqual(await db.get_tombstones(["A", "B"], ["AlphaFoldDB"]), {"B": "unknown_id"},
+                         "Tombstones should only apply to the source dbs they were stored for")
+        self.assertEqual(await db.get_tombstones(["A", "B"]), {"B": "unknown_id"})
+        results = [r async for r in db.get_cache_batch(["A", "B"], ["PDB"])]
+        self.assertEqual(results, [("A", None, "no_structure"), ("B", None, "unknown_id")])
+
+        self.assertEqual(await db.expire_tombstones(), 1)
+        await db.store_cache("A", pdb_file(1), "", "PDB", 0)
+        await db.store_cache_bulk([("B", pdb_file(2), "", "AlphaFoldDB", 0)])
+        self.assertEqual(await db.get_tombstones(["A", "B"], ["PDB"]), {},
+                         "Storing a file should remove the tombstones of its uniprot id")
+
+    async def test_clear_and_query_plans(self):
+        await db.store_cache("A", pdb_file(1), "MVLSAADK", "PDB", 0)
+        await db.store_uniprot_metadata("A", {"entries": []})
+        await db.store_tombstone("B", None, "unknown_id", 60)
+        plans = (await db.explain_queries("A", "MVLSAADK"))["plans"]
+        self.assertTrue(plans["retrieve_by_uniprot_id"]["index_covered"])
+        self.assertTrue(plans["retrieve_by_sequence"]["index_covered"])
+        self.assertNotIn("retrieve_by_sequence", (await db.explain_queries("A", "MVL"))["plans"])
+        await db.clear_cache()
+        self.assertIsNone(await db.get_cache({"uniprot_id": "A"}))
+        self.assertEqual(await db.engine.count(), 0)
+        self.assertIsNone(await db.get_uniprot_metadata("A"))
+        self.assertEqual(await db.get_tombstones(["B"]), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -87,6 +87,14 @@ class CalculationManager:
                 calculation.set_on_complete_callback(cls.attempt_start_calculation)
                 calculation.start() # Once the calculation is complete, it should as a callback attempt  to start another calculation, now a space is free
 
+    @classmethod
+    def state_counts(cls):
+        """ Count the calculations in the list in each state """
+        counts = {state: 0 for state in CalculationState}
+        for calculation in cls.calculations_list:
+            counts[calculation.status] += 1
+        return counts
+
     @classmethod
     def concurrent_calculations_count(cls):
         """ Count all alive calculation processes """
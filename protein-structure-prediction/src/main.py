@@ -1,10 +1,12 @@
 from fastapi import FastAPI, File, UploadFile
 from fastapi.responses import PlainTextResponse, RedirectResponse
 from .CalculationManager import CalculationManager
+from .metrics import MetricsMiddleware, metrics_response
 import logging
 
 logger = logging.getLogger(__name__)
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
 HOST = "0.0.0.0"
 PORT = 7000
 
@@ -16,6 +18,12 @@ def redirect_to_docs():
 def handle_404(_, __):
     return redirect_to_docs()
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """ Prometheus metrics: request latency per route, queue depth
+     and the number of calculations in each state. """
+    return metrics_response()
+
 @app.get("/list_calculations", response_class=PlainTextResponse)
 def list_calculations():
     """ Returns a list of all sequences which have been or are being processed,
@@ -0,0 +1,64 @@
+from prometheus_client import Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from fastapi.responses import Response
+from .CalculationManager import CalculationManager
+from .CalculationState import CalculationState
+import time
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, until the last byte of the response is sent",
+    ["method", "route", "status"])
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing requests to psp by route template, so requests for
+    different sequences share a series. Calculations only get queued or cancelled
+    while a request is served; they run in their own processes, untimed here."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(scope["method"],
+                                   route.path if route is not None else "unmatched",
+                                   status).observe(time.perf_counter() - start)
+
+
+class CalculationCollector:
+    "Reports the calculation queue from the CalculationManager when metrics are scraped"
+
+    def collect(self):
+        counts = CalculationManager.state_counts()
+        yield GaugeMetricFamily("psp_queue_depth", "Calculations waiting to start",
+                                value=counts[CalculationState.WAITING])
+        yield GaugeMetricFamily("psp_running_calculations", "Calculation processes alive",
+                                value=CalculationManager.concurrent_calculations_count())
+        by_state = GaugeMetricFamily("psp_calculations", "Calculations in the list by state",
+                                     labels=["state"])
+        for state, count in counts.items():
+            by_state.add_metric([str(state)], count)
+        yield by_state
+
+
+REGISTRY.register(CalculationCollector())
+
+
+def metrics_response():
+    "Return the current value of every metric in the prometheus text format"
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
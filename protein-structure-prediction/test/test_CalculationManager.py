@@ -2,6 +2,7 @@ import logging
 import unittest
 
 from src.CalculationManager import CalculationManager
+from src.CalculationState import CalculationState
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +12,11 @@ class TestCalculationManager(unittest.TestCase):
         logger.warning("Tests incomplete for PSP Container.")
         logger.warning("Tests incomplete for CalculationManager.")
         logger.warning("Tests incomplete for list_calculations.")
+
+    def test_state_counts(self):
+        counts = CalculationManager.state_counts()
+        self.assertEqual(set(counts), set(CalculationState), "Expected a count for every calculation state.")
+        self.assertEqual(sum(counts.values()), 0, "Counted calculations in an empty list.")
     
 if __name__ == "__main__":
     unittest.main()
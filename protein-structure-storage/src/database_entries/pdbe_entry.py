@@ -4,6 +4,7 @@ import re
 
 from .abstract_entry import ExternalDatabaseEntry
 from ..helpers import get_from_url
+from ..fetch_strategy import hedged, LatencyWindow
 from .weight_importer import import_weights
 
 logger = logging.getLogger(__name__)
@@ -28,19 +29,31 @@ def PDBe_link(id):
     return f"https://www.ebi.ac.uk/pdbe/entry-files/download/pdb{id}.ent"
 
 def RCSB_link(id):
-    return f"https://files.rcsb.org/download/{id}.pdb"
+    # compressed, a few times smaller to download than the .pdb
+    return f"https://files.rcsb.org/download/{id}.pdb.gz"
+
+# Mirrors a file is requested from, in order, and their recent latencies
+PDB_MIRRORS = [RCSB_link, PDBe_link]
+mirror_latencies = {mirror: LatencyWindow() for mirror in PDB_MIRRORS}
 
 class PDBeEntry(ExternalDatabaseEntry):
 
-    def fetch(self, backend_link=RCSB_link) -> str:
-        """ Fetch a .pdb file from PDBe database and return in string format. """
+    async def fetch(self, backend_link=None) -> str:
+        """ Fetch a .pdb file from PDBe database and return in string format.
+        By default the file is requested from the first of PDB_MIRRORS, and also
+        from the next if that fails or is slower than usual (see fetch_strategy.hedged),
+        returning whichever answers first. backend_link picks a single mirror. """
         pdb_id = self.extract_id()
-        pdb_file = get_from_url(backend_link(pdb_id))
-        if pdb_file is None:
-            logger.error("Failed to fetch pdb file, id: " + pdb_id)
-            return ""
-        else:
-            return pdb_file.decode()
+        mirrors = PDB_MIRRORS if backend_link is None else [backend_link]
+        pdb_file = await hedged([lambda mirror=mirror: self._fetch_from(mirror, pdb_id) for mirror in mirrors],
+                                [mirror_latencies.get(mirror) or LatencyWindow() for mirror in mirrors])
+        if pdb_file == "":
+            logger.error(f"Failed to fetch pdb file, id: {pdb_id}")
+        return pdb_file
+
+    async def _fetch_from(self, backend_link, pdb_id):
+        url = backend_link(pdb_id)
+        return (await get_from_url(url, gzipped=url.endswith(".gz"))).decode()
         
     def calculate_raw_quality_score(self) -> float:
         """ Calculate unweighted quality score for this entry """
@@ -0,0 +1,120 @@
+from math import e, log
+import logging
+import re
+import numpy as np
+
+from .pdbe_entry import PDBeEntry, pdbe_weights
+
+logger = logging.getLogger(__name__)
+
+# The patterns PDBeEntry's extract_resolution and extract_chain_length use
+RESOLUTION_RE = re.compile(r"^(\d+(?:\.?\d+)?) A$")
+CHAIN_RE = re.compile(r"[A-Z](?:/[A-Z]])?=(\d+)-(\d+)")
+NO_METADATA = {}
+
+
+def score_entries(entries):
+    """ Return an array of the quality scores of the entries, the same as their
+    get_quality_score(), also storing each one as the entry's quality_score.
+
+    PDBe entries, which proteins can have hundreds of, are scored together:
+    their resolution, method and chain spans are extracted into arrays and scored
+    in one vectorized pass with pdbe_weights. An entry with no method gets the
+    default method score (PDBeEntry.calculate_method_score can't score it).
+    Other entries are scored one at a time. """
+    scores = np.empty(len(entries))
+    pdbe = [i for i, entry in enumerate(entries) if isinstance(entry, PDBeEntry)]
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, PDBeEntry):
+            scores[i] = entry.get_quality_score()
+    if len(pdbe) > 0:
+        scores[pdbe] = _score_pdbe([entries[i].entry_data for i in pdbe])
+        for i in pdbe:
+            entries[i].quality_score = float(scores[i])
+    return scores
+
+
+def top_entries(entries, k):
+    """ Return the k highest scoring entries, best first, as the first k of
+    sorted(entries, reverse=True) would, without sorting all of them. """
+    if len(entries) == 0 or k <= 0:
+        return []
+    scores = score_entries(entries)
+    if k < len(entries):
+        # the k-th highest score, then every entry scoring at least that, so ties
+        # are ordered as the full sort orders them
+        threshold = np.partition(scores, len(entries) - k)[len(entries) - k]
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(entries))
+    # stable, so equal scores keep the order they were given in
+    best = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+    return [entries[i] for i in best]
+
+
+# --------------------------------------------------------
+# --------------- PRIVATE HELPER FUNCTIONS ---------------
+# --------------------------------------------------------
+
+
+def _score_pdbe(entry_data):
+    "PDBeEntry.calculate_raw_quality_score of each of the entry_data dicts, as an array"
+    resolution = np.array([_resolution(d.get("resolution", "")) for d in entry_data])
+    resolution_score = _resolution_score(resolution)
+
+    methods = np.array([(d.get("method") or "").lower() for d in entry_data])
+    unique_methods, method_index = np.unique(methods, return_inverse=True)
+    multipliers = pdbe_weights["method_multiplier"]
+    method_score = np.array([multipliers.get(m, multipliers["default"]) for m in unique_methods],
+                            dtype=float)[method_index]
+
+    # every span of every entry's chains, and which entry it belongs to
+    spans = [CHAIN_RE.findall(d.get("chains", "")) for d in entry_data]
+    owner = np.repeat(np.arange(len(spans)), [len(s) for s in spans])
+    ends = np.array([int(end) for s in spans for span in s for end in span], dtype=float).reshape(-1, 2)
+    chain_length = np.bincount(owner, weights=np.abs(ends[:, 1] - ends[:, 0]) + 1, minlength=len(spans))
+    chain_length[chain_length <= 0] = pdbe_weights["default_chain_length_score"]
+    # the entries of a protein usually share one protein_metadata dict, so each is only read once
+    metadata = [d.get("protein_metadata", NO_METADATA) for d in entry_data]
+    full_chain_lengths = {id(m): _full_chain_length(m) for m in {id(m): m for m in metadata}.values()}
+    full_chain_length = np.array([full_chain_lengths[id(m)] for m in metadata], dtype=float)
+    chain_score = np.full(len(entry_data), float(pdbe_weights["default_chain_length_score"]))
+    known = full_chain_length != 0
+    chain_score[known] = np.abs(chain_length[known]) / np.abs(full_chain_length[known])
+
+    avg_score = (pdbe_weights["resolution_multipler"] * resolution_score
+                 + pdbe_weights["method_score_multiplier"] * method_score
+                 + pdbe_weights["chain_length_multiplier"] * chain_score) / 3
+    return pdbe_weights["final_score_multiplier"] * avg_score
+
+
+def _resolution(resolution_string):
+    "PDBeEntry.extract_resolution of a resolution string"
+    match = RESOLUTION_RE.match(resolution_string)
+    if match is None:
+        return pdbe_weights["resolution"]["default"]
+    return float(match.group(1))
+
+
+def _resolution_score(resolution):
+    "PDBeEntry.calculate_resolution_score of an array of resolutions"
+    weights = pdbe_weights["resolution"]
+    a = weights["weight_at_1"]
+    if weights["interpolation"] == "linear":
+        return np.maximum(resolution * ((a - 1) / 1.0) + 1, 0)
+    if weights["interpolation"] == "exponential":
+        return np.power(e, log(a) * resolution)
+    logger.error(f"Failed to calculate resolution scores: weights table specifies invalid interpolation scheme \"{weights['interpolation']}\" for resolution.")
+    return np.full(len(resolution), float(weights["default"]))
+
+
+def _full_chain_length(protein_metadata):
+    "PDBeEntry.extract_full_chain_length of an entry's protein metadata"
+    string_chain_length = len(protein_metadata.get("sequence", ""))
+    try:
+        reported_chain_length = int(protein_metadata.get("sequence_length", 0))
+    except ValueError:
+        reported_chain_length = 0
+    if reported_chain_length != string_chain_length:
+        return max(reported_chain_length, string_chain_length, 0)
+    return reported_chain_length
@@ -0,0 +1,112 @@
+from collections import deque
+from .metrics import STRUCTURE_FETCHES, HEDGED_FETCHES
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the file of one entry before trying the next ranked entry,
+# and the most entries tried per miss
+FETCH_ATTEMPT_SECONDS = float(os.environ.get("FETCH_ATTEMPT_SECONDS", 15))
+FETCH_MAX_ATTEMPTS = int(os.environ.get("FETCH_MAX_ATTEMPTS", 3))
+# Percentile of a mirror's recent latencies after which the next mirror is also asked,
+# and the delay used until HEDGE_MIN_SAMPLES latencies have been seen
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 95))
+HEDGE_DEFAULT_SECONDS = float(os.environ.get("HEDGE_DEFAULT_SECONDS", 1))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+
+
+class LatencyWindow:
+    "The latencies of the most recent `size` successful requests to one upstream"
+
+    def __init__(self, size=500):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p=HEDGE_PERCENTILE, default=HEDGE_DEFAULT_SECONDS, min_samples=HEDGE_MIN_SAMPLES):
+        "Return the p-th percentile of the latencies, or default if there are fewer than min_samples"
+        if len(self.samples) < min_samples:
+            return default
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def fetch_ranked(entries, attempt_seconds=None, max_attempts=None):
+    """Fetch the file of the first of the ranked entries that has one, moving on to the
+    next entry if a fetch fails, returns a blank file or takes longer than attempt_seconds,
+    trying at most max_attempts entries.
+    Returns (entry, file), or (None, "") if none of them could be fetched."""
+    attempt_seconds = FETCH_ATTEMPT_SECONDS if attempt_seconds is None else attempt_seconds
+    max_attempts = FETCH_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    for entry in entries[:max_attempts]:
+        source_db = entry.get_entry_data("external_db_name").upper()
+        try:
+            async with asyncio.timeout(attempt_seconds):
+                protein_file = await entry.fetch()
+        except TimeoutError:
+            STRUCTURE_FETCHES.labels(source_db, "timeout").inc()
+            logger.warning(f"Fetch timed out after {attempt_seconds}s, trying the next entry. entry: {entry.entry_data.get('id')}")
+            continue
+        except Exception as e:
+            STRUCTURE_FETCHES.labels(source_db, "error").inc()
+            logger.error(f"Fetch failed, trying the next entry. entry: {entry.entry_data.get('id')} - {e}")
+            continue
+        if protein_file == "":
+            STRUCTURE_FETCHES.labels(source_db, "empty").inc()
+            logger.warning(f"Fetch returned no file, trying the next entry. entry: {entry.entry_data.get('id')}")
+            continue
+        STRUCTURE_FETCHES.labels(source_db, "ok").inc()
+        return entry, protein_file
+    return None, ""
+
+
+async def hedged(fetches, latencies):
+    """Return the first non-blank result of the coroutine functions in fetches, such as
+    requests for the same file from different mirrors, or "" if they all fail.
+    Each is started once the one before it has failed, or has taken longer than
+    the HEDGE_PERCENTILE of its latencies (a LatencyWindow each in latencies).
+    The rest are cancelled as soon as one succeeds."""
+    running = {}  # task: index in fetches
+    next_fetch = 0
+    try:
+        while next_fetch < len(fetches) or len(running) > 0:
+            if next_fetch < len(fetches):
+                task = asyncio.ensure_future(_timed(fetches[next_fetch], latencies[next_fetch]))
+                running[task] = next_fetch
+                next_fetch += 1
+                if next_fetch > 1:
+                    HEDGED_FETCHES.labels("sent").inc()
+            # wait for the newest request's usual latency before asking the next mirror
+            delay = latencies[next_fetch - 1].percentile() if next_fetch < len(fetches) else None
+            done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = running.pop(task)
+                if task.exception() is not None:
+                    logger.error(f"Hedged fetch failed: {task.exception()}")
+                elif task.result() != "":
+                    if index > 0:
+                        HEDGED_FETCHES.labels("won").inc()
+                    return task.result()
+        return ""
+    finally:
+        for task in running:
+            task.cancel()
+
+
+async def _timed(fetch, latencies):
+    """Run fetch(), adding its latency to latencies if it returns a file.
+    If it is cancelled the time it ran for is added, as its latency is at least that,
+    so the window doesn't only see the requests fast enough not to be cancelled."""
+    start = time.perf_counter()
+    try:
+        result = await fetch()
+    except asyncio.CancelledError:
+        latencies.add(time.perf_counter() - start)
+        raise
+    if result != "":
+        latencies.add(time.perf_counter() - start)
+    return result
@@ -1,6 +1,22 @@
-from urllib.request import urlopen
-from urllib.error import HTTPError, URLError
-from http.client import InvalidURL
+from contextlib import aclosing
+from fastapi.middleware.gzip import GZipMiddleware
+from io import RawIOBase
+from starlette.datastructures import Headers
+from . import http_client
+from .metrics import upstream_request
+import asyncio
+import gzip
+import httpx
+import json
+import os
+import zipfile
+import zlib
+
+# Compression level of what pss gzips itself: files sent to clients that weren't
+# already compressed in the cache, and the files it sends to the cache
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+# Headers of a request with a gzip compressed json body, see gzip_json
+GZIP_JSON_HEADERS = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
 
 
 def print_except(url, info, e):
@@ -9,31 +25,100 @@ def print_except(url, info, e):
           " --- Exception: ", e)
 
     
-def get_from_url(url):
-    "Tries to request data from a url, return None on failure"
+# Statuses meaning the server doesn't have what the url asks for, rather than failing
+NOT_FOUND_STATUSES = (400, 404, 410)
+
+
+async def get_from_url(url, not_found=None, gzipped=False):
+    """Tries to request data from a url, return a blank bytearray on failure.
+    If not_found is given it is returned instead when the server answers
+    with one of NOT_FOUND_STATUSES, so callers can tell the two apart.
+    If gzipped the url is of a gzip file, such as a .pdb.gz, which is returned decompressed.
+    Goes through the shared pooled client, so connections are reused."""
     if not isinstance(url, str):
         print("the supplied url was not a string")
     else:
-        try:
-            f = urlopen(url)
-            if f.getcode() != 200:
-                print(f"http status code: {f.getcode()}, uniprot id"
-                      " was invalid, id: {uniprot_id}")
-            else:
-                return f.read()
-        except HTTPError as e:
-            print_except(url, "internet connection issue", e)
-        except URLError as e:
-            print_except(url, "url error", e)
-        except InvalidURL as e:
-            print_except(url, "invalid url string", e)
-        except UnicodeEncodeError as e:
-            print_except(url, "invalid character in url", e)
-        except Exception as e:
-            print_except(url, "unknown exeption", e)
+        with upstream_request(url) as request:
+            try:
+                r = await http_client.get_client().get(url)
+                if not_found is not None and r.status_code in NOT_FOUND_STATUSES:
+                    print(f"http status code: {r.status_code}, not found, url: {url}")
+                    return not_found
+                if r.status_code != 200:
+                    print(f"http status code: {r.status_code}, url"
+                          f" was invalid, url: {url}")
+                elif gzipped:
+                    return _gunzip(r.content)
+                else:
+                    return r.content
+            except httpx.TimeoutException as e:
+                print_except(url, "timed out", e)
+            except httpx.TransportError as e:
+                print_except(url, "internet connection issue", e)
+            except httpx.InvalidURL as e:
+                print_except(url, "invalid url string", e)
+            except (gzip.BadGzipFile, zlib.error, EOFError) as e:
+                print_except(url, "invalid gzip file", e)
+            except Exception as e:
+                print_except(url, "unknown exeption", e)
+            request.failed()
     return bytearray()
 
 
+def accepts_gzip(accept_encoding):
+    """Return True if an Accept-Encoding header value accepts gzip,
+    e.g. "gzip, deflate" or "*;q=0, gzip" but not "gzip;q=0" or a missing header.
+    A gzip coding takes precedence over *, and the highest q of a coding given twice wins."""
+    if accept_encoding is None:
+        return False
+    qualities = {}
+    for coding in accept_encoding.lower().split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip()
+        if name not in ("gzip", "*"):
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = max(quality, qualities.get(name, 0.0))
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+class AcceptsGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that only compresses the responses of clients accepts_gzip says accept gzip,
+    as the file routes decide, rather than of any client whose Accept-Encoding mentions gzip"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not accepts_gzip(Headers(scope=scope).get("accept-encoding")):
+            return await self.app(scope, receive, send)
+        await super().__call__(scope, receive, send)
+
+
+async def gzip_json(data):
+    """Return data as gzip compressed json, to send with GZIP_JSON_HEADERS.
+    Compressed in a thread, so large batches of files don't block the event loop."""
+    return await asyncio.to_thread(lambda: gzip.compress(json.dumps(data).encode(), GZIP_LEVEL))
+
+
+async def gzip_stream(chunks):
+    """
+    Take an async iterable of bytes and yield them gzip compressed as they arrive,
+    closing it when done or when the stream is closed early
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if len(compressed) > 0:
+                yield compressed
+    yield compressor.flush()
+
+
 def query_list_path(key, items, initial="?"):
     """
     Take a key string and items a list of strings.
@@ -49,3 +134,62 @@ def query_list_path(key, items, initial="?"):
     for x in items:
         query += key + "=" + x + "&"
     return query[0:-1]
+
+
+async def ndjson_stream(results):
+    """
+    Take an async iterable of (uniprot_id, pdb_file) tuples, where pdb_file
+    is "" if none was found, and yield a line of json for each
+    """
+    async for uniprot_id, pdb_file in results:
+        yield json.dumps({"uniprot_id": uniprot_id,
+                          "present": pdb_file != "",
+                          "pdb_file": pdb_file}) + "\n"
+
+
+async def zip_stream(results):
+    """
+    Take an async iterable of (uniprot_id, pdb_file) tuples and yield the bytes
+    of a zip archive with a {uniprot_id}.pdb file for each one that was found,
+    writing each file as it arrives rather than building the archive in memory.
+    The ids with no file are listed in missing.txt
+    """
+    buffer = _StreamBuffer()
+    missing = []
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        async for uniprot_id, pdb_file in results:
+            if pdb_file == "":
+                missing.append(uniprot_id)
+                continue
+            archive.writestr(f"{uniprot_id}.pdb", pdb_file)
+            yield buffer.drain()
+        if len(missing) > 0:
+            archive.writestr("missing.txt", "\n".join(missing) + "\n")
+    yield buffer.drain()
+
+
+def _gunzip(data):
+    """Decompress a downloaded gzip file. Servers sending it with Content-Encoding: gzip
+    have already had it decompressed by the client, so it is returned as it is."""
+    if data[:2] != b"\x1f\x8b":
+        return data
+    return gzip.decompress(data)
+
+
+class _StreamBuffer(RawIOBase):
+    "Unseekable file that keeps what is written until it is drained"
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
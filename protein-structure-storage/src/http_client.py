@@ -0,0 +1,142 @@
+from contextvars import ContextVar
+import asyncio
+import os
+import time
+import weakref
+import httpx
+
+# Seconds to wait to connect to a host, and between bytes of a response
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+# Seconds to wait for a free connection before giving up on a request
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", 30))
+# Connections kept in the pool across all hosts, and kept open while idle
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 200))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 50))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+# Requests in flight to any one host, so a slow host can't take every connection.
+# Over HTTP/1.1 each is a connection, over HTTP/2 they share one.
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", 100))
+
+
+def create_client(verify=True):
+    """Return a pooled async client, reusing connections (and their TLS sessions)
+    across requests, using HTTP/2 with the hosts that support it."""
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        verify=verify,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY))
+    return httpx.AsyncClient(
+        transport=_HostLimitedTransport(transport, HTTP_MAX_CONNECTIONS_PER_HOST),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+        follow_redirects=True)
+
+
+def get_client():
+    """Return the pooled client of the running event loop, creating it on first use.
+    Connections belong to the loop that opened them, so each loop has its own client;
+    the service runs one loop, so shares one client."""
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = create_client()
+    return _clients[loop]
+
+
+async def close_client():
+    "Close the client of the running event loop, if it has one"
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class RateLimiter:
+    """Spaces out the requests to each host with a rate, in requests per second,
+    so they start at most that often. Hosts without a rate aren't limited.
+    A request waiting for its turn holds it, so ones started together go out one
+    after another rather than in bursts."""
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.next_free = {}  # host: time the next request to it may start
+
+    async def wait(self, host):
+        "Wait until a request to host may start"
+        rate = self.rates.get(host)
+        if rate is None or rate <= 0:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_free.get(host, now))
+        self.next_free[host] = start + 1 / rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class _HostLimitedTransport(httpx.AsyncBaseTransport):
+    """Wraps a transport to allow at most per_host requests in flight to each host.
+    A request holds its slot until its response is closed, so streamed
+    responses count until they have been read.
+    Requests made while a RateLimiter is set in rate_limiter also wait for their turn."""
+
+    def __init__(self, transport, per_host):
+        self.transport = transport
+        self.per_host = per_host
+        self.slots = {}
+
+    async def handle_async_request(self, request):
+        limiter = rate_limiter.get()
+        if limiter is not None:
+            await limiter.wait(request.url.host)
+        slot = self._slot(request.url.host)
+        try:
+            # not asyncio.wait_for, which can swallow a cancellation arriving as the slot is acquired
+            async with asyncio.timeout(HTTP_POOL_TIMEOUT):
+                await slot.acquire()
+        except TimeoutError:
+            raise httpx.PoolTimeout(f"No free connection to {request.url.host}", request=request)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            slot.release()
+            raise
+        return httpx.Response(status_code=response.status_code,
+                              headers=response.headers,
+                              stream=_ReleasingStream(response.stream, slot),
+                              extensions=response.extensions)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def _slot(self, host):
+        if host not in self.slots:
+            self.slots[host] = asyncio.BoundedSemaphore(self.per_host)
+        return self.slots[host]
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    "Response body that gives back its host slot once closed"
+
+    def __init__(self, stream, slot):
+        self.stream = stream
+        self.slot = slot
+        self.released = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.slot.release()
+
+
+# The clients every outbound request of pss goes through, by event loop (see get_client)
+_clients = weakref.WeakKeyDictionary()
+# The RateLimiter of the requests made by the current task and the tasks it starts,
+# e.g. a warm-up job's, so only they are limited
+rate_limiter = ContextVar("rate_limiter", default=None)
@@ -1,17 +1,47 @@
-from fastapi import FastAPI, File, UploadFile, Query
-from fastapi.responses import PlainTextResponse, RedirectResponse
-from typing import Annotated
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, UploadFile, Query, Header, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse, Response
+from typing import Annotated, Literal
 import logging
+import os
 from .database_entries import afdb_entry
-from .pss import get_pdb_file, get_pdb_file_by_sequence, get_pdb_file_by_db_id, get_db_id_by_uniprot_id, upload_pdb_file, CACHE_CONTAINER_URL
+from .pss import stream_pdb_file, get_pdb_files, stream_pdb_file_by_sequence, stream_pdb_file_by_db_id, get_db_id_by_uniprot_id, upload_pdb_file, upload_queue, uniprot_metadata, CACHE_CONTAINER_URL
+from .pss import get_file_hash_by_uniprot_id, get_metadata_by_sequence, get_metadata_by_db_id
 from .uniprot import ALPHAFOLD_DB_NAME
-from .helpers import get_from_url
+from .helpers import get_from_url, ndjson_stream, zip_stream, accepts_gzip, AcceptsGZipMiddleware, GZIP_LEVEL
+from .http_client import close_client
+from .metrics import MetricsMiddleware, metrics_response, register_upload_queue
+from .warmup import WarmupJobs, WARMUP_CONCURRENCY, id_list_path
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # send the files left in the upload queue when the service last stopped
+    upload_queue.start()
+    # carry on with the warm-up jobs that were running when the service last stopped
+    warmup_jobs.resume_interrupted()
+    yield
+    # before the upload queue, so the files the jobs fetched last are sent or spilled
+    await warmup_jobs.close()
+    await upload_queue.close()
+    await close_client()
+
+app = FastAPI(lifespan=lifespan)
+# compresses the responses of clients that accept gzip, except files that are already
+# compressed (see text_stream) and zip archives
+app.add_middleware(AcceptsGZipMiddleware, compresslevel=GZIP_LEVEL)
+app.add_middleware(MetricsMiddleware)
+register_upload_queue(upload_queue)
+warmup_jobs = WarmupJobs()
 HOST = "0.0.0.0"
 PORT = 5000
+# Cache-Control of the files returned, e.g. "public, max-age=86400" to let a proxy or CDN
+# in front of pss answer repeat requests itself. By default they may be stored,
+# but are revalidated with their ETag before being reused.
+STRUCTURE_CACHE_CONTROL = os.environ.get("STRUCTURE_CACHE_CONTROL", "no-cache")
 
 @app.get("/", include_in_schema=False)
 def redirect_to_docs():
@@ -21,47 +51,211 @@ def redirect_to_docs():
 def handle_404(_, __):
     return redirect_to_docs()
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus metrics: request latency per route, cache hits and misses,
+    and the latency and errors of requests to other services."""
+    return metrics_response()
+
+
+def text_stream(stream, encoding=None):
+    """Stream the bytes of a file (a pss.FileStream) back as plain text,
+    with encoding as its Content-Encoding if they are compressed"""
+    headers = file_headers(stream.hash, encoding)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(stream, media_type="text/plain; charset=utf-8", headers=headers)
+
+
+def file_headers(pdb_hash, encoding=None):
+    """Return the caching headers of the file with pdb_hash, or of a blank file if it is None.
+    The ETag is the hash of the file, weak when it is compressed, as the compressed
+    bytes of a file aren't always the same."""
+    headers = {"Vary": "Accept-Encoding"}
+    if pdb_hash is not None:
+        headers["ETag"] = ("W/" if encoding is not None else "") + f'"{pdb_hash}"'
+        headers["Cache-Control"] = STRUCTURE_CACHE_CONTROL
+    return headers
+
+
+def etag_matches(if_none_match, pdb_hash):
+    """Return True if an If-None-Match header value matches the ETag
+    of the file with pdb_hash, comparing weakly as GET requests do"""
+    if if_none_match is None or pdb_hash in (None, ""):
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or f'"{pdb_hash}"' in tags
+
+
+def not_modified(pdb_hash, encoding=None):
+    return Response(status_code=304, headers=file_headers(pdb_hash, encoding))
+
+
+def metadata_hash(metadata):
+    "Return the file hash in cache metadata from pss, or \"\" if there is no file"
+    return "" if metadata == "" else metadata["hash"]
+
+
+def file_encoding(accept_encoding):
+    """Return the encoding to send a file in for an Accept-Encoding header:
+    gzip if the client accepts it, so files the cache stores compressed
+    are sent on without decompressing them, otherwise None"""
+    return "gzip" if accepts_gzip(accept_encoding) else None
+
+
 @app.get("/retrieve_by_uniprot_id/{id}", response_class=PlainTextResponse)
-def retrieve_by_uniprot_id(id: str, alphafold_only: bool = False, override_cache: bool = False,
-                           db: Annotated[list[str] | None, Query()] = None):
+async def retrieve_by_uniprot_id(id: str, alphafold_only: bool = False, override_cache: bool = False,
+                                 db: Annotated[list[str] | None, Query()] = None,
+                                 accept_encoding: Annotated[str | None, Header()] = None,
+                                 if_none_match: Annotated[str | None, Header()] = None):
     """Retrieves pdb file given the uniprot id for that protein structure.
     Tries to retrieve from cache first; If not present, finds the highest scoring file
     from uniprot and adds it to the cache before returning it.
     If the optional parameter alphafold_only == True then returns
-    only the alphafold predicted entry"""
+    only the alphafold predicted entry.
+    Files have their hash as ETag; if it matches If-None-Match, 304 is returned
+    after looking up only the metadata of the file in the cache."""
     if alphafold_only:
-        return get_pdb_file(id, override_cache, source_dbs=[ALPHAFOLD_DB_NAME])
-    else:
-        return get_pdb_file(id, override_cache, source_dbs=db)
+        db = [ALPHAFOLD_DB_NAME]
+    encoding = file_encoding(accept_encoding)
+    if if_none_match is not None and not override_cache:
+        pdb_hash = await get_file_hash_by_uniprot_id(id, db)
+        if etag_matches(if_none_match, pdb_hash):
+            return not_modified(pdb_hash, encoding)
+    return text_stream(await stream_pdb_file(id, override_cache, source_dbs=db, encoding=encoding), encoding)
+
+
+@app.post("/retrieve_by_uniprot_ids/")
+async def retrieve_by_uniprot_ids(ids: list[str], db: Annotated[list[str] | None, Query()] = None,
+                                  format: Literal["ndjson", "zip"] = "ndjson"):
+    """Retrieves the pdb files for a json list of uniprot ids.
+    All ids are looked up in the cache at once, ids not in the cache are fetched
+    from uniprot and added to the cache like retrieve_by_uniprot_id.
+    Files are streamed back as they are found, either as newline delimited json
+    with a {"uniprot_id", "present", "pdb_file"} object per id,
+    or as a zip archive of {uniprot_id}.pdb files."""
+    results = get_pdb_files(ids, source_dbs=db)
+    if format == "zip":
+        return StreamingResponse(zip_stream(results), media_type="application/zip",
+                                 headers={"Content-Disposition": "attachment; filename=pdb_files.zip"})
+    return StreamingResponse(ndjson_stream(results), media_type="application/x-ndjson")
 
 
 @app.get("/retrieve_by_sequence/{seq}", response_class=PlainTextResponse)
-def retrieve_by_sequence(seq: str, db: Annotated[list[str] | None, Query()] = None):
+async def retrieve_by_sequence(seq: str, db: Annotated[list[str] | None, Query()] = None,
+                               accept_encoding: Annotated[str | None, Header()] = None,
+                               if_none_match: Annotated[str | None, Header()] = None):
     """Retrieves pdb file given a part of the sequence for a protein structure.
     Pulls only from cache"""
-    return get_pdb_file_by_sequence(seq, db)
+    encoding = file_encoding(accept_encoding)
+    if if_none_match is not None:
+        pdb_hash = metadata_hash(await get_metadata_by_sequence(seq, db))
+        if etag_matches(if_none_match, pdb_hash):
+            return not_modified(pdb_hash, encoding)
+    return text_stream(await stream_pdb_file_by_sequence(seq, db, encoding=encoding), encoding)
 
 
 @app.get("/retrieve_by_key/{key}", response_class=PlainTextResponse)
-def retrieve_by_key(key: str):
+async def retrieve_by_key(key: str, accept_encoding: Annotated[str | None, Header()] = None,
+                          if_none_match: Annotated[str | None, Header()] = None):
     """Retrieves pdb file from cache using its unique key in the cache."""
-    return get_pdb_file_by_db_id(key)
+    encoding = file_encoding(accept_encoding)
+    if if_none_match is not None:
+        pdb_hash = metadata_hash(await get_metadata_by_db_id(key))
+        if etag_matches(if_none_match, pdb_hash):
+            return not_modified(pdb_hash, encoding)
+    return text_stream(await stream_pdb_file_by_db_id(key, encoding=encoding), encoding)
 
 
 @app.get("/retrieve_key_by_uniprot_id/{id}", response_class=PlainTextResponse)
-def retrieve_key_by_uniprot_id(id: str, db: Annotated[list[str] | None, Query()] = None):
+async def retrieve_key_by_uniprot_id(id: str, db: Annotated[list[str] | None, Query()] = None):
     """Retrieve unique cache key using the uniprot id for a protein structure."""
-    return get_db_id_by_uniprot_id(id, db)
+    return await get_db_id_by_uniprot_id(id, db)
 
 
 @app.post("/upload_pdb/", response_class=PlainTextResponse)
 async def upload_pdb(file: UploadFile, id: str = "", db: str = "User Upload",
                      sequence: str = "", score: float = 0):
     """Allows user to upload a pdb file into the cache"""
-    return upload_pdb_file(file.file.read().decode('utf-8'), db, id, sequence, score)
+    return await upload_pdb_file((await file.read()).decode('utf-8'), db, id, sequence, score)
+
+
+@app.get("/admin/upload_queue/")
+async def upload_queue_status():
+    """Returns the state of the queue of fetched files waiting to be stored in the cache:
+    the files (and bytes) waiting in memory and spilled to disk, the lag in seconds of the oldest,
+    and the count of files uploaded, unchanged, failed, dropped and spilled so far."""
+    return upload_queue.stats()
+
+
+@app.post("/admin/warmup/")
+async def start_warmup(file: UploadFile | None = None, path: str | None = None,
+                       db: Annotated[list[str] | None, Query()] = None,
+                       concurrency: int = WARMUP_CONCURRENCY):
+    """Starts a job warming the cache with the pdb files of a list of uniprot ids,
+    one per line, either uploaded as file or read from path in WARMUP_ID_LIST_DIR on the pss host.
+    Ids are resolved like retrieve_by_uniprot_id, concurrency at a time, with the
+    requests to each external database rate limited. Ids the cache already has a file
+    for are skipped without reading the file. Progress is checkpointed, so a job
+    interrupted by a restart carries on where it stopped. Returns the job's status."""
+    if (file is None) == (path is None):
+        raise HTTPException(400, "Give the id list either as file or as path")
+    if concurrency < 1:
+        raise HTTPException(400, "concurrency must be at least 1")
+    if file is not None:
+        ids_file = file.file
+    else:
+        try:
+            ids_file = open(id_list_path(path), "rb")
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        except OSError as e:
+            raise HTTPException(400, f"Can't read the id list: {e}")
+    with ids_file:
+        return await warmup_jobs.create(ids_file, db, concurrency)
+
+
+@app.get("/admin/warmup/")
+async def warmup_statuses():
+    """Returns the status of every warm-up job, oldest first"""
+    return warmup_jobs.statuses()
+
+
+@app.get("/admin/warmup/{job_id}")
+async def warmup_status(job_id: str):
+    """Returns the status of a warm-up job: its state (running, paused, interrupted,
+    failed, cancelled or finished), the ids done (fetched), skipped (already cached),
+    failed and remaining, the ids resolved per second and the seconds left at that rate."""
+    return warmup_response(warmup_jobs.status(job_id))
+
+
+@app.post("/admin/warmup/{job_id}/pause")
+async def pause_warmup(job_id: str):
+    """Stops a warm-up job at its checkpoint until it is resumed"""
+    return warmup_response(await warmup_jobs.pause(job_id))
+
+
+@app.post("/admin/warmup/{job_id}/resume")
+async def resume_warmup(job_id: str):
+    """Carries on with a paused, interrupted or failed warm-up job from its checkpoint"""
+    return warmup_response(await warmup_jobs.resume(job_id))
+
+
+@app.post("/admin/warmup/{job_id}/cancel")
+async def cancel_warmup(job_id: str):
+    """Stops a warm-up job for good, keeping its status"""
+    return warmup_response(await warmup_jobs.cancel(job_id))
+
+
+def warmup_response(status):
+    # not an HTTPException, which the 404 handler would redirect to the docs
+    if status is None:
+        return JSONResponse({"detail": "No such warm-up job"}, status_code=404)
+    return status
 
 
 @app.get("/clear_cache/")
-def clear_cache_database():
-    get_from_url(CACHE_CONTAINER_URL + "/clear_cache/")
+async def clear_cache_database():
+    await get_from_url(CACHE_CONTAINER_URL + "/clear_cache/")
+    uniprot_metadata.clear()
     return
@@ -0,0 +1,148 @@
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from fastapi.responses import Response
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import time
+
+# A miss can wait on several upstream fetches of up to HTTP_READ_TIMEOUT (30s) each,
+# well past the default last bucket of 10s
+REQUEST_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, until the last byte of the response is sent",
+    ["method", "route", "status"],
+    buckets=REQUEST_LATENCY_BUCKETS)
+CACHE_LOOKUPS = Counter(
+    "pss_cache_lookups_total",
+    "Lookups in the protein cache, by result (hit, miss, tombstone or error)",
+    ["result"])
+UPSTREAM_LATENCY = Histogram(
+    "pss_upstream_request_duration_seconds",
+    "Time taken by requests to other services (uniprot, rcsb, afdb, the cache)",
+    ["host"])
+UPSTREAM_ERRORS = Counter(
+    "pss_upstream_request_errors_total",
+    "Requests to other services that failed",
+    ["host"])
+UNIPROT_METADATA_LOOKUPS = Counter(
+    "pss_uniprot_metadata_lookups_total",
+    "Lookups of parsed uniprot metadata, by where it was found (memory, cache) or miss",
+    ["result"])
+STRUCTURE_FETCHES = Counter(
+    "pss_structure_fetches_total",
+    "Attempts at fetching the file of a ranked entry on a miss, by source database "
+    "and result (ok, empty, timeout or error); all but ok move on to the next entry",
+    ["source_db", "result"])
+HEDGED_FETCHES = Counter(
+    "pss_hedged_fetches_total",
+    "Requests to a further mirror made by hedged fetches (sent), and those that answered first (won)",
+    ["result"])
+COALESCED_MISSES = Counter(
+    "pss_coalesced_misses_total",
+    "Cache misses that shared a resolution already running for the same id, "
+    "by where it ran (process, or host for another worker process)",
+    ["scope"])
+WARMUP_IDS = Counter(
+    "pss_warmup_ids_total",
+    "Ids resolved by cache warm-up jobs, by status (done, skipped as already cached, or failed)",
+    ["status"])
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing requests to pss by route template, so
+    /retrieve_by_uniprot_id/P02070 and /retrieve_by_uniprot_id/P69905 share a series.
+    Requests that match no route are redirected to /docs and labelled "unmatched"."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(scope["method"],
+                                   route.path if route is not None else "unmatched",
+                                   status).observe(time.perf_counter() - start)
+
+
+class UploadQueueCollector:
+    "Exposes the state of the cache upload queue, read when metrics are scraped"
+
+    def __init__(self, upload_queue):
+        self.upload_queue = upload_queue
+
+    def collect(self):
+        stats = self.upload_queue.stats()
+        depth = GaugeMetricFamily("pss_upload_queue_depth", "Files waiting to be stored in the cache",
+                                  labels=["where"])
+        depth.add_metric(["memory"], stats["pending"])
+        depth.add_metric(["spilling"], stats["spilling"])
+        depth.add_metric(["disk"], stats["spilled_pending"])
+        yield depth
+        size = GaugeMetricFamily("pss_upload_queue_bytes", "Bytes of files waiting to be stored in the cache",
+                                 labels=["where"])
+        size.add_metric(["memory"], stats["pending_bytes"])
+        size.add_metric(["spilling"], stats["spilling_bytes"])
+        size.add_metric(["disk"], stats["spilled_bytes"])
+        yield size
+        yield GaugeMetricFamily("pss_upload_queue_lag_seconds",
+                                "Age of the oldest file waiting in memory to be stored in the cache",
+                                value=stats["lag_seconds"])
+        files = CounterMetricFamily("pss_upload_queue_files", "Files taken off the upload queue, by result",
+                                    labels=["result"])
+        for result in ["uploaded", "unchanged", "failed", "dropped", "spilled"]:
+            files.add_metric([result], stats[result])
+        yield files
+        yield CounterMetricFamily("pss_upload_queue_retries", "Batches sent to the cache again after failing",
+                                  value=stats["retries"])
+
+
+def register_upload_queue(upload_queue):
+    REGISTRY.register(UploadQueueCollector(upload_queue))
+
+
+def metrics_response():
+    "Return the current value of every metric in the prometheus text format"
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@contextmanager
+def upstream_request(url):
+    """Time a request to url under its host, counting it as an error
+    if it raises. Call failed() on the result for failures that don't raise."""
+    host = urlparse(url).hostname or "unknown"
+    request = _UpstreamRequest(host)
+    start = time.perf_counter()
+    try:
+        yield request
+    except Exception:
+        request.failed()
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(host).observe(time.perf_counter() - start)
+
+
+class _UpstreamRequest:
+    def __init__(self, host):
+        self.host = host
+        self.errored = False
+
+    def failed(self):
+        "Count the request as an error, once"
+        if not self.errored:
+            self.errored = True
+            UPSTREAM_ERRORS.labels(self.host).inc()
@@ -1,94 +1,264 @@
-from .helpers import get_from_url, query_list_path
-from .uniprot import uniprot_get_entries, resolve_aliases
+from .helpers import get_from_url, query_list_path, gzip_json, gzip_stream, GZIP_JSON_HEADERS, GZIP_LEVEL
+from .uniprot import uniprot_get_entries, resolve_aliases, UnknownUniprotId, UniprotUnavailable
+from .metrics import CACHE_LOOKUPS, upstream_request
+from .http_client import get_client
+from .single_flight import SingleFlight
+from .upload_queue import UploadQueue
+from .uniprot_metadata import MetadataCache
+from .fetch_strategy import fetch_ranked, FETCH_MAX_ATTEMPTS
+from .database_entries.ranking import top_entries
+from hashlib import blake2b
+from urllib.parse import quote, urlencode
+import asyncio
+import gzip
 import json
 import logging
-import requests
-from requests.exceptions import ConnectionError
+import os
+from httpx import HTTPError
 
 logger = logging.getLogger(__name__)
 
 # docker compose internal protein cache url
 CACHE_CONTAINER_URL = "http://pc:6000"
 
+# Maximum number of cache misses resolved from uniprot at once in batch requests
+BATCH_MISS_WORKERS = 8
 
-def upload_pdb_file(text, source_db, uniprot_id="", sequence="", score=0):
-    r = requests.post(CACHE_CONTAINER_URL + "/protein_file",
-                      json={"uniprot_id": uniprot_id,
+# Concurrent misses for the same id share one resolution,
+# also with the other worker processes on the host
+misses_in_flight = SingleFlight()
+
+# Files fetched from the external databases are stored in the cache in the background,
+# after they have been returned
+upload_queue = UploadQueue(CACHE_CONTAINER_URL)
+
+# Parsed uniprot xml, reused by misses for other sources and after override_cache
+uniprot_metadata = MetadataCache(CACHE_CONTAINER_URL)
+
+# Seconds the cache remembers that uniprot has no entry for an id, or no entry
+# in the supported databases, before the id is looked up in uniprot again.
+# Storing a file for the id, e.g. with /upload_pdb/, ends them early.
+TOMBSTONE_UNKNOWN_ID_SECONDS = float(os.environ.get("TOMBSTONE_UNKNOWN_ID_SECONDS", 24 * 3600))
+TOMBSTONE_NO_STRUCTURE_SECONDS = float(os.environ.get("TOMBSTONE_NO_STRUCTURE_SECONDS", 6 * 3600))
+
+
+class FileStream:
+    """Async iterator over the bytes of a file, as returned by the stream_* functions,
+    with the blake2b hash the cache stores the file under, or None if there is no file"""
+
+    def __init__(self, chunks, pdb_hash=None):
+        self.chunks = chunks
+        self.hash = pdb_hash
+
+    def __aiter__(self):
+        return self.chunks.__aiter__()
+
+
+async def upload_pdb_file(text, source_db, uniprot_id="", sequence="", score=0):
+    """
+    store a pdb file in the cache, returning the cache key or ""
+    if it was already stored.
+    The file is only sent if the cache does not already hold it for
+    this uniprot id and source database.
+    """
+    if uniprot_id != "" and await _is_current_in_cache(text, source_db, uniprot_id):
+        logger.info(f"File already in cache, not uploading. id: {uniprot_id} - db: {source_db}")
+        return ""
+    body = await gzip_json({"uniprot_id": uniprot_id,
                             "pdb_file": text,
                             "sequence": sequence,
                             "source_db": source_db,
                             "score": score})
-    if r.status_code != 200:
-        logger.error(f"Failed to store protein file in cache: {r.text}")
+    with upstream_request(CACHE_CONTAINER_URL) as request:
+        r = await get_client().post(CACHE_CONTAINER_URL + "/protein_file/",
+                                    content=body, headers=GZIP_JSON_HEADERS)
+        if r.status_code != 200:
+            request.failed()
+            logger.error(f"Failed to store protein file in cache: {r.text}")
     return r.text
 
 
-def get_pdb_file(uniprot_id, override_cache=False, source_dbs=None):
+async def get_pdb_file(uniprot_id, override_cache=False, source_dbs=None):
     """
     return a pdb_file from cache or from an external database
     matching the uniprot id.
     source_dbs can be a list of databases to check.
     By default it will use all implemented databases.
     """
+    return await _read_all(await stream_pdb_file(uniprot_id, override_cache, source_dbs))
+
+
+async def stream_pdb_file(uniprot_id, override_cache=False, source_dbs=None, encoding=None):
+    """
+    like get_pdb_file, but returns an async iterator over the bytes of the file.
+    Files in the cache are passed through as they arrive from the cache,
+    without being decoded.
+    If encoding is "gzip" the bytes are gzip compressed, and the files the cache
+    sends compressed, as it stores them, are passed through without decompressing them.
+    Misses are resolved once for all the concurrent requests with the same
+    uniprot id, source_dbs and override_cache.
+    Ids the cache has a tombstone for return a blank file without asking uniprot.
+    """
     source_dbs = _resolve_sources(source_dbs)
-    protein_file = ""
     if not override_cache:
-        protein_file = _request_from_cache(
-            uniprot_id, "/retrieve_by_uniprot_id/",
-            query=query_list_path("source_dbs", source_dbs)
-        )
-    if protein_file == "":
-        # check uniprot if file not in cache
-        entries = uniprot_get_entries(
-            uniprot_id, source_dbs=source_dbs)
-        
-        if len(entries) == 0:
-            logger.warning(
-                f"No proteins found in UniProt database, id: {uniprot_id}")
-            return ""
-        else:
-            entries.sort(reverse=True)
-            logger.info(f"Considered {len(entries)} entries, "
-                        + f"choosing best. id: {uniprot_id} - db: "
-                        + f"{entries[0].get_entry_data('external_db_name')}")
-            protein_file = entries[0].fetch()
-            try:
-                upload_pdb_file(
-                    protein_file,
-                    entries[0].get_entry_data("external_db_name"),
-                    uniprot_id,
-                    entries[0].get_protein_metadata()["sequence"],
-                    entries[0].get_quality_score())
-            except ConnectionError as e:
-                print(e)
-    return protein_file
+        # fetched already, but not stored in the cache yet
+        queued = upload_queue.pending_file(uniprot_id, source_dbs)
+        if queued is not None:
+            return _file_stream(queued.encode(), encoding)
+        cached = await _stream_from_cache(
+            uniprot_id, "/raw/retrieve_by_uniprot_id/",
+            query=query_list_path("source_dbs", source_dbs), encoding=encoding)
+        if cached is not None:
+            return cached
+    # check uniprot if file not in cache
+    key = (uniprot_id.upper(), tuple(sorted(source_dbs)), override_cache)
+    pdb_file = await misses_in_flight.run(key, lambda: _fetch_from_uniprot(uniprot_id, source_dbs))
+    return _file_stream(pdb_file.encode(), encoding)
 
 
-def get_pdb_file_by_sequence(sequence, source_dbs=None):
+async def get_file_hash_by_uniprot_id(uniprot_id, source_dbs=None):
+    """
+    returns the blake2b hash of the file stream_pdb_file would return
+    without override_cache, or "" if it would have to be fetched from uniprot.
+    Only the metadata of the file is read from the cache, not the file.
+    """
     source_dbs = _resolve_sources(source_dbs)
-    return _request_from_cache(sequence, "/retrieve_by_sequence/",
-                               query=query_list_path("source_dbs", source_dbs))
+    queued = upload_queue.pending_file(uniprot_id, source_dbs)
+    if queued is not None:
+        return _file_hash(queued.encode())
+    metadata = await get_metadata_by_uniprot_id(uniprot_id, source_dbs)
+    return "" if metadata == "" else metadata["hash"]
+
+
+async def warm_pdb_file(uniprot_id, source_dbs=None):
+    """
+    makes sure the cache has the pdb file of the uniprot id, for warming the cache.
+    returns "cached" if it had it already, found from its metadata without reading
+    the file, "fetched" if it was fetched from an external database (and queued
+    for upload to the cache), or "missing" if no file could be found for the id.
+    """
+    if await get_file_hash_by_uniprot_id(uniprot_id, source_dbs) != "":
+        return "cached"
+    if await get_pdb_file(uniprot_id, source_dbs=source_dbs) != "":
+        return "fetched"
+    return "missing"
+
+
+async def get_pdb_files(uniprot_ids, source_dbs=None):
+    """
+    yield (uniprot_id, pdb_file) for each of the uniprot ids,
+    with pdb_file "" if no file was found.
+    All the ids are looked up in the cache in one request, then the misses
+    are fetched like get_pdb_file, BATCH_MISS_WORKERS at a time.
+    Cache hits are yielded in the order given, misses as they are resolved.
+    """
+    source_dbs = _resolve_sources(source_dbs)
+    uniprot_ids = list(uniprot_ids)
+    answered = set()
+    misses = []
+    try:
+        # timed until the response starts, the body is read as the client consumes it
+        with upstream_request(CACHE_CONTAINER_URL):
+            client = get_client()
+            r = await client.send(client.build_request(
+                "POST", CACHE_CONTAINER_URL + "/retrieve_by_uniprot_ids/",
+                json={"ids": uniprot_ids,
+                      "source_dbs": source_dbs if len(source_dbs) > 0 else None}),
+                stream=True)
+        try:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if line == "":
+                    continue
+                response = json.loads(line)
+                answered.add(response["uniprot_id"])
+                if response["present"]:
+                    CACHE_LOOKUPS.labels("hit").inc()
+                    yield response["uniprot_id"], response["pdb_file"]
+                elif response.get("tombstone") is not None:
+                    CACHE_LOOKUPS.labels("tombstone").inc()
+                    yield response["uniprot_id"], ""
+                else:
+                    CACHE_LOOKUPS.labels("miss").inc()
+                    misses.append(response["uniprot_id"])
+        finally:
+            await r.aclose()
+    except HTTPError as e:
+        logger.error(f"Network issue while fetching protein files from cache: {e}")
+        unanswered = [id for id in uniprot_ids if id.upper() not in answered]
+        CACHE_LOOKUPS.labels("error").inc(len(unanswered))
+        misses += unanswered
+    logger.info(f"Batch cache lookup missed {len(misses)} of {len(uniprot_ids)} ids.")
+    async for result in _bounded_map(
+            lambda id: _get_pdb_file_or_blank(id, source_dbs),
+            misses, BATCH_MISS_WORKERS):
+        yield result
+
+
+async def get_pdb_file_by_sequence(sequence, source_dbs=None):
+    return await _read_all(await stream_pdb_file_by_sequence(sequence, source_dbs))
+
+
+async def stream_pdb_file_by_sequence(sequence, source_dbs=None, encoding=None):
+    source_dbs = _resolve_sources(source_dbs)
+    cached = await _stream_from_cache(sequence, "/raw/retrieve_by_sequence/",
+                                      query=query_list_path("source_dbs", source_dbs), encoding=encoding)
+    return _file_stream(b"", encoding) if cached is None else cached
+
+
+async def get_metadata_by_sequence(sequence, source_dbs=None):
+    """
+    returns a dict of the cache metadata of the pdb file get_pdb_file_by_sequence
+    would return, or "" if there is none. The file itself is not fetched.
+    """
+    source_dbs = _resolve_sources(source_dbs)
+    return await _request_from_cache(
+        sequence, "/retrieve_metadata_by_sequence/", field="metadata",
+        query=query_list_path("source_dbs", source_dbs))
+
 
+async def get_pdb_file_by_db_id(db_id):
+    return await _read_all(await stream_pdb_file_by_db_id(db_id))
 
-def get_pdb_file_by_db_id(db_id):
-    return _request_from_cache(db_id, "/retrieve_by_db_id/")
 
+async def stream_pdb_file_by_db_id(db_id, encoding=None):
+    cached = await _stream_from_cache(db_id, "/raw/retrieve_by_db_id/", encoding=encoding)
+    return _file_stream(b"", encoding) if cached is None else cached
 
-def get_db_id_by_uniprot_id(uniprot_id, source_dbs=None):
+
+async def get_metadata_by_db_id(db_id):
+    """
+    returns a dict of the cache metadata of the pdb file with the db id,
+    or "" if it is not in the cache. The file itself is not fetched.
+    """
+    return await _request_from_cache(db_id, "/retrieve_metadata_by_db_id/", field="metadata")
+
+
+async def get_db_id_by_uniprot_id(uniprot_id, source_dbs=None):
     """
     returns the database id of the pdb file with the matching uniprot id
     if that uniprot id is not in the local cache, then first add it to cache
     """
     source_dbs = _resolve_sources(source_dbs)
-    db_id = _request_from_cache(
-        uniprot_id, "/retrieve_db_id_by_uniprot_id/", field="db_id",
+    metadata = await get_metadata_by_uniprot_id(uniprot_id, source_dbs)
+    if metadata == "":
+        if await get_pdb_file(uniprot_id, source_dbs=source_dbs) != "":
+            metadata = await get_metadata_by_uniprot_id(uniprot_id, source_dbs)
+    if metadata == "":
+        return ""
+    return metadata["db_id"]
+
+
+async def get_metadata_by_uniprot_id(uniprot_id, source_dbs=None):
+    """
+    returns a dict of the cache metadata (db_id, uniprot_id, source_db, score,
+    hash, sequence_length and size) of the pdb file with the matching uniprot id,
+    or "" if it is not in the cache. The file itself is not fetched.
+    """
+    source_dbs = _resolve_sources(source_dbs)
+    return await _request_from_cache(
+        uniprot_id, "/retrieve_metadata_by_uniprot_id/", field="metadata",
         query=query_list_path("source_dbs", source_dbs))
-    if db_id == "":
-        if get_pdb_file(uniprot_id, source_dbs=source_dbs) != "":
-            db_id = _request_from_cache(
-                uniprot_id, "/retrieve_db_id_by_uniprot_id/", field="db_id",
-            query=query_list_path("source_dbs", source_dbs))
-    return db_id
 
 
 
@@ -103,18 +273,189 @@ def _resolve_sources(source_dbs):
         source_dbs = resolve_aliases(source_dbs)
     return source_dbs
 
-def _request_from_cache(search_value, cache_endpoint, query="", field="pdb_file"):
+async def _fetch_from_uniprot(uniprot_id, source_dbs):
+    """Fetch the highest scoring file for the uniprot id from the external
+    databases and queue it to be added to the cache. If the best entry's file
+    can't be fetched the next best are tried (see fetch_strategy.fetch_ranked).
+    Returns "" if there is none,
+    leaving a tombstone in the cache if uniprot has no entry for the id,
+    or none in the source databases."""
+    try:
+        entries = await uniprot_get_entries(
+            uniprot_id, source_dbs=source_dbs, metadata_cache=uniprot_metadata)
+    except UnknownUniprotId:
+        # unknown whatever the sources, so the tombstone applies to all of them
+        await _store_tombstone(uniprot_id, [], "unknown_id", TOMBSTONE_UNKNOWN_ID_SECONDS)
+        return ""
+    except UniprotUnavailable:
+        logger.error(f"Failed to fetch UniProt entry, id: {uniprot_id}")
+        return ""
+
+    if len(entries) == 0:
+        logger.warning(
+            f"No proteins found in UniProt database, id: {uniprot_id}")
+        await _store_tombstone(uniprot_id, source_dbs, "no_structure", TOMBSTONE_NO_STRUCTURE_SECONDS)
+        return ""
+    # only the entries fetch_ranked may try need ordering
+    entries = top_entries(entries, FETCH_MAX_ATTEMPTS)
+    logger.info(f"Considered {len(entries)} entries, "
+                + f"choosing best. id: {uniprot_id} - db: "
+                + f"{entries[0].get_entry_data('external_db_name')}")
+    entry, protein_file = await fetch_ranked(entries)
+    if protein_file != "":
+        upload_queue.put(
+            uniprot_id,
+            protein_file,
+            entry.get_protein_metadata()["sequence"],
+            entry.get_entry_data("external_db_name"),
+            entry.get_quality_score(),
+            source_dbs)
+    return protein_file
+
+
+async def _store_tombstone(uniprot_id, source_dbs, reason, ttl):
+    "Leave a tombstone for the uniprot id in the cache, so repeat misses don't ask uniprot again"
+    try:
+        with upstream_request(CACHE_CONTAINER_URL) as request:
+            r = await get_client().put(CACHE_CONTAINER_URL + "/tombstones/" + quote(uniprot_id),
+                                       json={"source_dbs": source_dbs if len(source_dbs) > 0 else None,
+                                             "reason": reason,
+                                             "ttl": ttl})
+            if r.status_code != 200:
+                request.failed()
+                logger.error(f"Failed to store tombstone in cache: {r.text}")
+    except HTTPError as e:
+        logger.error(f"Failed to store tombstone in cache, id: {uniprot_id} - {e}")
+
+
+async def _is_current_in_cache(text, source_db, uniprot_id):
+    """Ask the cache whether it already holds this file for the uniprot id and
+    source database, by its blake2b hash. Returns False if the cache can't be reached."""
+    pdb_hash = _file_hash(text.encode())
+    f = await get_from_url(CACHE_CONTAINER_URL + "/is_current/" + quote(uniprot_id) + "?"
+                           + urlencode({"source_db": source_db, "hash": pdb_hash}))
+    if f == bytearray():
+        return False
+    return json.loads(f)["current"]
+
+
+async def _get_pdb_file_or_blank(uniprot_id, source_dbs):
+    "get_pdb_file returning (uniprot_id, pdb_file), with a blank file rather than raising on failure"
+    try:
+        return uniprot_id, await get_pdb_file(uniprot_id, source_dbs=source_dbs)
+    except Exception as e:
+        logger.error(f"Failed to fetch protein file, id: {uniprot_id} - {e}")
+        return uniprot_id, ""
+
+
+async def _bounded_map(fn, items, workers):
+    """Yield the result of the coroutine fn(item) for each item as they complete,
+    running at most `workers` at a time."""
+    running = set()
+    try:
+        for item in items:
+            running.add(asyncio.ensure_future(fn(item)))
+            if len(running) >= workers:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while len(running) > 0:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # the client went away before the results were read
+        for task in running:
+            task.cancel()
+
+
+async def _request_from_cache(search_value, cache_endpoint, query="", field="pdb_file"):
     logger.info(f"Attempting fetch from cache {cache_endpoint} - looking for {search_value}.")
-    f = get_from_url(CACHE_CONTAINER_URL
-                     + cache_endpoint
-                     + search_value
-                     + query)
-    if f is None:
+    f = await get_from_url(CACHE_CONTAINER_URL
+                           + cache_endpoint
+                           + quote(search_value)
+                           + query)
+    if f is None or f == bytearray():
+        CACHE_LOOKUPS.labels("error").inc()
         logger.error("Network issue while fetching protein file from cache.")
         return ""
     response = json.loads(f)
     if not response['present']:
+        CACHE_LOOKUPS.labels("miss").inc()
         logger.info("Cache miss.")
         return ""
+    CACHE_LOOKUPS.labels("hit").inc()
     logger.info(f"Cache hit, returning requested field {field}.")
     return response[field]
+
+
+async def _stream_from_cache(search_value, cache_endpoint, query="", encoding=None):
+    """Request a file from one of the cache's raw endpoints.
+    Returns an async iterator over the bytes of the file as they arrive,
+    an empty one if the cache has a tombstone saying there is no file,
+    or None if the file is not in the cache.
+    The cache sends files gzip compressed as it stores them; if encoding is "gzip"
+    they are passed on as they are, otherwise they are decompressed as they arrive."""
+    logger.info(f"Attempting fetch from cache {cache_endpoint} - looking for {search_value}.")
+    try:
+        with upstream_request(CACHE_CONTAINER_URL):
+            client = get_client()
+            r = await client.send(client.build_request(
+                "GET", CACHE_CONTAINER_URL + cache_endpoint + quote(search_value) + query),
+                stream=True)
+    except HTTPError as e:
+        CACHE_LOOKUPS.labels("error").inc()
+        logger.error(f"Network issue while fetching protein file from cache: {e}")
+        return None
+    if r.status_code != 200:
+        await r.aclose()
+        tombstone = r.headers.get("X-Cache-Tombstone")
+        if tombstone is not None:
+            CACHE_LOOKUPS.labels("tombstone").inc()
+            logger.info(f"Cache tombstone ({tombstone}), returning blank file.")
+            return _file_stream(b"", encoding)
+        CACHE_LOOKUPS.labels("miss").inc()
+        logger.info("Cache miss.")
+        return None
+    CACHE_LOOKUPS.labels("hit").inc()
+    logger.info("Cache hit, streaming file.")
+    pdb_hash = r.headers.get("X-Cache-Hash")
+    if encoding == "gzip":
+        if r.headers.get("Content-Encoding") == "gzip":
+            return FileStream(_iter_and_close(r, raw=True), pdb_hash)
+        return FileStream(gzip_stream(_iter_and_close(r)), pdb_hash)
+    return FileStream(_iter_and_close(r), pdb_hash)
+
+
+async def _iter_and_close(response, chunk_size=64 * 1024, raw=False):
+    """Yield the body of a streamed response, closing it once read.
+    If raw it is yielded as sent, without undoing its Content-Encoding."""
+    try:
+        chunks = response.aiter_raw(chunk_size) if raw else response.aiter_bytes(chunk_size)
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await response.aclose()
+
+
+def _file_hash(data):
+    "Return the blake2b hash the cache stores a file's bytes under"
+    return blake2b(data).hexdigest()
+
+
+def _file_stream(data, encoding=None):
+    "FileStream of a file already in memory, blank if there is no file"
+    return FileStream(_iter_file(data, encoding), _file_hash(data) if len(data) > 0 else None)
+
+
+async def _iter_file(data, encoding=None):
+    """Async iterator over a file already in memory, gzip compressed if encoding is "gzip".
+    Compressed in a thread, so large files don't block the event loop."""
+    if encoding == "gzip":
+        data = await asyncio.to_thread(gzip.compress, data, GZIP_LEVEL)
+    yield data
+
+
+async def _read_all(chunks):
+    "Join an async iterator over the bytes of a file into a string"
+    return b"".join([chunk async for chunk in chunks]).decode()
@@ -0,0 +1,138 @@
+from hashlib import blake2b
+from .metrics import COALESCED_MISSES
+import asyncio
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Directory shared by the worker processes on a host for their lock and result files
+SINGLE_FLIGHT_DIR = os.environ.get("SINGLE_FLIGHT_DIR",
+                                   os.path.join(tempfile.gettempdir(), "pss-single-flight"))
+# Seconds a result left for other processes is used for, before it is removed
+SINGLE_FLIGHT_RESULT_SECONDS = float(os.environ.get("SINGLE_FLIGHT_RESULT_SECONDS", 5))
+# Seconds to wait on another process's resolution before running our own anyway
+SINGLE_FLIGHT_LOCK_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_LOCK_TIMEOUT", 120))
+# Seconds between attempts to take a lock held by another process
+LOCK_POLL_SECONDS = 0.05
+
+
+class SingleFlight:
+    """Runs at most one call at a time per key, sharing its result with every
+    call for the same key made while it runs.
+
+    Within a process the callers await the same task. Across the worker
+    processes of a host, the key's lock is a byte of one shared lock file,
+    held while the call runs; the result is left in a file for a few seconds,
+    so the processes that were waiting on the lock read it rather than
+    running the call again.
+
+    Results must be strings.
+    """
+
+    def __init__(self, directory=SINGLE_FLIGHT_DIR, result_seconds=SINGLE_FLIGHT_RESULT_SECONDS,
+                 lock_timeout=SINGLE_FLIGHT_LOCK_TIMEOUT):
+        self.directory = directory
+        self.result_seconds = result_seconds
+        self.lock_timeout = lock_timeout
+        self.in_flight = {}
+        self.lock_fd = None
+        self.lock_pid = None
+
+    async def run(self, key, fn):
+        """Return await fn(), or the result of the call already running for key.
+        A caller that is cancelled stops waiting, without cancelling the call."""
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_once_on_host(key, fn))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            COALESCED_MISSES.labels("process").inc()
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+
+    async def _run_once_on_host(self, key, fn):
+        name = blake2b(repr(key).encode(), digest_size=16)
+        result_path = os.path.join(self.directory, name.hexdigest() + ".result")
+        # POSIX record locks only conflict between processes,
+        # the in-process callers already share this task
+        offset = int.from_bytes(name.digest()[:7], "big")
+        locked = await self._lock(offset)
+        try:
+            if locked:
+                result = self._read_result(result_path)
+                if result is not None:
+                    COALESCED_MISSES.labels("host").inc()
+                    return result
+            result = await fn()
+            if locked:
+                self._write_result(result_path, result)
+            return result
+        finally:
+            if locked:
+                fcntl.lockf(self._lock_file(), fcntl.LOCK_UN, 1, offset)
+
+    async def _lock(self, offset):
+        """Take the lock at offset of the lock file, waiting for other processes.
+        Returns False if it could not be taken in time or the file can't be used."""
+        try:
+            fd = self._lock_file()
+        except OSError as e:
+            logger.warning(f"Can't coalesce misses across processes, no lock file: {e}")
+            return False
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                return True
+            except (BlockingIOError, PermissionError):
+                if time.monotonic() > deadline:
+                    logger.warning("Timed out waiting on another process's resolution, resolving again.")
+                    return False
+                await asyncio.sleep(LOCK_POLL_SECONDS)
+
+    def _lock_file(self):
+        """The descriptor of the lock file, opened once per process.
+        Closing any descriptor of the file would drop all of the process's locks on it."""
+        if self.lock_pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            self.lock_fd = os.open(os.path.join(self.directory, "locks"), os.O_RDWR | os.O_CREAT, 0o644)
+            self.lock_pid = os.getpid()
+        return self.lock_fd
+
+    def _read_result(self, path):
+        "Return the result left at path if it is recent enough, otherwise None"
+        try:
+            if time.time() - os.path.getmtime(path) > self.result_seconds:
+                return None
+            with open(path, "rb") as f:
+                return f.read().decode()
+        except OSError:
+            return None
+
+    def _write_result(self, path, result):
+        "Leave the result at path for the processes waiting on the lock, for a few seconds"
+        try:
+            partial = path + f".{os.getpid()}"
+            with open(partial, "wb") as f:
+                f.write(result.encode())
+            os.replace(partial, path)
+        except OSError as e:
+            logger.warning(f"Failed to share a resolved miss with other processes: {e}")
+            return
+        asyncio.get_running_loop().call_later(self.result_seconds + 1, self._remove_stale, path)
+
+    def _remove_stale(self, path):
+        "Remove the result at path unless a newer result has replaced it"
+        try:
+            if time.time() - os.path.getmtime(path) >= self.result_seconds:
+                os.remove(path)
+        except OSError:
+            pass
@@ -1,6 +1,10 @@
+import asyncio
+import httpx
 import logging
 from xml.etree import ElementTree
-from .helpers import get_from_url
+from .helpers import get_from_url, NOT_FOUND_STATUSES
+from .http_client import get_client
+from .metrics import upstream_request
 from .database_entries import pdbe_entry, afdb_entry
 
 logger = logging.getLogger(__name__)
@@ -8,6 +12,11 @@ logger = logging.getLogger(__name__)
 PDBE_DB_NAME = "PDB".upper()
 ALPHAFOLD_DB_NAME = "AlphaFoldDB".upper()
 
+UNIPROT_ENTRY_URL = "https://rest.uniprot.org/uniprotkb/"
+# Bytes of a UniProt xml response read and parsed at a time. The elements of a chunk
+# are built before they are dropped, so smaller chunks hold less in memory at once.
+XML_CHUNK_BYTES = 16 * 1024
+
 # Mappings of external database names (in all uppercase, as written in uniprot db)
 # to their corresponding ExternalDatabaseEntry objects. in database_entries folder.
 EXTERNAL_DATABASES = {
@@ -23,6 +32,14 @@ ALIASES = {
 }
 
 
+class UnknownUniprotId(LookupError):
+    "UniProt has no entry for the id"
+
+
+class UniprotUnavailable(Exception):
+    "The UniProt entry could not be fetched, e.g. because of a network issue"
+
+
 def resolve_aliases(source_dbs):
     """
     Resolve Database aliases to their real names
@@ -38,16 +55,23 @@ def resolve_aliases(source_dbs):
     return dbs
 
 
-def uniprot_get_entries(uniprot_id, source_dbs=None):
+async def uniprot_get_entries(uniprot_id, source_dbs=None, metadata_cache=None):
     """ Get list of ExternalDatabaseEntry objects for the supported databases
     using a uniprot id. 
     source_dbs can be a list of database names to consider.
     By default use all implemented databases
+    metadata_cache can be a MetadataCache (see uniprot_metadata.py) to reuse
+    the parsed uniprot xml from, and add it to.
+    Raises UnknownUniprotId if UniProt has no entry for the id, and UniprotUnavailable
+    if it couldn't be fetched, so an empty list means there is no supported entry.
     """
     sources = _select_external_dbs(source_dbs)
     if source_dbs is None or len(source_dbs) == 0:
         sources = EXTERNAL_DATABASES
-    uniprot_entries_data = _parse_uniprot_xml(uniprot_id)
+    if metadata_cache is None:
+        uniprot_entries_data = await _fetch_uniprot_entries(uniprot_id)
+    else:
+        uniprot_entries_data = await _cached_uniprot_entries(uniprot_id, metadata_cache)
     entries = list()
     for entry_data in uniprot_entries_data:
         database_object = sources.get(entry_data["external_db_name"].upper())
@@ -71,52 +95,150 @@ def _select_external_dbs(source_dbs):
     return dbs
 
 
-def _parse_uniprot_xml(uniprot_id):
+async def _parse_uniprot_xml(uniprot_id):
     """ Return a list of dictionaries containing the 'external_database_name',
     'id' (entry id in the database), 'method', 'resolution', 'chains' and
     'protein_metadata'  (general protein metadata not specific to each database
-    entry) for all the entries stored by UniProt. """
-    entries = []
-    xml_text = _request_uniprot_file(uniprot_id, "xml")
-    if xml_text is None:
-        return entries
-    root = ElementTree.fromstring(xml_text)
-    extracted_metadata = {} # Any additional metadata that is extracted and stored (this is generic to the protein, not specific to each database entry)
-    for child in root:
-        if child.tag.endswith("entry"):
-            for dbentry in child:
-                if dbentry.tag.endswith("dbReference"):
-                    new_entry = {}
-                    new_entry['external_db_name'] = dbentry.attrib['type']
-                    new_entry['id'] = dbentry.attrib['id']
-                    for properties in dbentry:
-                        if properties.tag.endswith("property"):
-                            new_entry[properties.attrib['type']] = properties.attrib['value']
-                    entries.append(new_entry)
-                elif dbentry.tag.endswith("sequence"):
-                    extracted_metadata["sequence"] = dbentry.text
-                    extracted_metadata["mass"] = dbentry.attrib['mass']
-                    extracted_metadata["sequence_length"] = dbentry.attrib['length']
-                    # If we wanted to extract feature metadata,
-                    # this could go here
-
-    # Add generic protein metadata to each database entry of this protein
-    for entry in entries:
-        entry["protein_metadata"] = extracted_metadata
+    entry) for the entries stored by UniProt in the EXTERNAL_DATABASES. """
+    try:
+        return await _fetch_uniprot_entries(uniprot_id)
+    except (UnknownUniprotId, UniprotUnavailable):
+        return []
+
+
+async def _fetch_uniprot_entries(uniprot_id):
+    """ _parse_uniprot_xml, raising UnknownUniprotId or UniprotUnavailable
+    rather than returning an empty list if the xml can't be fetched.
+    The xml is parsed as it arrives, so the response is never held in memory whole. """
+    if not isinstance(uniprot_id, str):
+        logger.error(f"Failed to fetch UniProt entry, the given UniProt ID was {type(uniprot_id)}, not string")
+        raise UniprotUnavailable(uniprot_id)
+    url = UNIPROT_ENTRY_URL + uniprot_id + ".xml"
+    parser = _EntriesParser()
+    status = None
+    with upstream_request(url) as request:
+        try:
+            async with get_client().stream("GET", url) as r:
+                status = r.status_code
+                if status == 200:
+                    async for chunk in r.aiter_bytes(XML_CHUNK_BYTES):
+                        # parsed in a thread, so large entries don't hold up the event loop
+                        await asyncio.to_thread(parser.feed, chunk)
+                elif status not in NOT_FOUND_STATUSES:
+                    request.failed()
+        except httpx.HTTPError as e:
+            request.failed()
+            logger.error(f"Failed to fetch UniProt entry, there may be a network issue: {e}")
+            raise UniprotUnavailable(uniprot_id)
+    if status in NOT_FOUND_STATUSES:
+        logger.warning(f"UniProt has no entry for {uniprot_id}.")
+        raise UnknownUniprotId(uniprot_id)
+    if status != 200:
+        logger.error(f"Failed to fetch UniProt entry, http status code: {status}")
+        raise UniprotUnavailable(uniprot_id)
+    logger.info(f"Successfully fetched UniProt entry for {uniprot_id}.")
+    return parser.close()
+
+
+async def _cached_uniprot_entries(uniprot_id, metadata_cache):
+    """ _parse_uniprot_xml, reusing the entries from metadata_cache if it has them,
+    and adding them if not. Failures to fetch the xml are not cached. """
+    if not isinstance(uniprot_id, str):
+        return await _fetch_uniprot_entries(uniprot_id)
+    metadata = await metadata_cache.get(uniprot_id)
+    if metadata is not None:
+        # the protein metadata is stored once, rather than with every entry
+        return [{**entry, "protein_metadata": metadata["protein_metadata"]}
+                for entry in metadata["entries"]]
+    entries = await _fetch_uniprot_entries(uniprot_id)
+    protein_metadata = entries[0]["protein_metadata"] if len(entries) > 0 else {}
+    metadata_cache.put(uniprot_id, {
+        "entries": [{k: v for k, v in entry.items() if k != "protein_metadata"} for entry in entries],
+        "protein_metadata": protein_metadata})
     return entries
 
 
-def _request_uniprot_file(uniprot_id, filetype):
+def _entries_from_xml(xml_text, databases=EXTERNAL_DATABASES):
+    """Parse the entries of _parse_uniprot_xml out of the text of a UniProt xml file,
+    keeping only the dbReferences to the databases given (names in uppercase)."""
+    if isinstance(xml_text, str):
+        xml_text = xml_text.encode()
+    parser = _EntriesParser(databases)
+    parser.feed(xml_text)
+    return parser.close()
+
+
+class _EntriesParser:
+    """Parses the entries of _parse_uniprot_xml out of a UniProt xml file fed to it in chunks,
+    keeping only the dbReferences to the databases given (names in uppercase).
+    Each child of the entry is dropped once read, so the thousands of GO, InterPro, etc.
+    references of well studied proteins are never all held in memory as a tree."""
+
+    def __init__(self, databases=EXTERNAL_DATABASES):
+        self.databases = databases
+        self.parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self.entries = []
+        self.extracted_metadata = {} # Any additional metadata that is extracted and stored (this is generic to the protein, not specific to each database entry)
+        self.depth = 0  # of the element being parsed, 1 for the root
+        self.entry = None
+
+    def feed(self, data):
+        "Parse the next chunk of the xml"
+        self.parser.feed(data)
+        self._read_events()
+
+    def close(self):
+        "Finish parsing, returning the entries"
+        self.parser.close()
+        self._read_events()
+        # Add generic protein metadata to each database entry of this protein
+        for entry in self.entries:
+            entry["protein_metadata"] = self.extracted_metadata
+        return self.entries
+
+    def _read_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                self.depth += 1
+                if self.depth == 2:
+                    self.entry = element
+                continue
+            self.depth -= 1
+            # only the direct children of an entry, not references nested in citations etc.
+            if self.depth != 2 or not self.entry.tag.endswith("entry"):
+                continue
+            if element.tag.endswith("dbReference") and element.attrib['type'].upper() in self.databases:
+                new_entry = {}
+                new_entry['external_db_name'] = element.attrib['type']
+                new_entry['id'] = element.attrib['id']
+                for properties in element:
+                    if properties.tag.endswith("property"):
+                        new_entry[properties.attrib['type']] = properties.attrib['value']
+                self.entries.append(new_entry)
+            elif element.tag.endswith("sequence"):
+                self.extracted_metadata["sequence"] = element.text
+                self.extracted_metadata["mass"] = element.attrib['mass']
+                self.extracted_metadata["sequence_length"] = element.attrib['length']
+                # If we wanted to extract feature metadata,
+                # this could go here
+            # done with this child, so its subtree can be freed
+            self.entry.remove(element)
+
+
+async def _request_uniprot_file(uniprot_id, filetype, not_found=None):
     """ Given UniProt id and file type strings, return the text contents of
-    the UniProt entry. """
+    the UniProt entry, or None if it couldn't be fetched.
+    If not_found is given it is returned instead when UniProt has no such entry. """
     if not isinstance(uniprot_id, str):
         logger.error(f"Failed to fetch UniProt entry, the given UniProt ID was {type(uniprot_id)}, not string")
         return None
     if not isinstance(filetype, str):
         logger.error(f"Failed to fetch UniProt entry, the given filetype was {type(filetype)}, not string")
         return None
-    result = get_from_url("https://rest.uniprot.org/uniprotkb/" +
-                          uniprot_id + "." + filetype)
+    result = await get_from_url(UNIPROT_ENTRY_URL + uniprot_id + "." + filetype, not_found=not_found)
+    if not_found is not None and result is not_found:
+        logger.warning(f"UniProt has no entry for {uniprot_id}.")
+        return not_found
     if result == bytearray():
         logger.error("Failed to fetch UniProt entry, id may be invalid or there may be a network issue.")
         return None
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from httpx import HTTPError
+from urllib.parse import quote
+from .http_client import get_client
+from .metrics import UNIPROT_METADATA_LOOKUPS, upstream_request
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Days parsed uniprot metadata is used for before the uniprot xml is fetched again
+UNIPROT_METADATA_TTL_DAYS = float(os.environ.get("UNIPROT_METADATA_TTL_DAYS", 7))
+# Accessions whose metadata is also kept in memory, the most recently used
+UNIPROT_METADATA_MEMORY_ENTRIES = int(os.environ.get("UNIPROT_METADATA_MEMORY_ENTRIES", 10000))
+
+
+class MetadataCache:
+    """The uniprot metadata parsed for each accession, kept for ttl seconds,
+    so other source_dbs filters and scoring with new weights don't need
+    the uniprot xml to be fetched and parsed again.
+
+    Metadata is kept in memory for the most recently used max_entries accessions,
+    and in the cache service, which shares it with the other replicas and keeps it
+    across restarts. Values are json compatible dicts.
+    The ranking of the entries is not kept: it depends on the source_dbs filter
+    and the weights, and scoring them again takes a few milliseconds at most.
+    """
+
+    def __init__(self, cache_url, ttl=UNIPROT_METADATA_TTL_DAYS * 24 * 3600,
+                 max_entries=UNIPROT_METADATA_MEMORY_ENTRIES):
+        self.cache_url = cache_url
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = OrderedDict()  # accession: (expires at, metadata), least recently used first
+        self.storing = set()
+
+    async def get(self, accession):
+        "Return the metadata of accession if it was stored less than ttl seconds ago, otherwise None"
+        accession = accession.upper()
+        found = self.memory.get(accession)
+        if found is not None:
+            if found[0] > time.time():
+                self.memory.move_to_end(accession)
+                UNIPROT_METADATA_LOOKUPS.labels("memory").inc()
+                return found[1]
+            del self.memory[accession]
+        try:
+            with upstream_request(self.cache_url) as request:
+                r = await get_client().get(self.cache_url + "/uniprot_metadata/" + quote(accession),
+                                           params={"max_age": self.ttl})
+                if r.status_code != 200:
+                    request.failed()
+                    raise HTTPError(f"http status {r.status_code}")
+                response = r.json()
+        except (HTTPError, ValueError) as e:
+            # ValueError for a response that isn't json, such as an error page of a proxy
+            logger.warning(f"Failed to read uniprot metadata from cache, id: {accession} - {e}")
+            response = {"present": False}
+        if not response["present"]:
+            UNIPROT_METADATA_LOOKUPS.labels("miss").inc()
+            return None
+        UNIPROT_METADATA_LOOKUPS.labels("cache").inc()
+        self._remember(accession, response["metadata"], response["stored_at"] + self.ttl)
+        return response["metadata"]
+
+    def put(self, accession, metadata):
+        """Keep the metadata of accession in memory, and store it in the cache
+        service in the background"""
+        accession = accession.upper()
+        self._remember(accession, metadata, time.time() + self.ttl)
+        task = asyncio.ensure_future(self._store(accession, metadata))
+        # keep a reference until it is done, the event loop only keeps weak ones
+        self.storing.add(task)
+        task.add_done_callback(self.storing.discard)
+
+    def clear(self):
+        "Forget the metadata kept in memory"
+        self.memory.clear()
+
+    def _remember(self, accession, metadata, expires_at):
+        self.memory[accession] = (expires_at, metadata)
+        self.memory.move_to_end(accession)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    async def _store(self, accession, metadata):
+        try:
+            with upstream_request(self.cache_url) as request:
+                r = await get_client().put(self.cache_url + "/uniprot_metadata/" + quote(accession),
+                                           json={"metadata": metadata})
+                if r.status_code != 200:
+                    request.failed()
+                    logger.error(f"Failed to store uniprot metadata in cache: {r.text}")
+        except HTTPError as e:
+            logger.error(f"Failed to store uniprot metadata in cache, id: {accession} - {e}")
@@ -0,0 +1,339 @@
+from collections import deque
+from hashlib import blake2b
+from httpx import HTTPError
+from .helpers import gzip_json, GZIP_JSON_HEADERS
+from .http_client import get_client
+from .metrics import upstream_request
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Files sent to the cache per bulk request, and the most bytes of files per request
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 50))
+WRITE_BEHIND_BATCH_BYTES = int(os.environ.get("WRITE_BEHIND_BATCH_BYTES", 16 * 1024 * 1024))
+# Seconds to wait for more files before sending a batch that isn't full
+WRITE_BEHIND_BATCH_WAIT_SECONDS = float(os.environ.get("WRITE_BEHIND_BATCH_WAIT_SECONDS", 0.5))
+# Bytes of files waiting in memory; past this they are spilled to disk
+WRITE_BEHIND_MAX_BYTES = int(os.environ.get("WRITE_BEHIND_MAX_BYTES", 256 * 1024 * 1024))
+# Directory files are spilled to, "" to drop them instead, and the most bytes kept there
+WRITE_BEHIND_SPILL_DIR = os.environ.get("WRITE_BEHIND_SPILL_DIR",
+                                        os.path.join(tempfile.gettempdir(), "pss-upload-spill"))
+WRITE_BEHIND_SPILL_MAX_BYTES = int(os.environ.get("WRITE_BEHIND_SPILL_MAX_BYTES", 1024 * 1024 * 1024))
+# Bytes of files held in memory while they wait to be written to disk; past this they are dropped
+WRITE_BEHIND_SPILLING_MAX_BYTES = int(os.environ.get("WRITE_BEHIND_SPILLING_MAX_BYTES", 64 * 1024 * 1024))
+# Attempts at sending a batch, waiting WRITE_BEHIND_BACKOFF_SECONDS after the first failure,
+# doubling each time up to WRITE_BEHIND_MAX_BACKOFF_SECONDS
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", 5))
+WRITE_BEHIND_BACKOFF_SECONDS = float(os.environ.get("WRITE_BEHIND_BACKOFF_SECONDS", 0.5))
+WRITE_BEHIND_MAX_BACKOFF_SECONDS = float(os.environ.get("WRITE_BEHIND_MAX_BACKOFF_SECONDS", 30))
+# Seconds to wait for the cache to store a batch
+WRITE_BEHIND_TIMEOUT = float(os.environ.get("WRITE_BEHIND_TIMEOUT", 60))
+
+
+class UploadQueue:
+    """Write-behind queue of files to store in the cache, so a request can return
+    a file fetched from upstream without waiting for the cache to store it.
+
+    Files are sent to the cache's /protein_files/ endpoint in gzip compressed batches
+    by a background task, retrying failed batches with exponential backoff.
+    Each batch is first checked against the cache by hash with one /is_current/
+    request, and only the files the cache doesn't hold already are sent.
+    The files waiting in memory are bounded by max_bytes; past that they are
+    spilled to files in spill_dir (up to spill_max_bytes) by another background
+    task, and sent once the memory queue has drained, also after a restart.
+    The files waiting to be written to disk are bounded by spilling_max_bytes,
+    in case the disk is slower than files arrive.
+    When there is no room left files are dropped, which only costs fetching
+    them again on the next miss.
+    """
+
+    def __init__(self, cache_url, batch_size=WRITE_BEHIND_BATCH_SIZE, batch_bytes=WRITE_BEHIND_BATCH_BYTES,
+                 batch_wait=WRITE_BEHIND_BATCH_WAIT_SECONDS, max_bytes=WRITE_BEHIND_MAX_BYTES,
+                 spill_dir=WRITE_BEHIND_SPILL_DIR, spill_max_bytes=WRITE_BEHIND_SPILL_MAX_BYTES,
+                 spilling_max_bytes=WRITE_BEHIND_SPILLING_MAX_BYTES, max_attempts=WRITE_BEHIND_MAX_ATTEMPTS, backoff=WRITE_BEHIND_BACKOFF_SECONDS,
+                 max_backoff=WRITE_BEHIND_MAX_BACKOFF_SECONDS, timeout=WRITE_BEHIND_TIMEOUT):
+        self.cache_url = cache_url
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_wait = batch_wait
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.spilling_max_bytes = spilling_max_bytes
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.pending = deque()  # (enqueued_at, upload, key) oldest first
+        self.pending_bytes = 0
+        # files waiting to be sent, by (uniprot id, source dbs) they were resolved for
+        self.pending_files = {}
+        self.sending = []
+        self.spilling = deque()  # (enqueued_at, upload) waiting to be written to disk
+        self.spilling_bytes = 0
+        self.spiller = None
+        self.spilled_files, self.spilled_bytes = self._scan_spill_dir()
+        self.counts = {"uploaded": 0, "unchanged": 0, "failed": 0, "dropped": 0, "spilled": 0, "retries": 0}
+        self.last_error = None
+        self.wakeup = None
+        self.worker = None
+        self.spill_sequence = 0
+
+    def put(self, uniprot_id, pdb_file, sequence, source_db, score, source_dbs=()):
+        """Queue a file to be stored in the cache, starting the background task if needed.
+        source_dbs are the source databases the file was resolved from, so requests
+        for the same id and sources can be answered before it is stored (see pending_file)."""
+        upload = {"uniprot_id": uniprot_id,
+                  "pdb_file": pdb_file,
+                  "sequence": sequence,
+                  "source_db": source_db,
+                  "score": score}
+        key = (uniprot_id.upper(), tuple(sorted(source_dbs)))
+        size = len(pdb_file)
+        self.start()
+        if self.pending_bytes + size > self.max_bytes:
+            if self.spill_dir == "" or self.spilling_bytes + size > self.spilling_max_bytes:
+                self._drop(upload)
+                return
+            self.spilling.append((time.time(), upload))
+            self.spilling_bytes += size
+            if self.spiller is None or self.spiller.done():
+                self.spiller = asyncio.get_running_loop().create_task(self._spill_queued())
+        else:
+            self.pending.append((time.time(), upload, key))
+            self.pending_bytes += size
+            self.pending_files[key] = pdb_file
+        self.wakeup.set()
+
+    def pending_file(self, uniprot_id, source_dbs=()):
+        "Return the file queued in memory for the uniprot id and source dbs, or None"
+        return self.pending_files.get((uniprot_id.upper(), tuple(sorted(source_dbs))))
+
+    def stats(self):
+        """Return the number and bytes of files waiting in memory, waiting to be spilled and spilled to disk,
+        the lag (age in seconds of the oldest file waiting in memory or being sent),
+        and the count of files uploaded, unchanged, failed, dropped, spilled and of retries."""
+        oldest = [entry[0] for entry in self.sending[:1]] + [entry[0] for entry in list(self.pending)[:1]]
+        return {"pending": len(self.pending) + len(self.sending),
+                "pending_bytes": self.pending_bytes,
+                "spilling": len(self.spilling),
+                "spilling_bytes": self.spilling_bytes,
+                "spilled_pending": self.spilled_files,
+                "spilled_bytes": self.spilled_bytes,
+                "lag_seconds": time.time() - min(oldest) if len(oldest) > 0 else 0,
+                **self.counts,
+                "last_error": self.last_error}
+
+    async def run(self):
+        "Send the queued files to the cache in batches until cancelled"
+        while True:
+            if len(self.pending) == 0 and not self._load_spilled():
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if len(self.pending) < self.batch_size and self.pending_bytes < self.batch_bytes:
+                # give the batch a moment to fill
+                await asyncio.sleep(self.batch_wait)
+            self.sending = self._take_batch()
+            await self._send(self.sending)
+            for entry in self.sending:
+                self._forget(entry)
+            self.sending = []
+
+    async def close(self):
+        """Stop the background task, spilling the files not yet sent to disk,
+        so they are sent after a restart."""
+        if self.worker is not None and not self.worker.done():
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.worker = None
+        if self.spiller is not None:
+            await self.spiller
+            self.spiller = None
+        for entry in self.sending + list(self.pending):
+            self._forget(entry)
+            await self._spill(entry[0], entry[1])
+        self.sending = []
+        self.pending.clear()
+        self.pending_bytes = 0
+
+    def start(self):
+        """Start the background task on the running event loop if it isn't running there.
+        Called by put, and when the service starts to send the files spilled before a restart."""
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.worker.done() or self.worker.get_loop() is not loop:
+            self.wakeup = asyncio.Event()
+            self.worker = loop.create_task(self.run())
+
+    def _take_batch(self):
+        "Take the oldest files from the queue, up to batch_size files and batch_bytes"
+        batch = []
+        size = 0
+        while len(self.pending) > 0 and len(batch) < self.batch_size:
+            file_size = len(self.pending[0][1]["pdb_file"])
+            if len(batch) > 0 and size + file_size > self.batch_bytes:
+                break
+            batch.append(self.pending.popleft())
+            size += file_size
+        self.pending_bytes -= size
+        return batch
+
+    def _forget(self, entry):
+        "Stop answering pending_file with a queued file once it has been sent or spilled"
+        _, upload, key = entry
+        if key is not None and self.pending_files.get(key) is upload["pdb_file"]:
+            del self.pending_files[key]
+
+    async def _send(self, batch):
+        """Send the files of a batch the cache doesn't hold already, retrying with backoff,
+        and count the results"""
+        files = await self._stale_files([upload for _, upload, _ in batch])
+        self.counts["unchanged"] += len(batch) - len(files)
+        if len(files) == 0:
+            return
+        body = await gzip_json(files)
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with upstream_request(self.cache_url) as request:
+                    r = await get_client().post(self.cache_url + "/protein_files/", content=body,
+                                                headers=GZIP_JSON_HEADERS, timeout=self.timeout)
+                    if r.status_code == 200:
+                        for result in r.json():
+                            status = result.get("status")
+                            self.counts["failed" if status == "error" else
+                                        "unchanged" if status == "unchanged" else "uploaded"] += 1
+                        logger.info(f"Stored {len(files)} protein files in cache.")
+                        return
+                    request.failed()
+                    self.last_error = f"http status {r.status_code}: {r.text[:200]}"
+                    if r.status_code < 500:
+                        break  # the cache rejected the files, sending them again won't help
+            except HTTPError as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+            except Exception as e:
+                # such as a response that isn't the json expected, which sending again won't fix
+                self.last_error = f"{type(e).__name__}: {e}"
+                break
+            if attempt < self.max_attempts:
+                self.counts["retries"] += 1
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+        logger.error(f"Failed to store {len(files)} protein files in cache: {self.last_error}")
+        self.counts["failed"] += len(files)
+
+    async def _stale_files(self, files):
+        """Return the files the cache doesn't hold already for their uniprot id and source db,
+        asking it by their hashes in one request. If it can't be asked, all of them are returned."""
+        # the hash the cache stores files under
+        hashes = [{"uniprot_id": f["uniprot_id"], "source_db": f["source_db"],
+                   "hash": blake2b(f["pdb_file"].encode()).hexdigest()} for f in files]
+        try:
+            with upstream_request(self.cache_url) as request:
+                r = await get_client().post(self.cache_url + "/is_current/", json=hashes, timeout=self.timeout)
+                if r.status_code != 200:
+                    request.failed()
+                    raise HTTPError(f"http status {r.status_code}")
+                current = r.json()["current"]
+        except Exception as e:
+            logger.warning(f"Failed to check which files the cache holds, sending all of them - {e}")
+            return files
+        return [f for f, is_current in zip(files, current) if not is_current]
+
+    async def _spill_queued(self):
+        "Spill the uploads put while the memory queue was full, oldest first"
+        while len(self.spilling) > 0:
+            await self._spill(*self.spilling[0])
+            _, upload = self.spilling.popleft()
+            self.spilling_bytes -= len(upload["pdb_file"])
+            self.wakeup.set()
+
+    async def _spill(self, enqueued_at, upload):
+        "Write an upload to the spill directory, or drop it if there is no room"
+        data = json.dumps({"enqueued_at": enqueued_at, "upload": upload}).encode()
+        if self.spill_dir == "" or self.spilled_bytes + len(data) > self.spill_max_bytes:
+            self._drop(upload)
+            return
+        self.spill_sequence += 1
+        # names sort oldest first
+        name = f"{time.time_ns():020d}-{os.getpid()}-{self.spill_sequence}.json"
+        try:
+            # off the event loop, the disk may be slow
+            await asyncio.to_thread(_write_spill_file, self.spill_dir, name, data)
+        except OSError as e:
+            self.counts["dropped"] += 1
+            logger.warning(f"Failed to spill protein file, dropping it, id: {upload['uniprot_id']} - {e}")
+            return
+        self.spilled_files += 1
+        self.spilled_bytes += len(data)
+        self.counts["spilled"] += 1
+
+    def _drop(self, upload):
+        "Count and log an upload there is no room for"
+        self.counts["dropped"] += 1
+        logger.warning(f"Upload queue full, dropping protein file, id: {upload['uniprot_id']}")
+
+    def _load_spilled(self):
+        """Move the oldest spilled files back into the memory queue, up to a batch.
+        Returns whether any were loaded."""
+        self.spilled_files, self.spilled_bytes = self._scan_spill_dir()
+        if self.spilled_files == 0:
+            return False
+        loaded = 0
+        for name in sorted(os.listdir(self.spill_dir)):
+            if loaded >= self.batch_size or self.pending_bytes >= self.max_bytes:
+                break
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.spill_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                # whoever removes the file sends it, if other processes share the directory
+                os.remove(path)
+            except OSError:
+                continue
+            self.spilled_files -= 1
+            self.spilled_bytes -= len(data)
+            try:
+                spilled = json.loads(data)
+            except ValueError:
+                logger.error(f"Dropping unreadable spilled upload {name}")
+                self.counts["dropped"] += 1
+                continue
+            self.pending.append((spilled["enqueued_at"], spilled["upload"], None))
+            self.pending_bytes += len(spilled["upload"]["pdb_file"])
+            loaded += 1
+        return loaded > 0
+
+    def _scan_spill_dir(self):
+        "Return the number and total bytes of the spilled uploads"
+        count, size = 0, 0
+        if self.spill_dir == "":
+            return count, size
+        try:
+            with os.scandir(self.spill_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json"):
+                        count += 1
+                        size += entry.stat().st_size
+        except OSError:
+            pass
+        return count, size
+
+
+def _write_spill_file(spill_dir, name, data):
+    "Write data to the file name in spill_dir, so it never appears partly written"
+    os.makedirs(spill_dir, exist_ok=True)
+    path = os.path.join(spill_dir, name)
+    with open(path + ".partial", "wb") as f:
+        f.write(data)
+    os.replace(path + ".partial", path)
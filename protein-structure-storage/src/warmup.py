@@ -0,0 +1,438 @@
+from .http_client import RateLimiter, rate_limiter
+from .metrics import WARMUP_IDS
+from .pss import warm_pdb_file
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Directory the warm-up jobs of a host keep their id lists and checkpoints in,
+# shared by its worker processes
+WARMUP_DIR = os.environ.get("WARMUP_DIR", os.path.join(tempfile.gettempdir(), "pss-warmup"))
+# Ids a job resolves at once, unless it is started with another concurrency
+WARMUP_CONCURRENCY = int(os.environ.get("WARMUP_CONCURRENCY", 32))
+# Requests per second the jobs of a worker process make to each upstream host,
+# as "HOST=RATE,...". Hosts not listed, such as the cache, aren't limited.
+WARMUP_RATE_LIMITS = os.environ.get(
+    "WARMUP_RATE_LIMITS",
+    "rest.uniprot.org=40,www.ebi.ac.uk=40,files.rcsb.org=40,alphafold.ebi.ac.uk=40")
+# Seconds between checkpoints of a running job's progress
+WARMUP_CHECKPOINT_SECONDS = float(os.environ.get("WARMUP_CHECKPOINT_SECONDS", 5))
+# Directory on the host id lists can be read from by path, rather than uploaded.
+# "" (the default) only accepts uploaded id lists.
+WARMUP_ID_LIST_DIR = os.environ.get("WARMUP_ID_LIST_DIR", "")
+
+# The status each result of warm_pdb_file counts towards
+RESULT_STATUSES = {"fetched": "done", "cached": "skipped", "missing": "failed"}
+# States of jobs that are never run again
+FINAL_STATES = ("finished", "cancelled")
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def parse_rates(value):
+    """Parse per host rates given as "HOST=RATE,..." (e.g. "rest.uniprot.org=40")
+    into a dict of host to requests per second."""
+    rates = {}
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+        host, rate = item.split("=")
+        rates[host.strip().lower()] = float(rate)
+    return rates
+
+
+def id_list_path(path, root=WARMUP_ID_LIST_DIR):
+    """Return the real path of an id list given by path, relative to root, raising ValueError
+    if reading id lists by path is disabled or it is outside root, e.g. through .. or a symlink."""
+    if root == "":
+        raise ValueError("Reading id lists by path is disabled, upload the id list as file")
+    root = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"The id list must be in {root}")
+    return resolved
+
+
+class WarmupJobs:
+    """The cache warm-up jobs of a host, each resolving a list of uniprot ids
+    with warm_pdb_file, concurrency ids at a time, so the cache has their files.
+
+    A job's id list, options and checkpoint are kept in its own directory
+    under directory, shared by the worker processes of the host. The process
+    running a job holds a lock on its directory, so each job runs in one process,
+    and any process can report its status from its checkpoint. A job that was
+    running when its process stopped is carried on from its checkpoint by the
+    next process to start, or on resume. Jobs are paused and cancelled through
+    a control file, read by the process running the job at each checkpoint.
+
+    The requests of the jobs of a process share a RateLimiter of rate_limits,
+    so each upstream host is asked at most at its rate whatever the concurrency.
+    """
+
+    def __init__(self, directory=WARMUP_DIR, rate_limits=None,
+                 checkpoint_seconds=WARMUP_CHECKPOINT_SECONDS, warm=warm_pdb_file):
+        self.directory = directory
+        self.limiter = RateLimiter(parse_rates(WARMUP_RATE_LIMITS) if rate_limits is None else rate_limits)
+        self.checkpoint_seconds = checkpoint_seconds
+        self.warm = warm
+        self.running = {}  # job id: WarmupJob run by this process
+
+    async def create(self, ids_file, source_dbs=None, concurrency=WARMUP_CONCURRENCY):
+        """Start a job warming the ids in ids_file, a binary file with one uniprot id per line.
+        The list is copied into the job's directory first, so the positions in its
+        checkpoint stay valid. Returns the status of the job."""
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, job_id)
+        os.makedirs(path)
+        total = await asyncio.to_thread(_copy_ids, ids_file, os.path.join(path, "ids.txt"))
+        _write_json(os.path.join(path, "job.json"),
+                    {"id": job_id, "source_dbs": source_dbs, "concurrency": concurrency,
+                     "total": total, "created_at": time.time()})
+        self.start(job_id)
+        return self.status(job_id)
+
+    def start(self, job_id):
+        """Run the job in this process, unless it is finished or cancelled,
+        or another process runs it. Returns True if it runs in this process."""
+        if job_id in self.running:
+            return True
+        path = self._path(job_id)
+        if path is None:
+            return False
+        lock = _try_lock(path)
+        if lock is None:
+            return False
+        job = WarmupJob(path, self.limiter, self.warm, self.checkpoint_seconds)
+        if job.state in FINAL_STATES:
+            os.close(lock)
+            return False
+        job.state = "running"
+        self.running[job_id] = job
+        job.task = asyncio.ensure_future(self._run(job_id, job, lock))
+        return True
+
+    def resume_interrupted(self):
+        "Carry on with the jobs that were running when the process running them stopped"
+        for job_id in self._job_ids():
+            checkpoint = _read_json(os.path.join(self.directory, job_id, "checkpoint.json"))
+            if checkpoint is not None and checkpoint["state"] == "running":
+                if self.start(job_id):
+                    logger.info(f"Resuming warm-up job {job_id} from its checkpoint")
+
+    def status(self, job_id):
+        """Return the status of the job, or None if there is no such job.
+        The status of a job run by another process is read from its checkpoint."""
+        job = self.running.get(job_id)
+        if job is not None:
+            return job.status()
+        path = self._path(job_id)
+        if path is None:
+            return None
+        progress = _read_json(os.path.join(path, "checkpoint.json")) or _new_progress()
+        if progress["state"] == "running" and not _is_locked(path):
+            # its process stopped without checkpointing a pause or cancel
+            progress["state"] = _read_control(path) or "interrupted"
+            progress["in_flight"] = 0
+            progress["throughput_per_second"] = 0
+        return _status(_read_json(os.path.join(path, "job.json")), progress)
+
+    def statuses(self):
+        "Return the status of every job, oldest first"
+        statuses = [self.status(job_id) for job_id in self._job_ids()]
+        return sorted([s for s in statuses if s is not None], key=lambda s: s["created_at"])
+
+    async def pause(self, job_id):
+        "Stop the job at its checkpoint until it is resumed. Returns its status, or None if there is no such job."
+        return await self._stop(job_id, "paused")
+
+    async def cancel(self, job_id):
+        "Stop the job for good. Returns its status, or None if there is no such job."
+        return await self._stop(job_id, "cancelled")
+
+    async def resume(self, job_id):
+        """Run a paused, interrupted or failed job from its checkpoint in this process,
+        if no other process runs it. Returns its status, or None if there is no such job."""
+        path = self._path(job_id)
+        if path is None:
+            return None
+        status = self.status(job_id)
+        if status["state"] in FINAL_STATES:
+            return status
+        _clear_control(path)
+        self.start(job_id)
+        return self.status(job_id)
+
+    async def close(self):
+        """Stop the jobs run by this process, checkpointing them as running
+        so they are resumed when the service starts again"""
+        await asyncio.gather(*(job.stop(job.state) for job in list(self.running.values())))
+
+    async def _stop(self, job_id, state):
+        path = self._path(job_id)
+        if path is None:
+            return None
+        status = self.status(job_id)
+        if status["state"] in FINAL_STATES:
+            return status
+        # read at the next checkpoint by whichever process runs the job
+        _write_json(os.path.join(path, "control.json"), {"state": state})
+        job = self.running.get(job_id)
+        if job is not None:
+            await job.stop(state)
+        elif not _is_locked(path):
+            progress = _read_json(os.path.join(path, "checkpoint.json")) or _new_progress()
+            progress["state"] = state
+            _write_json(os.path.join(path, "checkpoint.json"), progress)
+        return self.status(job_id)
+
+    async def _run(self, job_id, job, lock):
+        try:
+            await job.run()
+        finally:
+            del self.running[job_id]
+            os.close(lock)
+
+    def _path(self, job_id):
+        "The directory of the job, or None if there is no such job"
+        if JOB_ID_RE.match(job_id) is None:
+            return None
+        path = os.path.join(self.directory, job_id)
+        return path if os.path.exists(os.path.join(path, "job.json")) else None
+
+    def _job_ids(self):
+        try:
+            return [name for name in os.listdir(self.directory) if self._path(name) is not None]
+        except FileNotFoundError:
+            return []
+
+
+class WarmupJob:
+    """A warm-up job run by this process, from its checkpoint if it has one.
+
+    Ids are read from the job's list as they are needed, so lists of millions of
+    ids aren't held in memory. They finish out of order, so progress is kept as
+    the watermark, the position in the list before which every id is resolved,
+    and the positions after it that are resolved already. The ids in flight when
+    the job stops are resolved again when it resumes.
+    """
+
+    def __init__(self, path, limiter, warm, checkpoint_seconds):
+        self.path = path
+        self.limiter = limiter
+        self.warm = warm
+        self.checkpoint_seconds = checkpoint_seconds
+        self.options = _read_json(os.path.join(path, "job.json"))
+        progress = _read_json(os.path.join(path, "checkpoint.json")) or _new_progress()
+        self.state = progress["state"]
+        self.counts = progress["counts"]
+        self.next_index = progress["watermark"]
+        self.next_offset = progress["watermark_offset"]
+        self.completed = set(progress["completed_ahead"])
+        self.elapsed = progress["elapsed_seconds"]
+        self.last_error = progress["last_error"]
+        self.in_flight = {}  # position in the list: byte offset of its line
+        self.started = None
+        self.resolved = 0  # ids resolved since the job last started
+        self.task = None
+
+    async def run(self):
+        """Resolve the ids left in the list, checkpointing every checkpoint_seconds
+        and when the job stops"""
+        control = _read_control(self.path)
+        if control is not None:
+            self.state = control
+            self._checkpoint()
+            return
+        self.state = "running"
+        self.started = time.monotonic()
+        self._checkpoint()
+        # only the requests of this task and the tasks it starts are rate limited
+        token = rate_limiter.set(self.limiter)
+        ids = self._ids()
+        checkpoints = asyncio.ensure_future(self._checkpoint_periodically())
+        try:
+            await asyncio.gather(*(self._worker(ids) for _ in range(self.options["concurrency"])))
+            self.state = "finished"
+        except Exception as e:
+            logger.error(f"Warm-up job {self.options['id']} failed - {e}")
+            self.state = "failed"
+            self.last_error = str(e)
+        finally:
+            checkpoints.cancel()
+            ids.close()
+            rate_limiter.reset(token)
+            self.elapsed += time.monotonic() - self.started
+            self.started = None
+            self._checkpoint()
+
+    async def stop(self, state):
+        "Stop the job, leaving it in state"
+        self.state = state
+        self.task.cancel()
+        await asyncio.wait([self.task])
+
+    def status(self):
+        return _status(self.options, self._progress())
+
+    async def _worker(self, ids):
+        for index, uniprot_id in ids:
+            try:
+                status = RESULT_STATUSES[await self.warm(uniprot_id, self.options["source_dbs"])]
+            except Exception as e:
+                logger.error(f"Failed to warm the cache with {uniprot_id} - {e}")
+                self.last_error = f"{uniprot_id}: {e}"
+                status = "failed"
+            del self.in_flight[index]
+            self.completed.add(index)
+            self.counts[status] += 1
+            self.resolved += 1
+            WARMUP_IDS.labels(status).inc()
+
+    def _ids(self):
+        "Yield (position, id) for each id of the list from the watermark on that isn't resolved yet"
+        with open(os.path.join(self.path, "ids.txt"), "rb") as f:
+            f.seek(self.next_offset)
+            for line in f:
+                index, offset = self.next_index, self.next_offset
+                self.next_index += 1
+                self.next_offset += len(line)
+                uniprot_id = line.strip().decode(errors="replace")
+                if uniprot_id == "" or index in self.completed:
+                    continue
+                self.in_flight[index] = offset
+                yield index, uniprot_id
+
+    async def _checkpoint_periodically(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_seconds)
+            control = _read_control(self.path)
+            if control is not None:
+                # paused or cancelled through another process
+                self.state = control
+                self.task.cancel()
+                return
+            self._checkpoint()
+
+    def _checkpoint(self):
+        watermark = min(self.in_flight) if len(self.in_flight) > 0 else self.next_index
+        self.completed = {index for index in self.completed if index >= watermark}
+        _write_json(os.path.join(self.path, "checkpoint.json"), self._progress())
+
+    def _progress(self):
+        "The progress of the job, as kept in its checkpoint"
+        if len(self.in_flight) > 0:
+            watermark = min(self.in_flight)
+            watermark_offset = self.in_flight[watermark]
+        else:
+            watermark, watermark_offset = self.next_index, self.next_offset
+        elapsed = self.elapsed
+        throughput = 0
+        if self.started is not None:
+            run_seconds = time.monotonic() - self.started
+            elapsed += run_seconds
+            throughput = self.resolved / run_seconds if run_seconds > 0 else 0
+        elif elapsed > 0:
+            throughput = sum(self.counts.values()) / elapsed
+        return {"state": self.state, "watermark": watermark, "watermark_offset": watermark_offset,
+                "completed_ahead": sorted(index for index in self.completed if index >= watermark),
+                "counts": dict(self.counts), "in_flight": len(self.in_flight),
+                "elapsed_seconds": elapsed, "throughput_per_second": throughput,
+                "last_error": self.last_error, "updated_at": time.time()}
+
+
+# --------------------------------------------------------
+# --------------- PRIVATE HELPER FUNCTIONS ---------------
+# --------------------------------------------------------
+
+
+def _new_progress():
+    return {"state": "running", "watermark": 0, "watermark_offset": 0, "completed_ahead": [],
+            "counts": {"done": 0, "skipped": 0, "failed": 0}, "in_flight": 0,
+            "elapsed_seconds": 0, "throughput_per_second": 0, "last_error": None, "updated_at": None}
+
+
+def _status(options, progress):
+    """The status of a job from its options and progress: the ids done (fetched),
+    skipped (already cached) and failed, and the ids resolved per second since
+    it last started (or over its whole run once stopped), with the seconds left at that rate"""
+    counts = progress["counts"]
+    remaining = options["total"] - sum(counts.values())
+    throughput = progress["throughput_per_second"]
+    eta = None
+    if progress["state"] == "running" and throughput > 0:
+        eta = round(remaining / throughput)
+    return {"id": options["id"], "state": progress["state"], "source_dbs": options["source_dbs"],
+            "concurrency": options["concurrency"], "total": options["total"], **counts,
+            "remaining": remaining, "in_flight": progress["in_flight"],
+            "throughput_per_second": round(throughput, 2), "eta_seconds": eta,
+            "elapsed_seconds": round(progress["elapsed_seconds"], 1),
+            "created_at": options["created_at"], "updated_at": progress["updated_at"],
+            "last_error": progress["last_error"]}
+
+
+def _copy_ids(ids_file, path):
+    "Copy the id list in ids_file to path, returning the number of ids in it"
+    with open(path, "wb") as f:
+        shutil.copyfileobj(ids_file, f)
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip() != b"")
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(path, value):
+    "Write value to path in one step, so readers in other processes never see part of it"
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w") as f:
+        json.dump(value, f)
+    os.replace(temp, path)
+
+
+def _read_control(path):
+    "The state a job was paused or cancelled to, or None"
+    control = _read_json(os.path.join(path, "control.json"))
+    return None if control is None else control["state"]
+
+
+def _clear_control(path):
+    try:
+        os.remove(os.path.join(path, "control.json"))
+    except FileNotFoundError:
+        pass
+
+
+def _try_lock(path):
+    """Take the lock of the job directory at path, returning its descriptor,
+    or None if another process (or descriptor) holds it.
+    flock, unlike lockf, locks the open file rather than the process, so
+    checking the lock from the process that holds it doesn't release it."""
+    fd = os.open(os.path.join(path, "lock"), os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except (BlockingIOError, PermissionError):
+        os.close(fd)
+        return None
+
+
+def _is_locked(path):
+    "Return True if a process is running the job in the directory at path"
+    fd = _try_lock(path)
+    if fd is None:
+        return True
+    os.close(fd)
+    return False
@@ -0,0 +1,65 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.pss
+from src.http_client import close_client
+
+
+class FakeCache(ThreadingHTTPServer):
+    """Stands in for the cache service on a local port, recording the requests made to it.
+    Subclasses answer the requests by overriding respond."""
+    daemon_threads = True
+
+    def __init__(self):
+        self.requests = []
+        super().__init__(("127.0.0.1", 0), FakeCacheHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def respond(self, request, body):
+        """Return the status, body and optionally the headers of the response to request, the handler,
+        with the request body read into body. A body that isn't bytes is sent as json."""
+        raise NotImplementedError
+
+
+class FakeCacheHandler(BaseHTTPRequestHandler):
+    def handle_request(self):
+        self.server.requests.append((self.command, self.path))
+        length = int(self.headers.get("Content-Length", 0))
+        status, body, *headers = self.server.respond(self, self.rfile.read(length) if length > 0 else b"")
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers[0] if headers else {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeCacheMixin:
+    """For IsolatedAsyncioTestCases: serves a FakeCache as the cache of src.pss, or as another
+    service whose url is the setting of module, and stops it after the test"""
+
+    cache = None
+
+    def start_cache(self, cache, module=src.pss, setting="CACHE_CONTAINER_URL", path=""):
+        self.cache = cache
+        self.replaced_setting = (module, setting, getattr(module, setting))
+        setattr(module, setting, cache.url() + path)
+        return cache
+
+    async def asyncTearDown(self):
+        await close_client()
+        if self.cache is not None:
+            setattr(*self.replaced_setting)
+            self.cache.shutdown()
+            self.cache.server_close()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import unittest
 logger = logging.getLogger(__name__)
@@ -166,7 +167,7 @@ class TestPDBeEntry(unittest.TestCase):
     def test_fetch(self):
         def get_output(metadata_dict):
             test_entry = PDBeEntry(metadata_dict)
-            return test_entry.fetch()
+            return asyncio.run(test_entry.fetch())
         self.assertEqual(len(get_output({'id': '1fsx'})), 440235, "Mismatching pdb file lengths for pdb-id 1sfx")
         
 
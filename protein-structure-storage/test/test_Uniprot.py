@@ -8,40 +8,64 @@ from urllib.request import urlopen
 from src.uniprot import _request_uniprot_file
 from src.uniprot import _parse_uniprot_xml
 from src.uniprot import uniprot_get_entries
+from src.uniprot import _entries_from_xml, _fetch_uniprot_entries, _EntriesParser
+from src.uniprot import UnknownUniprotId, UniprotUnavailable
+import src.uniprot
+from test.fake_cache import FakeCache, FakeCacheMixin
 
-class TestUniprot(unittest.TestCase):
-    def test__request_uniprot_file(self):
+test_xml = """<?xml version='1.0' encoding='UTF-8'?>
+<uniprot xmlns="http://uniprot.org/uniprot">
+<entry dataset="Swiss-Prot">
+  <accession>P02070</accession>
+  <reference key="1">
+    <citation type="journal article"><dbReference type="PDB" id="9XXX"/></citation>
+  </reference>
+  <dbReference type="EMBL" id="M10051"><property type="molecule type" value="mRNA"/></dbReference>
+  <dbReference type="PDB" id="1A00">
+    <property type="method" value="X-ray"/>
+    <property type="resolution" value="1.34 A"/>
+    <property type="chains" value="B/D=1-145"/>
+  </dbReference>
+  <dbReference type="GO" id="GO:0005833"><property type="term" value="C:hemoglobin complex"/></dbReference>
+  <dbReference type="AlphaFoldDB" id="P02070"/>
+  <sequence length="4" mass="15389" checksum="C0F2B2B3" version="2">MVLS</sequence>
+</entry>
+</uniprot>
+"""
+
+class TestUniprot(unittest.IsolatedAsyncioTestCase):
+    async def test__request_uniprot_file(self):
         #Valid A
-        validTest = _request_uniprot_file("p02070","xml")
+        validTest = await _request_uniprot_file("p02070","xml")
         comparison = urlopen("https://rest.uniprot.org/uniprotkb/p02070.xml")
         self.assertEqual(validTest, comparison.read())
         
         #Valid B
-        validTest = _request_uniprot_file("p06213","xml")
+        validTest = await _request_uniprot_file("p06213","xml")
         comparison = urlopen("https://rest.uniprot.org/uniprotkb/p06213.xml")
         self.assertEqual(validTest, comparison.read())
 
         #Valid C
-        validTest = _request_uniprot_file("a0pk11","xml")
+        validTest = await _request_uniprot_file("a0pk11","xml")
         comparison = urlopen("https://rest.uniprot.org/uniprotkb/a0pk11.xml")
         self.assertEqual(validTest, comparison.read())
 
         #Invalid uniprot_id
-        self.assertEqual(_request_uniprot_file("ImNotAnId", "xml"), None)
+        self.assertEqual(await _request_uniprot_file("ImNotAnId", "xml"), None)
 
         #Invalid filetype
-        self.assertEqual(_request_uniprot_file("p02070", "ImNotAFiletype"), None)
+        self.assertEqual(await _request_uniprot_file("p02070", "ImNotAFiletype"), None)
 
         #Invalid filetype
-        self.assertEqual(_request_uniprot_file("p02070", None), None)
+        self.assertEqual(await _request_uniprot_file("p02070", None), None)
 
         #Non-string uniprot_id
-        self.assertEqual(_request_uniprot_file(2070, "xml"), None)
+        self.assertEqual(await _request_uniprot_file(2070, "xml"), None)
 
         #Non-xml filetype
-        self.assertEqual(_request_uniprot_file("p02070", "html"), None)
+        self.assertEqual(await _request_uniprot_file("p02070", "html"), None)
 
-    def test_parse_uniprot_xml(self):
+    async def test_parse_uniprot_xml(self):
         path = "test/testdata/uniprot"
         test_cases = [ # List of uniprot_id, expected_output_file tuples
             ("A0A7M7QR98", f"{path}/A0A7M7QR98.json"),
@@ -52,7 +76,7 @@ class TestUniprot(unittest.TestCase):
         ]
 
         for uniprot_id, expected_output_file in test_cases:
-            actual_output = _parse_uniprot_xml(uniprot_id)
+            actual_output = await _parse_uniprot_xml(uniprot_id)
             if expected_output_file == None:
                 self.assertEqual(actual_output, [], f"Parser incorrectly handled invalid uniprot_id {uniprot_id}.")
             else:
@@ -65,5 +89,44 @@ class TestUniprot(unittest.TestCase):
                         self.assertNotEqual(elem["protein_metadata"].get(test_case,None), None, f"Parser incorrectly handled valid uniprot file {uniprot_id}, '{test_case}' attribute did not exist.")
                         self.assertNotEqual(elem["protein_metadata"].get(test_case,""), "", f"Parser incorrectly handled valid uniprot file {uniprot_id}, '{test_case}' attribute is empty.")
 
+    def test_entries_from_xml(self):
+        protein_metadata = {"sequence": "MVLS", "mass": "15389", "sequence_length": "4"}
+        self.assertEqual(_entries_from_xml(test_xml), [
+            {"external_db_name": "PDB", "id": "1A00", "method": "X-ray", "resolution": "1.34 A",
+             "chains": "B/D=1-145", "protein_metadata": protein_metadata},
+            {"external_db_name": "AlphaFoldDB", "id": "P02070", "protein_metadata": protein_metadata},
+        ], "Expected only the supported databases, and no references nested in citations")
+        self.assertEqual([e["id"] for e in _entries_from_xml(test_xml.encode(), databases={"EMBL", "GO"})],
+                         ["M10051", "GO:0005833"])
+
+    def test_entries_parsed_in_chunks(self):
+        parser = _EntriesParser()
+        data = test_xml.encode()
+        for i in range(0, len(data), 7):
+            parser.feed(data[i:i + 7])
+        self.assertEqual(parser.close(), _entries_from_xml(test_xml))
+
+
+class FakeUniprot(FakeCache):
+    "Serves test_xml for P02070, and fails with 500 for FAIL"
+
+    def respond(self, request, body):
+        if request.path == "/P02070.xml":
+            return 200, test_xml.encode()
+        return (500 if request.path == "/FAIL.xml" else 404), b"Error"
+
+
+class TestFetchUniprotEntries(FakeCacheMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.start_cache(FakeUniprot(), src.uniprot, "UNIPROT_ENTRY_URL", path="/")
+
+    async def test_entries_are_parsed_from_the_stream(self):
+        self.assertEqual(await _fetch_uniprot_entries("P02070"), _entries_from_xml(test_xml))
+        with self.assertRaises(UnknownUniprotId):
+            await _fetch_uniprot_entries("NOTANID")
+        with self.assertRaises(UniprotUnavailable):
+            await _fetch_uniprot_entries("FAIL")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import time
+import unittest
+
+from src.fetch_strategy import LatencyWindow, fetch_ranked, hedged
+
+
+class FakeEntry:
+    "Entry whose fetch returns pdb_file after delay seconds"
+
+    def __init__(self, id, pdb_file, delay=0):
+        self.entry_data = {"id": id, "external_db_name": "PDB"}
+        self.pdb_file = pdb_file
+        self.delay = delay
+
+    def get_entry_data(self, field):
+        return self.entry_data[field]
+
+    async def fetch(self):
+        await asyncio.sleep(self.delay)
+        return self.pdb_file
+
+
+def mirror(result, delay, calls):
+    "Fetch function for hedged returning result after delay seconds, recording its calls"
+    async def fetch():
+        calls.append(result)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            calls.append("cancelled " + result)
+            raise
+        return result
+    return fetch
+
+
+def window(seconds):
+    "A LatencyWindow whose percentile is seconds"
+    latencies = LatencyWindow()
+    for _ in range(20):
+        latencies.add(seconds)
+    return latencies
+
+
+class TestFetchStrategy(unittest.IsolatedAsyncioTestCase):
+    async def test_fetch_ranked(self):
+        entries = [FakeEntry("1", ""), FakeEntry("2", "slow", delay=10), FakeEntry("3", "ATOM"), FakeEntry("4", "ATOM 4")]
+        start = time.perf_counter()
+        entry, pdb_file = await fetch_ranked(entries, attempt_seconds=0.1)
+        self.assertEqual((entry.entry_data["id"], pdb_file), ("3", "ATOM"),
+                         "Expected the first entry that could be fetched in time")
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(await fetch_ranked(entries, attempt_seconds=0.1, max_attempts=2), (None, ""))
+
+    async def test_hedged_fast_primary(self):
+        calls = []
+        result = await hedged([mirror("first", 0, calls), mirror("second", 0, calls)], [window(0.5), window(0.5)])
+        self.assertEqual(result, "first")
+        self.assertEqual(calls, ["first"], "The second mirror should not be asked if the first answers in time")
+
+    async def test_hedged_slow_primary(self):
+        calls = []
+        start = time.perf_counter()
+        result = await hedged([mirror("first", 5, calls), mirror("second", 0.05, calls)], [window(0.1), window(0.1)])
+        self.assertEqual(result, "second")
+        self.assertLess(time.perf_counter() - start, 1)
+        await asyncio.sleep(0)
+        self.assertEqual(calls, ["first", "second", "cancelled first"], "Expected the slow request to be cancelled")
+
+    async def test_hedged_failing_primary(self):
+        calls = []
+        start = time.perf_counter()
+        result = await hedged([mirror("", 0, calls), mirror("second", 0, calls)], [window(5), window(5)])
+        self.assertEqual(result, "second")
+        self.assertLess(time.perf_counter() - start, 1, "The next mirror should be asked as soon as one fails")
+        self.assertEqual(await hedged([mirror("", 0, calls), mirror("", 0, calls)], [window(5), window(5)]), "")
+
+    def test_latency_window(self):
+        latencies = LatencyWindow(size=100)
+        self.assertEqual(latencies.percentile(95, default=1), 1, "Expected the default until there are enough samples")
+        for i in range(200):
+            latencies.add(i / 1000)
+        self.assertAlmostEqual(latencies.percentile(95), 0.195, msg="Expected the percentile of the most recent samples")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import gzip
+import logging
+import io
+import json
+import unittest
+import zipfile
+logger = logging.getLogger(__name__)
+
+from src.helpers import ndjson_stream, zip_stream, gzip_stream, accepts_gzip
+
+test_results = [("P02070", "ATOM 1\nEND\n"), ("ImNotAnId", ""), ("P06213", "ATOM 2\nEND\n" * 1000)]
+
+
+async def aiter_list(items):
+    for item in items:
+        yield item
+
+
+def collect(stream):
+    "Run an async generator to completion, returning what it yielded"
+    async def consume():
+        return [x async for x in stream]
+    return asyncio.run(consume())
+
+class TestHelpers(unittest.TestCase):
+    def test_ndjson_stream(self):
+        lines = collect(ndjson_stream(aiter_list(test_results)))
+        self.assertEqual(len(lines), 3, "Expected one line per result")
+        for line, (uniprot_id, pdb_file) in zip(lines, test_results):
+            self.assertTrue(line.endswith("\n"), "Lines should be newline terminated")
+            response = json.loads(line)
+            self.assertEqual(response["uniprot_id"], uniprot_id)
+            self.assertEqual(response["present"], pdb_file != "", f"Wrong present flag for {uniprot_id}")
+            self.assertEqual(response["pdb_file"], pdb_file)
+
+    def test_zip_stream(self):
+        chunks = collect(zip_stream(aiter_list(test_results)))
+        self.assertGreater(len(chunks), 1, "Archive should be streamed in more than one chunk")
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+        self.assertEqual(archive.namelist(), ["P02070.pdb", "P06213.pdb", "missing.txt"])
+        self.assertEqual(archive.read("P06213.pdb").decode(), test_results[2][1])
+        self.assertEqual(archive.read("missing.txt").decode(), "ImNotAnId\n")
+
+    def test_gzip_stream(self):
+        chunks = collect(gzip_stream(aiter_list([b"ATOM 1\n" * 1000, b"", b"END\n"])))
+        self.assertEqual(gzip.decompress(b"".join(chunks)), b"ATOM 1\n" * 1000 + b"END\n")
+        self.assertEqual(gzip.decompress(b"".join(collect(gzip_stream(aiter_list([]))))), b"")
+
+    def test_accepts_gzip(self):
+        for header, expected in [(None, False), ("", False), ("gzip", True), ("GZIP", True), ("deflate, gzip", True),
+                                 ("br;q=1.0, gzip;q=0.8", True), ("gzip;q=0.001", True), ("gzip; q=0.5", True),
+                                 ("*", True), ("*;q=0.5", True), ("identity", False), ("deflate", False),
+                                 ("gzip;q=0", False), ("gzip;q=0.0", False), ("gzip;q=x", False), ("*;q=0", False),
+                                 ("*;q=0, gzip", True), ("gzip, *;q=0", True), ("gzip;q=0, *", False),
+                                 ("*, gzip;q=0", False), ("gzip;q=0, gzip;q=0.5", True), ("gzip;q=0.5, gzip;q=0", True)]:
+            self.assertEqual(accepts_gzip(header), expected, f"Wrong answer for Accept-Encoding: {header}")
+
+    def test_zip_stream_empty(self):
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(collect(zip_stream(aiter_list([]))))))
+        self.assertEqual(archive.namelist(), [], "Expected an empty archive")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import gzip
+import unittest
+from hashlib import blake2b
+import httpx
+from src.main import app, etag_matches
+from test.fake_cache import FakeCache, FakeCacheMixin
+
+
+class FileCache(FakeCache):
+    "Cache holding one file under every key"
+    pdb_file = b"ATOM      1  CA  ALA A   1\nEND\n"
+
+    def __init__(self):
+        self.hash = blake2b(self.pdb_file).hexdigest()
+        super().__init__()
+
+    def respond(self, request, body):
+        if request.path.startswith("/raw/"):
+            return 200, gzip.compress(self.pdb_file), {"Content-Encoding": "gzip", "X-Cache-Hash": self.hash}
+        return 200, {"present": True, "metadata": {"hash": self.hash}}
+
+
+class TestConditionalRequests(FakeCacheMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.start_cache(FileCache())
+
+    async def test_not_modified(self):
+        etag = f'"{self.cache.hash}"'
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://pss") as client:
+            for path in ["/retrieve_by_uniprot_id/P02070", "/retrieve_by_key/1", "/retrieve_by_sequence/MVL"]:
+                r = await client.get(path, headers={"Accept-Encoding": "identity"})
+                self.assertEqual(r.content, self.cache.pdb_file)
+                self.assertEqual(r.headers["ETag"], etag)
+                self.assertIn("Cache-Control", r.headers)
+                r = await client.get(path, headers={"Accept-Encoding": "gzip"})
+                self.assertEqual(r.headers["ETag"], "W/" + etag, "Expected a weak ETag for the compressed file")
+
+                self.cache.requests.clear()
+                r = await client.get(path, headers={"If-None-Match": etag})
+                self.assertEqual(r.status_code, 304)
+                self.assertEqual(r.content, b"")
+                self.assertFalse(any(p.startswith("/raw/") for _, p in self.cache.requests),
+                                 f"Expected only the metadata of the file to be read, read {self.cache.requests}")
+                r = await client.get(path, headers={"If-None-Match": '"stale"'})
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(r.content, self.cache.pdb_file)
+
+    async def test_encoding_follows_accept_encoding(self):
+        etag = f'"{self.cache.hash}"'
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://pss") as client:
+            for path in ["/retrieve_by_uniprot_id/P02070", "/retrieve_by_key/1", "/retrieve_by_sequence/MVL"]:
+                for accept_encoding, encoding in [("gzip;q=0", None), ("gzip;q=0, *", None),
+                                                  ("*;q=0, gzip", "gzip"), ("*", "gzip")]:
+                    r = await client.get(path, headers={"Accept-Encoding": accept_encoding})
+                    self.assertEqual(r.headers.get("Content-Encoding"), encoding,
+                                     f"Wrong encoding for Accept-Encoding: {accept_encoding}")
+                    self.assertEqual(r.headers["ETag"], etag if encoding is None else "W/" + etag)
+                    self.assertEqual(r.content, self.cache.pdb_file)
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"abc"', "abc"))
+        self.assertTrue(etag_matches('W/"abc"', "abc"))
+        self.assertTrue(etag_matches('"x", W/"abc"', "abc"))
+        self.assertTrue(etag_matches("*", "abc"))
+        self.assertFalse(etag_matches('"x"', "abc"))
+        self.assertFalse(etag_matches("*", ""), "Expected no match when there is no file")
+        self.assertFalse(etag_matches(None, "abc"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,12 @@
 import logging
+import gzip
 import json
 import unittest
+from prometheus_client import REGISTRY
 from src.pss import *
 from src.database_entries.afdb_entry import AFDBEntry
 from src.database_entries.pdbe_entry import PDBeEntry
+from test.fake_cache import FakeCache, FakeCacheMixin
 
 
 logger = logging.getLogger(__name__)
@@ -11,17 +14,78 @@ afdb_test_entry = AFDBEntry({'id': 'P02070'})
 pdbe_test_entry = PDBeEntry({'id': '6II1', 'method': 'X-ray', 'resolution': '1.34 A', 'chains': 'B/D=1-145', 'protein_metadata': {'mass':15389, 'sequence_length':145, 'sequence': 'MVLSAADKGNVKAAWGKVGGHAAEYGAEALERMFLSFPTTKTYFPHFDLSHGSAQVKGHGAKVAAALTKAVEHLDDLPGALSELSDLHAHKLRVDPVNFKLLSHSLLVTLASHLPSDFTPAVHASLDKFLANVSTVLTSKYRPSD'}})
 
 
-class Testpss(unittest.TestCase):
+class Testpss(unittest.IsolatedAsyncioTestCase):
     
-    def test_get_pdb_file(self):
-        pdb_file1 = get_pdb_file('P02070', override_cache=True, source_dbs=None)
-        self.assertNotEqual(afdb_test_entry.fetch(), pdb_file1, "Expected pdb file of a PDBe entry. Got an AFDB file.")
-        self.assertEqual(pdbe_test_entry.fetch(), pdb_file1, "Recieved file does not match with test PDBe file")
+    async def test_get_pdb_file(self):
+        pdb_file1 = await get_pdb_file('P02070', override_cache=True, source_dbs=None)
+        self.assertNotEqual(await afdb_test_entry.fetch(), pdb_file1, "Expected pdb file of a PDBe entry. Got an AFDB file.")
+        self.assertEqual(await pdbe_test_entry.fetch(), pdb_file1, "Recieved file does not match with test PDBe file")
 
         #TESTING source_dbs flag with AFDB
-        pdb_file2 =  get_pdb_file('P02070', override_cache=True, source_dbs=["AFDB"])
-        self.assertNotEqual(pdbe_test_entry.fetch(),  pdb_file2, "Expected pdb file of an AFDB entry. Got a PDBe file. Check source_dbs flag")
-        self.assertEqual(afdb_test_entry.fetch(), pdb_file2, "Recieved file does not match with test AFDB file")
+        pdb_file2 =  await get_pdb_file('P02070', override_cache=True, source_dbs=["AFDB"])
+        self.assertNotEqual(await pdbe_test_entry.fetch(),  pdb_file2, "Expected pdb file of an AFDB entry. Got a PDBe file. Check source_dbs flag")
+        self.assertEqual(await afdb_test_entry.fetch(), pdb_file2, "Recieved file does not match with test AFDB file")
+
+
+class TombstoneCache(FakeCache):
+    "Cache that has a tombstone for every uniprot id"
+
+    def respond(self, request, body):
+        if request.command == "GET":
+            return 404, b"", {"X-Cache-Tombstone": "unknown_id"}
+        ids = json.loads(body)["ids"]
+        return 200, "".join(json.dumps({"uniprot_id": id, "present": False, "pdb_file": "", "tombstone": "no_structure"})
+                            + "\n" for id in ids).encode()
+
+
+class TestTombstones(FakeCacheMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.start_cache(TombstoneCache())
+
+    async def test_tombstoned_ids_are_not_resolved(self):
+        def tombstones():
+            return REGISTRY.get_sample_value("pss_cache_lookups_total", {"result": "tombstone"}) or 0
+
+        before = tombstones()
+        self.assertEqual(await get_pdb_file("NOTANID", source_dbs=["PDB"]), "")
+        self.assertEqual([r async for r in get_pdb_files(["A", "B"])], [("A", ""), ("B", "")])
+        self.assertEqual(tombstones() - before, 3)
+        self.assertEqual([method for method, _ in self.cache.requests], ["GET", "POST"],
+                         "Expected one cache lookup per request, and nothing resolved or stored")
+
+class CompressingCache(FakeCache):
+    "Cache holding one file, sent gzip compressed as stored to clients accepting gzip"
+    pdb_file = b"ATOM      1  CA  ALA A   1\n" * 500
+
+    def __init__(self):
+        self.compressed = gzip.compress(self.pdb_file, mtime=0)
+        super().__init__()
+
+    def respond(self, request, body):
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            return 200, self.compressed, {"Content-Encoding": "gzip"}
+        return 200, self.pdb_file
+
+
+class TestCompression(FakeCacheMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.start_cache(CompressingCache())
+
+    async def read(self, chunks):
+        return b"".join([chunk async for chunk in chunks])
+
+    async def test_compressed_files_are_passed_through(self):
+        self.assertEqual(await self.read(await stream_pdb_file_by_db_id("1", encoding="gzip")), self.cache.compressed,
+                         "Expected the file as the cache sent it, without recompressing it")
+        self.assertEqual(await self.read(await stream_pdb_file_by_db_id("1")), self.cache.pdb_file)
+        self.assertEqual(await get_pdb_file_by_db_id("1"), self.cache.pdb_file.decode())
+
+    async def test_uncompressed_files_are_compressed(self):
+        client = get_client()
+        client.headers["Accept-Encoding"] = "identity"
+        compressed = await self.read(await stream_pdb_file_by_db_id("1", encoding="gzip"))
+        self.assertEqual(gzip.decompress(compressed), self.cache.pdb_file)
+
 
 if __name__ == "__main__":
     unittest.main()
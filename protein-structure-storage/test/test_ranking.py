@@ -0,0 +1,65 @@
+import logging
+import random
+import unittest
+
+from src.database_entries.afdb_entry import AFDBEntry
+from src.database_entries.pdbe_entry import PDBeEntry, pdbe_weights
+from src.database_entries.ranking import score_entries, top_entries
+logging.getLogger("src.database_entries.pdbe_entry").setLevel(logging.CRITICAL) # Disable errors of invalid weights
+logging.getLogger("src.database_entries.ranking").setLevel(logging.CRITICAL)
+
+SEQUENCE = "MVLSAADKGNVKAAWGKVGGHAAEYGAEALERMFLSFPTTKTYFPHFDLSHGSAQVKGHGAKVAAALTKAVEHLDDLPGALSELSD"
+
+
+def random_entry_data(rng, i):
+    "The entry data of a PDB entry, sometimes with missing or corrupted fields"
+    data = {"external_db_name": "PDB", "id": f"{i:04X}",
+            "method": rng.choice(["X-ray", "EM", "NMR", "Neutron", "other"]),
+            "resolution": rng.choice([f"{rng.uniform(0.5, 9):.2f} A", f"{rng.randint(1, 5)} A", "1.3A", "", "-"]),
+            "chains": rng.choice(["A=1-50", "A/B=10-80", "A=1-20, B/C=30-85", "C=5-5", "", "invalid"]),
+            "protein_metadata": {"sequence": SEQUENCE,
+                                 "sequence_length": rng.choice([str(len(SEQUENCE)), "60", "0", "x"])}}
+    if rng.random() < 0.1:
+        data["protein_metadata"] = {}
+    if rng.random() < 0.1:
+        del data["resolution"]
+    return data
+
+
+class TestRanking(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(4)
+        self.interpolation = pdbe_weights["resolution"]["interpolation"]
+
+    def tearDown(self):
+        pdbe_weights["resolution"]["interpolation"] = self.interpolation
+
+    def test_scores_match_entries(self):
+        for interpolation in ["exponential", "linear", "unknown"]:
+            pdbe_weights["resolution"]["interpolation"] = interpolation
+            entries = [PDBeEntry(random_entry_data(self.rng, i)) for i in range(300)]
+            expected = [entry.calculate_raw_quality_score() for entry in entries]
+            scores = score_entries(entries)
+            for i, entry in enumerate(entries):
+                self.assertAlmostEqual(scores[i], expected[i], places=12, msg=f"{interpolation}: {entry.entry_data}")
+                self.assertEqual(entry.quality_score, scores[i])
+
+    def test_top_entries_match_sort(self):
+        entries = [PDBeEntry(random_entry_data(self.rng, i)) for i in range(200)]
+        # identical entries tie, the sort keeps them in the order given
+        entries += [PDBeEntry(dict(entries[0].entry_data, id=f"T{i}")) for i in range(5)]
+        entries.append(AFDBEntry({"external_db_name": "AlphaFoldDB", "id": "P12345"}))
+        self.rng.shuffle(entries)
+        expected = sorted(entries, reverse=True)
+        for k in [1, 3, 10, len(entries), len(entries) + 5]:
+            ranked = top_entries(entries, k)
+            self.assertEqual([e.entry_data["id"] for e in ranked],
+                             [e.entry_data["id"] for e in expected[:k]], f"k={k}")
+
+    def test_top_entries_empty(self):
+        self.assertEqual(top_entries([], 3), [])
+        self.assertEqual(top_entries([AFDBEntry({"external_db_name": "AlphaFoldDB", "id": "P1"})], 0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from src.single_flight import SingleFlight
+
+# Run in another process: resolve key "P1" as "from child" slowly, saying when it has the lock
+child_code = """
+import asyncio, sys
+from src.single_flight import SingleFlight
+
+async def resolve():
+    print("resolving", flush=True)
+    await asyncio.sleep(1)
+    return "from child"
+
+print(asyncio.run(SingleFlight(sys.argv[1]).run(("P1",), resolve)), flush=True)
+"""
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.single_flight = SingleFlight(self.directory.name)
+        self.calls = 0
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def resolve(self, result="ATOM 1\n"):
+        self.calls += 1
+        await asyncio.sleep(0.1)
+        return result
+
+    async def test_concurrent_calls_share_one_resolution(self):
+        results = await asyncio.gather(*[self.single_flight.run(("P1",), self.resolve) for _ in range(20)])
+        self.assertEqual(results, ["ATOM 1\n"] * 20)
+        self.assertEqual(self.calls, 1, "Expected one resolution for concurrent calls with the same key")
+        self.assertEqual(self.single_flight.in_flight, {}, "Finished calls should be forgotten")
+
+    async def test_different_keys_resolve_separately(self):
+        results = await asyncio.gather(self.single_flight.run(("P1",), lambda: self.resolve("a")),
+                                       self.single_flight.run(("P2",), lambda: self.resolve("b")))
+        self.assertEqual(results, ["a", "b"])
+        self.assertEqual(self.calls, 2)
+
+    async def test_errors_are_shared_and_not_kept(self):
+        async def fail():
+            self.calls += 1
+            await asyncio.sleep(0.1)
+            raise ValueError("upstream failed")
+        results = await asyncio.gather(*[self.single_flight.run(("P1",), fail) for _ in range(5)],
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(await self.single_flight.run(("P1",), self.resolve), "ATOM 1\n",
+                         "A failed resolution should not be reused")
+
+    async def test_cancelled_caller_does_not_cancel_resolution(self):
+        first = asyncio.ensure_future(self.single_flight.run(("P1",), self.resolve))
+        second = asyncio.ensure_future(self.single_flight.run(("P1",), self.resolve))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        self.assertEqual(await second, "ATOM 1\n")
+        self.assertEqual(self.calls, 1)
+
+    async def test_result_shared_across_processes(self):
+        child = subprocess.Popen([sys.executable, "-c", child_code, self.directory.name],
+                                 stdout=subprocess.PIPE, text=True)
+        try:
+            line = await asyncio.to_thread(child.stdout.readline)
+            self.assertEqual(line, "resolving\n")
+            result = await self.single_flight.run(("P1",), lambda: self.resolve("from parent"))
+            self.assertEqual(result, "from child", "Expected the result of the other process's resolution")
+            self.assertEqual(self.calls, 0)
+        finally:
+            child.communicate(timeout=10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import unittest
+from urllib.parse import urlparse, parse_qs
+
+from src.uniprot import uniprot_get_entries
+from src.uniprot_metadata import MetadataCache
+from src.database_entries.afdb_entry import AFDBEntry
+from src.database_entries.pdbe_entry import PDBeEntry
+from test.fake_cache import FakeCache, FakeCacheMixin
+
+test_metadata = {"entries": [{"external_db_name": "PDB", "id": "1A00", "method": "X-ray",
+                              "resolution": "1.34 A", "chains": "B/D=1-145"},
+                             {"external_db_name": "AlphaFoldDB", "id": "P02070"},
+                             {"external_db_name": "EMBL", "id": "M10051"}],
+                 "protein_metadata": {"sequence": "MVLS", "sequence_length": "4", "mass": "15389"}}
+
+
+class MetadataStore(FakeCache):
+    "Keeps the uniprot metadata PUT to it, like the cache service"
+
+    def __init__(self):
+        self.stored = {}
+        self.gets = 0
+        super().__init__()
+
+    def respond(self, request, body):
+        url = urlparse(request.path)
+        accession = url.path.split("/")[-1]
+        if request.command == "PUT":
+            self.stored[accession] = json.loads(body)["metadata"]
+            return 200, {"stored": True}
+        self.gets += 1
+        max_age = float(parse_qs(url.query)["max_age"][0])
+        found = self.stored.get(accession)
+        if found is None or max_age < 0:
+            return 200, {"present": False, "metadata": None, "stored_at": None}
+        return 200, {"present": True, "metadata": found, "stored_at": 1e10}
+
+
+class TestMetadataCache(FakeCacheMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.start_cache(MetadataStore())
+
+    async def test_put_and_get(self):
+        metadata_cache = MetadataCache(self.cache.url())
+        self.assertIsNone(await metadata_cache.get("P02070"))
+        metadata_cache.put("p02070", test_metadata)
+        await asyncio.gather(*metadata_cache.storing)
+        self.assertEqual(self.cache.stored, {"P02070": test_metadata}, "Expected the metadata in the cache service")
+
+        gets = self.cache.gets
+        self.assertEqual(await metadata_cache.get("P02070"), test_metadata)
+        self.assertEqual(self.cache.gets, gets, "Expected the metadata from memory")
+
+        # another replica, or after a restart
+        other = MetadataCache(self.cache.url())
+        self.assertEqual(await other.get("P02070"), test_metadata)
+        self.assertEqual(await other.get("P02070"), test_metadata)
+        self.assertEqual(self.cache.gets, gets + 1, "Expected one request to the cache service")
+
+    async def test_unreadable_response_is_a_miss(self):
+        self.cache.respond = lambda request, body: (200, b"<html>Bad gateway</html>")
+        metadata_cache = MetadataCache(self.cache.url())
+        self.assertIsNone(await metadata_cache.get("P02070"), "Expected a response that isn't json to be a miss")
+
+    async def test_ttl_and_size(self):
+        expired = MetadataCache(self.cache.url(), ttl=-1)
+        expired.put("P02070", test_metadata)
+        await asyncio.gather(*expired.storing)
+        self.assertIsNone(await expired.get("P02070"), "Expired metadata returned")
+
+        small = MetadataCache(self.cache.url(), max_entries=2)
+        for accession in ["A", "B", "C"]:
+            small._remember(accession, {}, float("inf"))
+        self.assertEqual(list(small.memory), ["B", "C"], "Expected the least recently used to be dropped")
+
+    async def test_entries_from_cached_metadata(self):
+        metadata_cache = MetadataCache(self.cache.url())
+        metadata_cache._remember("P02070", test_metadata, float("inf"))
+
+        entries = await uniprot_get_entries("P02070", [], metadata_cache=metadata_cache)
+        self.assertEqual([type(e) for e in entries], [PDBeEntry, AFDBEntry], "Unsupported databases should be skipped")
+        self.assertEqual(entries[0].get_protein_metadata(), test_metadata["protein_metadata"])
+        self.assertEqual(entries[0].extract_resolution(), 1.34)
+
+        entries = await uniprot_get_entries("P02070", source_dbs=["ALPHAFOLDDB"], metadata_cache=metadata_cache)
+        self.assertEqual([type(e) for e in entries], [AFDBEntry])
+        self.assertEqual(self.cache.gets, 0, "Expected no requests for metadata kept in memory")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import asyncio
+import gzip
+import json
+import tempfile
+import unittest
+from hashlib import blake2b
+
+from src.upload_queue import UploadQueue
+from test.fake_cache import FakeCache, FakeCacheMixin
+
+
+class BatchCache(FakeCache):
+    """Records the batches posted to /protein_files/, failing the first `failures` with `failure_status`.
+    Files with uniprot ids in `current` are reported as current by /is_current/."""
+
+    def __init__(self, failures=0, failure_status=503, current=(), failure_body=b"unavailable"):
+        self.batches = []
+        self.compressed = 0
+        self.failures = failures
+        self.failure_status = failure_status
+        self.failure_body = failure_body
+        self.current = set(current)
+        self.checked = []
+        super().__init__()
+
+    def respond(self, request, body):
+        if request.headers.get("Content-Encoding") == "gzip":
+            self.compressed += 1
+            body = gzip.decompress(body)
+        files = json.loads(body)
+        if request.path == "/is_current/":
+            self.checked.append(files)
+            return 200, {"current": [f["uniprot_id"] in self.current for f in files]}
+        if self.failures > 0:
+            self.failures -= 1
+            return self.failure_status, self.failure_body
+        self.batches.append(files)
+        return 200, [{"id": str(i), "status": "inserted"} for i in range(len(files))]
+
+
+def put(queue, n, start=0):
+    for i in range(start, start + n):
+        queue.put(f"P{i}", f"ATOM {i}\n" * 100, "MVLSAAD", "PDB", 0.5)
+
+
+class TestUploadQueue(FakeCacheMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        self.spill_dir.cleanup()
+
+    def queue(self, **kwargs):
+        return UploadQueue(self.cache.url(), **{"batch_wait": 0.1, "backoff": 0.01,
+                                                "spill_dir": self.spill_dir.name, **kwargs})
+
+    async def wait_for(self, queue, condition, timeout=5):
+        for _ in range(int(timeout / 0.02)):
+            if condition(queue.stats()):
+                return
+            await asyncio.sleep(0.02)
+        self.fail(f"Timed out waiting on the upload queue: {queue.stats()}")
+
+    async def test_files_are_sent_in_batches(self):
+        self.start_cache(BatchCache())
+        queue = self.queue(batch_size=4)
+        put(queue, 10)
+        self.assertEqual(queue.stats()["pending"], 10)
+        await self.wait_for(queue, lambda s: s["uploaded"] == 10)
+        self.assertEqual([len(b) for b in self.cache.batches], [4, 4, 2])
+        self.assertEqual(self.cache.compressed, 3, "Expected batches to be sent gzip compressed")
+        self.assertEqual(self.cache.batches[0][0]["uniprot_id"], "P0", "Expected the oldest files first")
+        self.assertEqual(set(self.cache.batches[0][0]), {"uniprot_id", "pdb_file", "sequence", "source_db", "score"})
+        self.assertEqual(queue.stats()["pending"], 0)
+        await queue.close()
+
+    async def test_files_the_cache_holds_are_not_sent(self):
+        self.start_cache(BatchCache(current=["P1", "P3"]))
+        queue = self.queue()
+        put(queue, 4)
+        await self.wait_for(queue, lambda s: s["uploaded"] + s["unchanged"] == 4)
+        self.assertEqual((queue.stats()["uploaded"], queue.stats()["unchanged"]), (2, 2))
+        self.assertEqual([f["uniprot_id"] for f in self.cache.batches[0]], ["P0", "P2"])
+        checked = self.cache.checked[0][0]
+        self.assertEqual(set(checked), {"uniprot_id", "source_db", "hash"})
+        self.assertEqual(checked["hash"], blake2b(("ATOM 0\n" * 100).encode()).hexdigest())
+        await queue.close()
+
+    async def test_pending_file_until_stored(self):
+        self.start_cache(BatchCache())
+        queue = self.queue()
+        queue.put("p1", "ATOM 1\n", "MVLSAAD", "PDB", 0.5, ["PDB"])
+        self.assertEqual(queue.pending_file("P1", ["PDB"]), "ATOM 1\n")
+        self.assertIsNone(queue.pending_file("P1", []), "Files resolved from other sources should not be returned")
+        await self.wait_for(queue, lambda s: s["uploaded"] == 1)
+        self.assertIsNone(queue.pending_file("P1", ["PDB"]))
+        await queue.close()
+
+    async def test_failed_batches_are_retried(self):
+        self.start_cache(BatchCache(failures=2))
+        queue = self.queue()
+        put(queue, 3)
+        await self.wait_for(queue, lambda s: s["uploaded"] == 3)
+        self.assertEqual(queue.stats()["retries"], 2)
+        self.assertEqual(len(self.cache.batches), 1)
+        await queue.close()
+
+    async def test_rejected_batches_are_not_retried(self):
+        self.start_cache(BatchCache(failures=1, failure_status=422))
+        queue = self.queue()
+        put(queue, 3)
+        await self.wait_for(queue, lambda s: s["failed"] == 3)
+        self.assertEqual(queue.stats()["retries"], 0)
+        self.assertIn("422", queue.stats()["last_error"])
+        await queue.close()
+
+    async def test_unexpected_response_fails_the_batch(self):
+        self.start_cache(BatchCache(failures=1, failure_status=200, failure_body=b"<html>proxy</html>"))
+        queue = self.queue()
+        put(queue, 3)
+        await self.wait_for(queue, lambda s: s["failed"] == 3)
+        self.assertIn("JSONDecodeError", queue.stats()["last_error"])
+        put(queue, 1, start=3)
+        await self.wait_for(queue, lambda s: s["uploaded"] == 1)
+        await queue.close()
+
+    async def test_gives_up_after_max_attempts(self):
+        self.start_cache(BatchCache(failures=100))
+        queue = self.queue(max_attempts=3)
+        put(queue, 2)
+        await self.wait_for(queue, lambda s: s["failed"] == 2)
+        self.assertEqual(queue.stats()["retries"], 2)
+        await queue.close()
+
+    async def test_spills_to_disk_when_full(self):
+        self.start_cache(BatchCache(failures=1))
+        queue = self.queue(max_bytes=2000)
+        put(queue, 5)
+        self.assertEqual(queue.stats()["pending"], 2)
+        await self.wait_for(queue, lambda s: s["spilled"] == 3)
+        await self.wait_for(queue, lambda s: s["uploaded"] == 5)
+        self.assertEqual(queue.stats()["spilled_pending"], 0)
+        sent = [f["uniprot_id"] for b in self.cache.batches for f in b]
+        self.assertEqual(sent, [f"P{i}" for i in range(5)])
+        await queue.close()
+
+    async def test_drops_without_room(self):
+        self.start_cache(BatchCache())
+        queue = self.queue(max_bytes=2000, spill_dir="")
+        put(queue, 5)
+        await self.wait_for(queue, lambda s: s["dropped"] == 3 and s["uploaded"] == 2)
+        await queue.close()
+
+    async def test_drops_while_spilling_is_full(self):
+        self.start_cache(BatchCache())
+        queue = self.queue(max_bytes=2000, spilling_max_bytes=2000)
+        put(queue, 6)
+        # 2 in memory, 2 waiting to be spilled, and the rest dropped before the spiller runs
+        stats = queue.stats()
+        self.assertEqual((stats["pending"], stats["spilling"], stats["dropped"]), (2, 2, 2))
+        await self.wait_for(queue, lambda s: s["spilled"] == 2 and s["spilling_bytes"] == 0)
+        await self.wait_for(queue, lambda s: s["uploaded"] == 4)
+        await queue.close()
+
+    async def test_close_keeps_unsent_files_for_restart(self):
+        self.start_cache(BatchCache(failures=100))
+        queue = self.queue(backoff=10)
+        put(queue, 3)
+        await asyncio.sleep(0.3)  # the first batch is being retried
+        await queue.close()
+        self.assertEqual(queue.stats()["spilled_pending"], 3)
+
+        self.cache.failures = 0
+        restarted = self.queue()
+        self.assertEqual(restarted.stats()["spilled_pending"], 3)
+        restarted.start()
+        await self.wait_for(restarted, lambda s: s["uploaded"] == 3)
+        await restarted.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import asyncio
+import io
+import logging
+import os
+import tempfile
+import time
+import unittest
+from collections import Counter
+
+from src.http_client import RateLimiter
+from src.warmup import WarmupJobs, id_list_path
+
+logging.getLogger("src.warmup").setLevel(logging.CRITICAL)
+
+
+class FakeWarm:
+    """Stands in for warm_pdb_file: ids starting with C are cached, with M missing,
+    with E raise, the rest are fetched. Ids numbered block_from or more wait until cancelled."""
+
+    def __init__(self, block_from=None):
+        self.calls = Counter()
+        self.block_from = block_from
+
+    async def __call__(self, uniprot_id, source_dbs=None):
+        self.calls[uniprot_id] += 1
+        if self.block_from is not None and int(uniprot_id[1:]) >= self.block_from:
+            await asyncio.Future()
+        await asyncio.sleep(0)
+        if uniprot_id.startswith("E"):
+            raise ValueError("unparseable entry")
+        return {"C": "cached", "M": "missing"}.get(uniprot_id[0], "fetched")
+
+
+def id_list(ids):
+    return io.BytesIO("\n".join(ids).encode())
+
+
+class TestWarmupJobs(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.managers = []
+
+    async def asyncTearDown(self):
+        for jobs in self.managers:
+            await jobs.close()
+        self.directory.cleanup()
+
+    def jobs(self, warm):
+        jobs = WarmupJobs(self.directory.name, rate_limits={}, checkpoint_seconds=0.05, warm=warm)
+        self.managers.append(jobs)
+        return jobs
+
+    async def wait_for(self, jobs, job_id, condition, timeout=5):
+        for _ in range(int(timeout / 0.02)):
+            status = jobs.status(job_id)
+            if condition(status):
+                return status
+            await asyncio.sleep(0.02)
+        self.fail(f"Timed out waiting on the warm-up job: {jobs.status(job_id)}")
+
+    async def test_job_counts_each_id(self):
+        warm = FakeWarm()
+        jobs = self.jobs(warm)
+        ids = [f"P{i}" for i in range(20)] + ["C1", "C2", "", "M1", "E1"]
+        status = await jobs.create(id_list(ids), concurrency=4)
+        self.assertEqual(status["total"], 24)
+        status = await self.wait_for(jobs, status["id"], lambda s: s["state"] == "finished")
+        self.assertEqual((status["done"], status["skipped"], status["failed"], status["remaining"]), (20, 2, 2, 0))
+        self.assertEqual(status["last_error"], "E1: unparseable entry")
+        self.assertEqual(sum(warm.calls.values()), 24)
+        self.assertEqual(jobs.statuses(), [jobs.status(status["id"])])
+        self.assertIsNone(jobs.status("0" * 32))
+
+    async def test_interrupted_job_resumes_from_its_checkpoint(self):
+        warm = FakeWarm(block_from=30)
+        jobs = self.jobs(warm)
+        status = await jobs.create(id_list([f"P{i}" for i in range(50)]), concurrency=4)
+        await self.wait_for(jobs, status["id"], lambda s: s["done"] == 30)
+        await jobs.close()
+
+        # as another worker process sees it
+        restarted = self.jobs(warm)
+        stopped = restarted.status(status["id"])
+        self.assertEqual((stopped["state"], stopped["done"]), ("interrupted", 30))
+        warm.block_from = None
+        restarted.resume_interrupted()
+        status = await self.wait_for(restarted, status["id"], lambda s: s["state"] == "finished")
+        self.assertEqual((status["done"], status["remaining"]), (50, 0))
+        # only the ids in flight when it stopped were resolved twice
+        self.assertEqual([i for i, calls in warm.calls.items() if calls > 1], ["P30", "P31", "P32", "P33"])
+
+    async def test_pause_from_another_process(self):
+        warm = FakeWarm(block_from=10)
+        jobs = self.jobs(warm)
+        status = await jobs.create(id_list([f"P{i}" for i in range(20)]), concurrency=2)
+        await self.wait_for(jobs, status["id"], lambda s: s["done"] == 10)
+
+        other = self.jobs(warm)
+        self.assertEqual(other.status(status["id"])["state"], "running")
+        await other.pause(status["id"])
+        await self.wait_for(other, status["id"], lambda s: s["state"] == "paused")
+        self.assertEqual(jobs.running, {})
+
+        warm.block_from = None
+        self.assertEqual((await other.resume(status["id"]))["state"], "running")
+        status = await self.wait_for(other, status["id"], lambda s: s["state"] == "finished")
+        self.assertEqual(status["done"], 20)
+        self.assertEqual((await other.cancel(status["id"]))["state"], "finished")
+
+
+class TestIdListPath(unittest.TestCase):
+    def test_paths_outside_the_directory_are_rejected(self):
+        with tempfile.TemporaryDirectory() as root:
+            root = os.path.realpath(root)
+            os.symlink("/etc/passwd", os.path.join(root, "link"))
+            self.assertEqual(id_list_path("ids.txt", root), os.path.join(root, "ids.txt"))
+            self.assertEqual(id_list_path(os.path.join(root, "ids.txt"), root), os.path.join(root, "ids.txt"))
+            for path in ["../ids.txt", "/etc/passwd", "link"]:
+                with self.assertRaises(ValueError, msg=path):
+                    id_list_path(path, root)
+            with self.assertRaises(ValueError):
+                id_list_path("ids.txt", "")
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_are_spaced_out(self):
+        limiter = RateLimiter({"rest.uniprot.org": 50})
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.wait("rest.uniprot.org") for _ in range(6)))
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.wait("pc") for _ in range(6)))
+        self.assertLess(time.monotonic() - start, 0.05)